@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""Benchmark doveadm password hashing throughput for a varying number of worker processes
+
+Usage::
+
+    python benchmarks/bench_pw_hash.py --count 2000 --workers 1 2 4 8
+"""
+
+import argparse
+import os
+import time
+
+from postfix_sql_ucli import utils
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=1000, help="number of passwords to hash")
+    parser.add_argument("--workers", type=int, nargs="+", help="numbers of worker processes to benchmark")
+    args = parser.parse_args()
+
+    cpu_count = os.cpu_count() or 1
+    workers = args.workers or sorted({1, *(2**n for n in range(1, cpu_count.bit_length())), cpu_count})
+    passwords = [f"password{n}" for n in range(args.count)]
+
+    print(f"Hashing {args.count} passwords, {cpu_count} CPUs available")
+    print(f"{'workers':>8} {'seconds':>9} {'hashes/s':>10} {'speedup':>8} {'per core':>9}")
+    baseline = None
+    for n in sorted({1, *workers}):
+        start = time.perf_counter()
+        utils.doveadm_pw_hash_many(passwords, workers=n)
+        elapsed = time.perf_counter() - start
+        # speedup relative to hashing in a single process
+        baseline = baseline or elapsed
+        speedup = baseline / elapsed
+        print(f"{n:>8} {elapsed:>9.3f} {args.count / elapsed:>10.0f} {speedup:>8.2f} {speedup / n:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Benchmark cold start of the command line interface using ``python -X importtime``
+
+The import time of ``postfix_sql_ucli.cli`` is measured relative to the import time of ``click``
+in the same interpreter, which makes the result comparable across machines. The script fails if
+the median ratio exceeds the checked-in baseline by more than the tolerance or if any of the heavy
+modules is imported at start-up.
+
+Usage::
+
+    python benchmarks/bench_startup.py [--runs 20] [--update]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_baseline.json")
+
+# modules that must only be imported on the code paths that need them
+HEAVY_MODULES = ["sqlalchemy", "passlib", "yaml", "concurrent.futures"]
+
+PROBE = """
+import sys
+import postfix_sql_ucli.cli
+print(','.join(module for module in {modules!r} if module in sys.modules))
+"""
+
+
+def measure():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE.format(modules=HEAVY_MODULES)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, total, name = line.split("|")
+            if total.strip().isdigit():
+                cumulative[name.strip()] = int(total)
+    imported = [module for module in result.stdout.strip().split(",") if module]
+    return cumulative["postfix_sql_ucli.cli"], cumulative["click"], imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20, help="number of interpreter starts")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown")
+    parser.add_argument("--update", action="store_true", help="store the measured ratio as the new baseline")
+    args = parser.parse_args()
+
+    samples = [measure() for _ in range(args.runs)]
+    cli_us = statistics.median(sample[0] for sample in samples)
+    click_us = statistics.median(sample[1] for sample in samples)
+    ratio = statistics.median(sample[0] / sample[1] for sample in samples)
+    imported = sorted({module for sample in samples for module in sample[2]})
+
+    print(f"postfix_sql_ucli.cli: {cli_us / 1000:.1f} ms, click: {click_us / 1000:.1f} ms, ratio: {ratio:.2f}")
+
+    if args.update:
+        with open(BASELINE_PATH, "w", encoding="utf-8") as baseline_file:
+            json.dump({"ratio": round(ratio, 2)}, baseline_file, indent=2)
+            baseline_file.write("\n")
+        print(f"Baseline updated: {BASELINE_PATH}")
+        return 0
+
+    failed = False
+    if imported:
+        print(f"FAIL: heavy modules imported at start-up: {', '.join(imported)}")
+        failed = True
+
+    with open(BASELINE_PATH, encoding="utf-8") as baseline_file:
+        baseline = json.load(baseline_file)["ratio"]
+    if ratio > baseline * (1 + args.tolerance):
+        print(
+            f"FAIL: start-up import ratio {ratio:.2f} exceeds baseline {baseline:.2f} by more than {args.tolerance:.0%}"
+        )
+        failed = True
+    else:
+        print(f"OK: baseline ratio {baseline:.2f}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+import hashlib
+import shutil
+
+import dataset
+import pytest
+from sqlalchemy import create_engine, create_mock_engine
+
+from postfix_sql_ucli import models
+
+# bump whenever dataset.py changes to invalidate the cached databases
+DATASET_VERSION = 1
+
+
+def schema_digest():
+    """Short digest of the SQLite schema DDL, cached databases are invalidated by schema changes"""
+
+    statements = []
+    engine = create_mock_engine("sqlite://", lambda sql, *args, **kwargs: statements.append(str(sql.compile(engine))))
+    models.Base.metadata.create_all(engine, checkfirst=False)
+    return hashlib.sha1("".join(statements).encode("utf-8")).hexdigest()[:8]
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--dataset-size",
+        action="append",
+        choices=list(dataset.SIZES),
+        help="dataset size to run the benchmarks at, can be repeated (default: 10k)",
+    )
+    parser.addoption("--dataset-seed", type=int, default=0, help="random seed of the datasets (default: 0)")
+
+
+def pytest_generate_tests(metafunc):
+    if "size" in metafunc.fixturenames:
+        metafunc.parametrize("size", metafunc.config.getoption("dataset_size") or ["10k"], scope="session")
+
+
+@pytest.fixture(scope="session")
+def data(request, size):
+    """Synthetic dataset of the given size"""
+
+    return dataset.generate(dataset.SIZES[size], request.config.getoption("dataset_seed"))
+
+
+@pytest.fixture(scope="session")
+def template_path(request, size, data):
+    """Path to a SQLite database with the dataset loaded, cached across sessions"""
+
+    seed = request.config.getoption("dataset_seed")
+    path = request.config.cache.mkdir("datasets") / f"v{DATASET_VERSION}-{schema_digest()}-{size}-{seed}.sqlite"
+    if not path.exists():
+        partial_path = path.with_suffix(".partial")
+        engine = create_engine(f"sqlite:///{partial_path}")
+        dataset.load(engine, data)
+        engine.dispose()
+        partial_path.rename(path)
+    return path
+
+
+@pytest.fixture(scope="session")
+def engine(tmp_path_factory, size, template_path):
+    """Engine connected to a copy of the dataset database shared by the benchmarks of a session"""
+
+    path = tmp_path_factory.mktemp(f"dataset-{size}") / "bench.sqlite"
+    shutil.copyfile(template_path, path)
+    engine = create_engine(f"sqlite:///{path}")
+    yield engine
+    engine.dispose()
@@ -0,0 +1,147 @@
+"""Deterministic synthetic datasets of virtual domains, users and aliases
+
+Datasets follow the shape of real mail hosting databases:
+
+* about 1% of the rows are domains, their sizes follow a Zipf distribution, so that a few
+  domains hold most of the mailboxes while most domains hold only a handful
+* about 60% of the rows are users spread over the domains accordingly
+* the remaining rows are aliases: ``postmaster@`` and ``abuse@`` for every domain, catch-all
+  aliases for some domains, group aliases with several destinations and forwardings of single
+  users to external addresses
+
+The same size and seed always produce the same dataset.
+"""
+
+import itertools
+import random
+
+from sqlalchemy import insert, select
+
+from postfix_sql_ucli import models, operations, utils
+
+# total number of rows of the dataset sizes used by the benchmark suites
+SIZES = {"10k": 10_000, "100k": 100_000, "1M": 1_000_000}
+
+FIRST_NAMES = ["anna", "ben", "chris", "dana", "emil", "fiona", "george", "hanna", "ivan", "julia", "karl", "lena"]
+LAST_NAMES = ["smith", "mueller", "garcia", "rossi", "novak", "kim", "silva", "jansen", "dubois", "nowak"]
+TLDS = ["com", "org", "net", "de", "io", "eu"]
+
+
+class Dataset:
+    """Domains, users and aliases of a synthetic dataset
+
+    :param domains: list of domain names
+    :type domains: list
+    :param users: list of user email addresses
+    :type users: list
+    :param aliases: list of (source, destination) tuples
+    :type aliases: list"""
+
+    def __init__(self, domains, users, aliases):
+        self.domains = domains
+        self.users = users
+        self.aliases = aliases
+
+    def __len__(self):
+        return len(self.domains) + len(self.users) + len(self.aliases)
+
+    def __repr__(self):
+        return f"Dataset(domains={len(self.domains)}, users={len(self.users)}, aliases={len(self.aliases)})"
+
+
+def generate(size, seed=0):
+    """Generate a dataset with about `size` rows in total
+
+    :param size: total number of domains, users and aliases
+    :type size: int
+    :param seed: random seed
+    :type seed: int
+    :returns: generated dataset
+    :rtype: Dataset"""
+
+    rng = random.Random(seed)
+
+    domain_count = max(1, size // 100)
+    domains = [f"{rng.choice(LAST_NAMES)}-{n}.{rng.choice(TLDS)}" for n in range(domain_count)]
+
+    # Zipf distributed domain sizes, cumulative weights make the choices O(log n)
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** 1.1 for rank in range(domain_count)))
+    users = [
+        f"{rng.choice(FIRST_NAMES)}.{rng.choice(LAST_NAMES)}{n}@{domain}"
+        for n, domain in enumerate(rng.choices(domains, cum_weights=cum_weights, k=size * 60 // 100))
+    ]
+
+    users_by_domain = {}
+    for user in users:
+        users_by_domain.setdefault(user.split('@', 1)[1], []).append(user)
+
+    aliases = []
+    alias_count = max(0, size - domain_count - len(users))
+    for domain in domains:
+        members = users_by_domain.get(domain)
+        if not members:
+            continue
+        aliases.append((f"postmaster@{domain}", members[0]))
+        aliases.append((f"abuse@{domain}", members[0]))
+        if rng.random() < 0.1:
+            aliases.append((f"@{domain}", members[-1]))
+
+    forwarded = set()
+    n = 0
+    while len(aliases) < alias_count and users:
+        n += 1
+        user = rng.choice(users)
+        domain = user.split('@', 1)[1]
+        if rng.random() < 0.3:
+            # group alias delivering to several users of the same domain
+            members = users_by_domain[domain]
+            for member in rng.sample(members, min(len(members), rng.randint(2, 8))):
+                aliases.append((f"team{n}@{domain}", member))
+        elif user not in forwarded:
+            forwarded.add(user)
+            aliases.append((user, f"{user.split('@', 1)[0]}@forward.example"))
+    del aliases[alias_count:]
+
+    return Dataset(domains, users, aliases)
+
+
+def load(engine, dataset, chunk_size=10000):
+    """Recreate all tables and load a dataset into the database
+
+    Every user is stored with the same password hash, hashing a password per user
+    would dominate the loading time.
+
+    :param engine: SQLAlchemy Engine object
+    :type engine: object
+    :param dataset: dataset to load
+    :type dataset: Dataset
+    :param chunk_size: number of rows per INSERT statement
+    :type chunk_size: int"""
+
+    operations.reset_database(engine)
+
+    def insert_chunks(connection, model, rows):
+        for start in range(0, len(rows), chunk_size):
+            connection.execute(insert(model), rows[start : start + chunk_size])
+
+    with engine.begin() as connection:
+        insert_chunks(connection, models.VirtualDomain, [{"name": name} for name in dataset.domains])
+        domain_ids = dict(connection.execute(select(models.VirtualDomain.name, models.VirtualDomain.id)).all())
+
+        password = utils.doveadm_pw_hash("password")
+        insert_chunks(
+            connection,
+            models.VirtualUser,
+            [
+                {"domain_id": domain_ids[email.split('@', 1)[1]], "email": email, "password": password}
+                for email in dataset.users
+            ],
+        )
+        insert_chunks(
+            connection,
+            models.VirtualAlias,
+            [
+                {"domain_id": domain_ids[source.split('@', 1)[1]], "source": source, "destination": destination}
+                for source, destination in dataset.aliases
+            ],
+        )
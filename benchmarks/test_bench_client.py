@@ -0,0 +1,33 @@
+"""Benchmarks of :class:`postfix_sql_ucli.client.PostfixSQLClient` against the functions it wraps"""
+
+import itertools
+
+import pytest
+
+from postfix_sql_ucli import operations
+from postfix_sql_ucli.client import PostfixSQLClient
+
+counter = itertools.count()
+
+
+pytestmark = pytest.mark.usefixtures("_constant_password_hash")
+
+
+@pytest.fixture
+def client(engine):
+    with PostfixSQLClient(engine) as client:
+        yield client
+
+
+@pytest.mark.parametrize("api", ["operations", "client"])
+def test_add_users(benchmark, engine, client, data, api):
+    # many users of the same domain, the client resolves the domain once
+    domain = data.domains[0]
+    add_user = client.add_user if api == "client" else lambda *args: operations.add_user(engine, *args)
+
+    def add_users():
+        prefix = f"{api}{next(counter)}-"
+        for n in range(50):
+            add_user(f"{prefix}{n}@{domain}", "password")
+
+    benchmark.pedantic(add_users, rounds=20)
@@ -0,0 +1,248 @@
+"""Benchmarks of the public functions of :mod:`postfix_sql_ucli.operations` at several dataset sizes
+
+Every benchmark works on the dataset shared by all benchmarks of the same size, operations adding
+entries use new unique keys and operations deleting entries remove entries added outside of the
+measured code. Password hashing is replaced by a constant, so that the database access is measured.
+
+Record the baseline and compare later runs against it, a benchmark slower by more than 25% fails::
+
+    tox -e bench -- --dataset-size 10k --dataset-size 100k --benchmark-save=baseline
+    tox -e bench -- --dataset-size 10k --dataset-size 100k --benchmark-compare --benchmark-compare-fail=median:25%
+
+Without arguments the benchmarks run at 10k rows and the run is saved to ``.benchmarks/``, so that
+the first run records a baseline for ``--benchmark-compare``. Saved runs are not checked in.
+"""
+
+import itertools
+import random
+import shutil
+
+import pytest
+from sqlalchemy import create_engine
+
+from postfix_sql_ucli import operations
+
+# public functions of the operations module covered by the benchmarks below
+BENCHMARKED = {
+    "reset_database",
+    "add_domain",
+    "search_domains",
+    "iter_domains",
+    "delete_domain",
+    "add_user",
+    "search_users",
+    "iter_users",
+    "delete_user",
+    "iter_delete_users",
+    "add_alias",
+    "search_aliases",
+    "iter_aliases",
+    "reverse_aliases",
+    "iter_reverse_aliases",
+    "delete_aliases",
+    "iter_delete_aliases",
+    "stats",
+    "iter_stats",
+    "export_maps",
+    "import_entries",
+    "plan_sync",
+    "sync",
+}
+
+ROUNDS = 200
+
+pytestmark = pytest.mark.usefixtures("_constant_password_hash")
+
+counter = itertools.count()
+
+
+def unique(template):
+    return template.format(next(counter))
+
+
+@pytest.fixture
+def rng():
+    return random.Random(0)
+
+
+def test_every_operation_benchmarked(public_functions):
+    assert set(public_functions(operations)) == BENCHMARKED
+
+
+def test_reset_database(benchmark, template_path, tmp_path):
+    def setup():
+        path = tmp_path / f"reset-{next(counter)}.sqlite"
+        shutil.copyfile(template_path, path)
+        return (create_engine(f"sqlite:///{path}"),), {}
+
+    benchmark.pedantic(operations.reset_database, setup=setup, rounds=3)
+
+
+def test_add_domain(benchmark, engine):
+    benchmark.pedantic(lambda: operations.add_domain(engine, unique("bench-{}.example")), rounds=ROUNDS)
+
+
+def test_search_domains(benchmark, engine, data, rng):
+    benchmark(lambda: operations.search_domains(engine, rng.choice(data.domains)))
+
+
+def test_iter_domains(benchmark, engine, data, rng):
+    benchmark(lambda: list(operations.iter_domains(engine, rng.choice(data.domains))))
+
+
+def test_delete_domain(benchmark, engine, data, rng):
+    def setup():
+        domain = unique("delete-{}.example")
+        operations.add_domain(engine, domain)
+        for n in range(20):
+            operations.add_user(engine, f"user{n}@{domain}", "password")
+            operations.add_alias(engine, f"alias{n}@{domain}", rng.choice(data.users))
+        return (engine, domain), {"chunk_size": 10}
+
+    benchmark.pedantic(lambda *args, **kwargs: list(operations.delete_domain(*args, **kwargs)), setup=setup, rounds=10)
+
+
+def test_add_user(benchmark, engine, data, rng):
+    benchmark.pedantic(
+        lambda: operations.add_user(engine, unique("bench{}@") + rng.choice(data.domains), "password"), rounds=ROUNDS
+    )
+
+
+def test_search_users(benchmark, engine, data, rng):
+    benchmark(lambda: operations.search_users(engine, rng.choice(data.users)))
+
+
+def test_search_users_page(benchmark, engine, data, rng):
+    # a page far into the table must cost the same as the first page
+    benchmark(lambda: operations.search_users(engine, "", limit=50, after=rng.choice(data.users)))
+
+
+def test_iter_users(benchmark, engine, data, rng):
+    benchmark(lambda: list(operations.iter_users(engine, rng.choice(data.users))))
+
+
+def test_delete_user(benchmark, engine, data, rng):
+    def setup():
+        email = unique("delete{}@") + rng.choice(data.domains)
+        operations.add_user(engine, email, "password")
+        return (engine, email), {}
+
+    benchmark.pedantic(operations.delete_user, setup=setup, rounds=ROUNDS)
+
+
+def test_iter_delete_users(benchmark, engine, data, rng):
+    def setup():
+        prefix = unique("delete{}-")
+        domain = rng.choice(data.domains)
+        for n in range(20):
+            operations.add_user(engine, f"{prefix}{n}@{domain}", "password")
+        return (engine, prefix), {"prefix": True, "chunk_size": 5}
+
+    benchmark.pedantic(
+        lambda *args, **kwargs: list(operations.iter_delete_users(*args, **kwargs)), setup=setup, rounds=20
+    )
+
+
+def test_add_alias(benchmark, engine, data, rng):
+    benchmark.pedantic(
+        lambda: operations.add_alias(engine, unique("alias{}@") + rng.choice(data.domains), rng.choice(data.users)),
+        rounds=ROUNDS,
+    )
+
+
+def test_search_aliases(benchmark, engine, data, rng):
+    benchmark(lambda: operations.search_aliases(engine, *rng.choice(data.aliases), exact=True))
+
+
+def test_iter_aliases(benchmark, engine, data, rng):
+    benchmark(lambda: list(operations.iter_aliases(engine, rng.choice(data.aliases)[0], "")))
+
+
+def test_reverse_aliases(benchmark, engine, data, rng):
+    benchmark(lambda: operations.reverse_aliases(engine, rng.choice(data.aliases)[1]))
+
+
+def test_iter_reverse_aliases(benchmark, engine, data, rng):
+    benchmark(lambda: list(operations.iter_reverse_aliases(engine, rng.choice(data.aliases)[1])))
+
+
+def test_delete_aliases(benchmark, engine, data, rng):
+    def setup():
+        source = unique("delete{}@") + rng.choice(data.domains)
+        operations.add_alias(engine, source, rng.choice(data.users))
+        return (engine, source, ""), {}
+
+    benchmark.pedantic(operations.delete_aliases, setup=setup, rounds=ROUNDS)
+
+
+def test_iter_delete_aliases(benchmark, engine, data, rng):
+    def setup():
+        source = unique("delete{}@") + rng.choice(data.domains)
+        for destination in rng.sample(data.users, 20):
+            operations.add_alias(engine, source, destination)
+        return (engine, source, ""), {"chunk_size": 5}
+
+    benchmark.pedantic(
+        lambda *args, **kwargs: list(operations.iter_delete_aliases(*args, **kwargs)), setup=setup, rounds=20
+    )
+
+
+def test_stats(benchmark, engine, data, rng):
+    benchmark(lambda: operations.stats(engine, rng.choice(data.domains)))
+
+
+def test_iter_stats(benchmark, engine):
+    benchmark.pedantic(lambda: list(operations.iter_stats(engine)), rounds=10)
+
+
+def test_import_entries(benchmark, engine, data, rng):
+    def setup():
+        domain = unique("import-{}.example")
+        entries = [(1, {"type": "domain", "name": domain})]
+        entries += [(n, {"type": "user", "email": f"user{n}@{domain}", "password": "password"}) for n in range(2, 52)]
+        entries.append((52, {"type": "alias", "source": f"@{domain}", "destination": rng.choice(data.users)}))
+        return (engine, entries), {"batch_size": 100}
+
+    benchmark.pedantic(lambda *args, **kwargs: list(operations.import_entries(*args, **kwargs)), setup=setup, rounds=20)
+
+
+def test_export_maps(benchmark, engine, tmp_path):
+    benchmark.pedantic(operations.export_maps, args=(engine, str(tmp_path)), rounds=3)
+
+
+@pytest.fixture
+def sync_engine(template_path, tmp_path):
+    # sync deletes all entries missing from the desired state, work on a private copy of the dataset
+    path = tmp_path / "sync.sqlite"
+    shutil.copyfile(template_path, path)
+    engine = create_engine(f"sqlite:///{path}")
+    yield engine
+    engine.dispose()
+
+
+def desired_state(data, domain=None):
+    """Desired state of the whole dataset, optionally with a new domain of 20 users"""
+
+    state = {
+        "domains": list(data.domains),
+        "users": [{"email": email, "password": "password"} for email in data.users],
+        "aliases": [{"source": source, "destination": destination} for source, destination in data.aliases],
+    }
+    if domain:
+        state["domains"].append(domain)
+        state["users"] += [{"email": f"user{n}@{domain}", "password": "password"} for n in range(20)]
+    return state
+
+
+def test_plan_sync(benchmark, sync_engine, data):
+    # the database is in the desired state, this measures streaming and comparing all entries
+    state = desired_state(data)
+    benchmark.pedantic(operations.plan_sync, args=(sync_engine, state), rounds=5)
+
+
+def test_sync(benchmark, sync_engine, data):
+    def setup():
+        # every round adds a new domain and deletes the domain added by the previous round
+        return (sync_engine, operations.plan_sync(sync_engine, desired_state(data, unique("sync-{}.example")))), {}
+
+    benchmark.pedantic(operations.sync, setup=setup, rounds=10)
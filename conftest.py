@@ -0,0 +1,29 @@
+"""Fixtures shared by the tests and the benchmarks"""
+
+import inspect
+
+import pytest
+
+from postfix_sql_ucli import utils
+
+
+@pytest.fixture
+def _constant_password_hash(monkeypatch):
+    """Replace password hashing with a constant SHA512-CRYPT hash, so that it does not dominate the timings"""
+
+    monkeypatch.setattr(utils, "doveadm_pw_hash", lambda password, salt=None: "$6$salt$hash")
+
+
+@pytest.fixture(scope="session")
+def public_functions():
+    """Function returning a dictionary of the public functions defined in a module by their names,
+    used to check that every operation is covered by a test suite"""
+
+    def public_functions(module):
+        return {
+            name: function
+            for name, function in inspect.getmembers(module, inspect.isfunction)
+            if function.__module__ == module.__name__ and not name.startswith("_")
+        }
+
+    return public_functions
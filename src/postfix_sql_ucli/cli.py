@@ -1,11 +1,93 @@
 #!/usr/bin/env python3
 
+import csv
+import functools
+import os
+import shlex
 import sys
+import time
 
 import click
-from sqlalchemy import create_engine
 
-from . import __version__, operations, utils
+from . import __version__, profiling, replicas, retry, server, utils
+
+OPERATIONS = [
+    "reset",
+    "add-domain",
+    "search-domains",
+    "delete-domain",
+    "add-user",
+    "search-users",
+    "delete-user",
+    "add-alias",
+    "search-aliases",
+    "reverse-aliases",
+    "delete-aliases",
+    "stats",
+    "import",
+    "export",
+    "sync",
+    "batch",
+    "serve",
+]
+
+# Unix socket the daemon listens on unless --socket option is given
+DEFAULT_SOCKET = 'postfix-sql-ucli.sock'
+
+# operations forwarded to a running daemon
+REMOTE_OPERATIONS = [
+    "reset",
+    "add-domain",
+    "search-domains",
+    "add-user",
+    "search-users",
+    "delete-user",
+    "add-alias",
+    "search-aliases",
+    "reverse-aliases",
+    "delete-aliases",
+    "stats",
+]
+
+
+def create_engine(*args, **kwargs):
+    # SQLAlchemy is only imported once a database connection is needed
+    from sqlalchemy import create_engine
+
+    return create_engine(*args, **kwargs)
+
+
+class EngineOperations:
+    """Functions of :mod:`postfix_sql_ucli.operations` module bound to an engine
+
+    The operations module and the database engine are only loaded on first use, so that
+    invocations failing argument validation do not pay for importing SQLAlchemy and passlib.
+    Read-only operations are bound to a read replica selected by the router, if it has any.
+
+    :param engine: SQLAlchemy Engine or Connection object
+    :type engine: object
+    :param connect: function creating the :class:`postfix_sql_ucli.replicas.ReplicaRouter`
+                    on first use if `engine` is not set
+    :type connect: callable"""
+
+    def __init__(self, engine=None, connect=None):
+        self._router = None if engine is None else replicas.ReplicaRouter(engine)
+        self._connect = connect
+
+    @property
+    def router(self):
+        if self._router is None:
+            self._router = self._connect()
+        return self._router
+
+    @property
+    def engine(self):
+        return self.router.primary
+
+    def __getattr__(self, name):
+        from . import operations
+
+        return functools.partial(getattr(operations, name), self.router.engine(name))
 
 
 def print_version(ctx, param, value):
@@ -15,7 +97,7 @@ def print_version(ctx, param, value):
     ctx.exit(0)
 
 
-def do_reset(engine, arguments, force):
+def do_reset(ops, arguments, force):
     if len(arguments):
         click.echo("reset operation expects no arguments")
         sys.exit(1)
@@ -25,10 +107,10 @@ def do_reset(engine, arguments, force):
             print("Reset operation aborted.")
             return
     click.echo("Reset Postfix SQL database")
-    operations.reset_database(engine)
+    ops.reset_database()
 
 
-def add_del_domain(engine, operation, arguments):
+def add_del_domain(ops, operation, arguments, batch_size=1000, pause=0):
     if len(arguments) != 1:
         click.echo(f"{operation} operation requires exactly one argument: domain name")
         sys.exit(1)
@@ -38,17 +120,39 @@ def add_del_domain(engine, operation, arguments):
         sys.exit(1)
     if operation == "add-domain":
         click.echo(f"Adding virtual domain: {domain_name}")
-        domains, added = operations.add_domain(engine, domain_name)
+        domains, added = ops.add_domain(domain_name)
         if added:
             click.echo(f"Created new virtual domain: {domains}")
         else:
             click.echo(f"Aborted, found exisitng virtual domain(s): {domains}")
     else:
-        # delete_domain(engine, domain_name)
-        click.echo("delete_domain operation is not implemented")
+        click.echo(f"Deleting virtual domain: {domain_name}")
+        deleted = {"users": 0, "aliases": 0, "domains": 0}
+        for progress in ops.delete_domain(domain_name, batch_size, pause):
+            for key, count in progress.items():
+                deleted[key] += count
+            if not progress["domains"]:
+                click.echo(f"Deleted {deleted['aliases']} virtual alias(es) and {deleted['users']} virtual user(s)")
+        if deleted["domains"]:
+            click.echo(
+                f"Deleted virtual domain {domain_name} with {deleted['users']} virtual user(s) "
+                f"and {deleted['aliases']} virtual alias(es)"
+            )
+        else:
+            click.echo("No virtual domains deleted")
+
+
+def given_options(options, *names):
+    # only pass the options that were set, keeping calls compatible with daemons not supporting them
+    return {name: options[name] for name in names if options[name] is not None}
+
+
+def print_next_page(results, search_options, key):
+    if search_options.get("limit") == len(results):
+        click.echo(f"More entries may follow, continue with: --after '{key(results[-1])}'")
 
 
-def search_domains(engine, arguments):
+def search_domains(ops, arguments, output_format, **search_options):
     if len(arguments) > 1:
         click.echo("search-domains operation expects at most one argument: domain name pattern")
         sys.exit(1)
@@ -56,50 +160,72 @@ def search_domains(engine, arguments):
         (domain_name_pattern,) = arguments
     else:
         domain_name_pattern = ''
+    if output_format:
+        utils.write_entries(ops.iter_domains(domain_name_pattern, **search_options), output_format, sys.stdout)
+        return
     click.echo(f"Searching virtual domain names for {domain_name_pattern}")
-    results = operations.search_domains(engine, domain_name_pattern)
+    results = ops.search_domains(domain_name_pattern, **search_options)
     if len(results):
         click.echo("Found virtual domain(s): " + ', '.join([str(x) for x in results]))
+        print_next_page(results, search_options, lambda entry: entry["name"])
     else:
         click.echo("No virtual domains found")
 
 
-def add_del_user(engine, operation, arguments):
+def add_user(ops, arguments, user_password=None):
     if len(arguments) != 1:
-        click.echo(f"{operation} operation requires exactly one argument: user email")
+        click.echo("add-user operation requires exactly one argument: user email")
         sys.exit(1)
     (user_email,) = arguments
     if not utils.is_valid_email(user_email):
-        click.echo(f"{operation} operation failed: invalid email address '{user_email}'")
+        click.echo(f"add-user operation failed: invalid email address '{user_email}'")
         sys.exit(1)
-    if operation == "add-user":
-        # get user password
-        if sys.stdin.isatty():
-            # interactive shell, prompt user for a password
-            user_password = utils.get_password()
-        else:
-            # read password from stdin
-            user_password = sys.stdin.readline()
-        click.echo(f"Adding virtual user: {user_email}")
-        users, added = operations.add_user(engine, user_email, user_password)
-        if users is None:
-            _, email_domain = user_email.split('@', 1)
-            click.echo(f"add-user operation failed: domain {email_domain} can not be used")
-            sys.exit(1)
-        if added:
-            click.echo(f"Created new virtual user: {users}")
-        else:
-            click.echo(f"Aborted, found exisitng virtual user(s): {users}")
+    # get user password
+    if user_password is not None:
+        pass
+    elif sys.stdin.isatty():
+        # interactive shell, prompt user for a password
+        user_password = utils.get_password()
+    else:
+        # read password from stdin
+        user_password = sys.stdin.readline()
+    click.echo(f"Adding virtual user: {user_email}")
+    users, added = ops.add_user(user_email, user_password)
+    if users is None:
+        _, email_domain = user_email.split('@', 1)
+        click.echo(f"add-user operation failed: domain {email_domain} can not be used")
+        sys.exit(1)
+    if added:
+        click.echo(f"Created new virtual user: {users}")
+    else:
+        click.echo(f"Aborted, found exisitng virtual user(s): {users}")
+
+
+def delete_users(ops, arguments, output_format, prefix, count_only, **delete_options):
+    if len(arguments) != 1:
+        click.echo("delete-user operation requires exactly one argument: user email" + (" prefix" if prefix else ""))
+        sys.exit(1)
+    (user_email,) = arguments
+    if prefix:
+        delete_options["prefix"] = True
+    elif not utils.is_valid_email(user_email):
+        click.echo(f"delete-user operation failed: invalid email address '{user_email}'")
+        sys.exit(1)
+    if count_only:
+        count = ops.delete_user(user_email, count_only=True, **delete_options)
+        click.echo(f"Deleted {count} virtual user account(s)")
+    elif output_format:
+        utils.write_entries(ops.iter_delete_users(user_email, **delete_options), output_format, sys.stdout)
     else:
-        click.echo(f"Deleting virtual user account: {user_email}")
-        results = operations.delete_user(engine, user_email)
+        click.echo(f"Deleting virtual user account{'s starting with' if prefix else ''}: {user_email}")
+        results = ops.delete_user(user_email, **delete_options)
         if len(results):
             click.echo("Deleted virtual user account(s): " + ', '.join([str(x) for x in results]))
         else:
             click.echo("No virtual user accounts deleted")
 
 
-def search_users(engine, arguments):
+def search_users(ops, arguments, output_format, **search_options):
     if len(arguments) > 1:
         click.echo("search-users operation expects at most one argument: user email pattern")
         sys.exit(1)
@@ -107,15 +233,22 @@ def search_users(engine, arguments):
         (user_email_pattern,) = arguments
     else:
         user_email_pattern = ''
-    click.echo(f"Searching virtual user accounts for {user_email_pattern}")
-    results = operations.search_users(engine, user_email_pattern)
+    if output_format:
+        utils.write_entries(ops.iter_users(user_email_pattern, **search_options), output_format, sys.stdout)
+        return
+    domain_name = search_options.get("domain_name")
+    click.echo(
+        f"Searching virtual user accounts for {user_email_pattern}" + (f" in {domain_name}" if domain_name else "")
+    )
+    results = ops.search_users(user_email_pattern, **search_options)
     if len(results):
         click.echo("Found virtual user account(s): " + ', '.join([str(x) for x in results]))
+        print_next_page(results, search_options, lambda entry: entry["email"])
     else:
         click.echo("No virtual user accounts found")
 
 
-def add_alias(engine, arguments):
+def add_alias(ops, arguments):
     if len(arguments) != 2:
         click.echo("add-alias operation requires exactly two arguments: source and destination email addresses")
         sys.exit(1)
@@ -126,7 +259,7 @@ def add_alias(engine, arguments):
 
     click.echo(f"Adding virtual alias: {source} -> {destination}")
 
-    aliases, added = operations.add_alias(engine, source, destination)
+    aliases, added = ops.add_alias(source, destination)
     if aliases is None:
         _, email_domain = source.split('@', 1)
         click.echo(f"add-alias operation failed: domain {email_domain} can not be used")
@@ -137,53 +270,343 @@ def add_alias(engine, arguments):
         click.echo(f"Aborted, found exisitng virtual alias(es): {aliases}")
 
 
-def del_search_aliases(engine, operation, arguments):
+def alias_patterns(operation, arguments):
     if len(arguments) > 2:
         click.echo(f"{operation} operation expects at most two arguments: source and destination email patterns")
         sys.exit(1)
     elif len(arguments) == 1:
-        source_email_pattern, destination_email_pattern = *arguments, ''
+        return arguments[0], ''
     elif len(arguments) == 2:
-        source_email_pattern, destination_email_pattern = arguments
+        return tuple(arguments)
+    return '', ''
+
+
+def delete_aliases(ops, arguments, output_format, count_only, **delete_options):
+    source_email_pattern, destination_email_pattern = alias_patterns("delete-aliases", arguments)
+    if count_only:
+        count = ops.delete_aliases(source_email_pattern, destination_email_pattern, count_only=True, **delete_options)
+        click.echo(f"Deleted {count} virtual alias(es)")
+    elif output_format:
+        utils.write_entries(
+            ops.iter_delete_aliases(source_email_pattern, destination_email_pattern, **delete_options),
+            output_format,
+            sys.stdout,
+        )
     else:
-        source_email_pattern, destination_email_pattern = '', ''
-
-    if operation == "delete-aliases":
         click.echo(f"Deleting virtual alias(es): {source_email_pattern} -> {destination_email_pattern}")
-        results = operations.delete_aliases(engine, source_email_pattern, destination_email_pattern)
+        results = ops.delete_aliases(source_email_pattern, destination_email_pattern, **delete_options)
         if len(results):
             click.echo("Deleted virtual alias(es): " + ', '.join([str(x) for x in results]))
         else:
             click.echo("No virtual aliases deleted")
+
+
+def search_aliases(ops, arguments, output_format, **search_options):
+    source_email_pattern, destination_email_pattern = alias_patterns("search-aliases", arguments)
+    if "after" in search_options and ',' in search_options["after"]:
+        # aliases are sorted by source and destination, continue after both of them
+        search_options["after"] = search_options["after"].split(',', 1)
+
+    if output_format:
+        utils.write_entries(
+            ops.iter_aliases(source_email_pattern, destination_email_pattern, **search_options),
+            output_format,
+            sys.stdout,
+        )
     else:
-        click.echo(f"Searching virtual aliases for {source_email_pattern} -> {destination_email_pattern}")
-        results = operations.search_aliases(engine, source_email_pattern, destination_email_pattern)
+        domain_name = search_options.get("domain_name")
+        click.echo(
+            f"Searching virtual aliases for {source_email_pattern} -> {destination_email_pattern}"
+            + (f" in {domain_name}" if domain_name else "")
+        )
+        results = ops.search_aliases(source_email_pattern, destination_email_pattern, **search_options)
         if len(results):
             click.echo("Found virtual alias(es): " + ', '.join([str(x) for x in results]))
+            print_next_page(results, search_options, lambda entry: f"{entry['source']},{entry['destination']}")
         else:
             click.echo("No virtual aliases found")
 
 
+def reverse_aliases(ops, arguments, output_format):
+    if len(arguments) != 1:
+        click.echo("reverse-aliases operation requires exactly one argument: destination email")
+        sys.exit(1)
+    (destination_email,) = arguments
+    if output_format:
+        utils.write_entries(ops.iter_reverse_aliases(destination_email), output_format, sys.stdout)
+        return
+    click.echo(f"Searching virtual aliases forwarding to {destination_email}")
+    results = ops.reverse_aliases(destination_email)
+    if len(results):
+        click.echo("Found virtual alias(es): " + ', '.join([x["source"] for x in results]))
+    else:
+        click.echo("No virtual aliases found")
+
+
+def stats(ops, arguments, output_format):
+    if len(arguments) > 1:
+        click.echo("stats operation expects at most one argument: domain name pattern")
+        sys.exit(1)
+    elif len(arguments) == 1:
+        (domain_name_pattern,) = arguments
+    else:
+        domain_name_pattern = ''
+    entries = ops.iter_stats(domain_name_pattern)
+    if not output_format:
+        # human-readable table with a labelled totals row
+        output_format = "table"
+        entries = (dict(entry, domain="(total)") if entry["domain"] is None else entry for entry in entries)
+    utils.write_entries(entries, output_format, sys.stdout)
+
+
+def import_entries(ops, arguments, input_format, batch_size, workers):
+    if len(arguments) != 1:
+        click.echo("import operation requires exactly one argument: input file path or '-' for standard input")
+        sys.exit(1)
+    (input_path,) = arguments
+
+    click.echo(f"Importing virtual domains, users and aliases from {input_path}")
+    processed, added, skipped, failed = 0, 0, 0, 0
+    start = time.perf_counter()
+    try:
+        entries = utils.read_entries(input_path, input_format)
+        for result in ops.import_entries(entries, batch_size, workers):
+            for line_number, message in result["errors"]:
+                click.echo(f"Line {line_number}: {message}")
+            processed += result["processed"]
+            added += result["added"]
+            skipped += result["skipped"]
+            failed += len(result["errors"])
+    except (OSError, ValueError, csv.Error) as e:
+        click.echo(f"import operation failed: {str(e)}")
+        sys.exit(1)
+    elapsed = time.perf_counter() - start
+
+    click.echo(
+        f"Processed {processed} entries in {elapsed:.2f}s ({processed / max(elapsed, 1e-9):.0f} rows/s): "
+        f"{added} added, {skipped} skipped, {failed} failed"
+    )
+    if failed:
+        sys.exit(1)
+
+
+def export_maps(ops, arguments):
+    if len(arguments) != 1:
+        click.echo("export operation requires exactly one argument: output directory path")
+        sys.exit(1)
+    (directory,) = arguments
+
+    click.echo(f"Exporting virtual domains, users and aliases to {directory}")
+    start = time.perf_counter()
+    try:
+        counts = ops.export_maps(directory)
+    except OSError as e:
+        click.echo(f"export operation failed: {str(e)}")
+        sys.exit(1)
+    elapsed = time.perf_counter() - start
+
+    for name, count in counts.items():
+        click.echo(f"Wrote {count} entries to {name}")
+    click.echo(f"Export completed in {elapsed:.2f}s")
+
+
+def sync(ops, arguments, batch_size, workers, dry_run):
+    if len(arguments) != 1:
+        click.echo("sync operation requires exactly one argument: desired state file path or '-' for standard input")
+        sys.exit(1)
+    (state_path,) = arguments
+
+    start = time.perf_counter()
+    try:
+        plan = ops.plan_sync(utils.load_state(state_path))
+    except (OSError, ValueError) as e:
+        click.echo(f"sync operation failed: {str(e)}")
+        sys.exit(1)
+
+    describe = {
+        "domain": lambda entry: entry["name"],
+        "user": lambda entry: entry["email"],
+        "alias": lambda entry: f"{entry['source']} -> {entry['destination']}",
+    }
+    counts = {}
+    for action, sign in [("delete", "-"), ("add", "+"), ("update", "~")]:
+        counts[action] = 0
+        for entry_type, entries in plan[action].items():
+            counts[action] += len(entries)
+            if dry_run:
+                for entry in entries:
+                    click.echo(f"{sign} {entry_type} {describe[entry_type](entry)}")
+    summary = f"{counts['add']} to add, {counts['update']} to update, {counts['delete']} to delete"
+
+    if dry_run:
+        click.echo(f"Plan: {summary}")
+        return
+    if not any(counts.values()):
+        click.echo("Database is in sync with the desired state, nothing to do")
+        return
+
+    click.echo(f"Synchronizing with {state_path}: {summary}")
+    result = ops.sync(plan, batch_size, workers)
+    for message in result["errors"]:
+        click.echo(message)
+    click.echo(
+        f"Sync completed in {time.perf_counter() - start:.2f}s: "
+        f"{result['added']} added, {result['updated']} updated, {result['deleted']} deleted"
+    )
+    if result["errors"]:
+        sys.exit(1)
+
+
+def dispatch(ops, operation, arguments, options, user_password=None):
+    if operation == "reset":
+        do_reset(ops, arguments, options["force"])
+    elif operation in ["add-domain", "delete-domain"]:
+        add_del_domain(ops, operation, arguments, options["batch_size"], options["pause"])
+    elif operation == "search-domains":
+        search_domains(ops, arguments, options["output_format"], **given_options(options, "limit", "after"))
+    elif operation == "add-user":
+        add_user(ops, arguments, user_password)
+    elif operation == "delete-user":
+        delete_users(
+            ops,
+            arguments,
+            options["output_format"],
+            options["prefix"],
+            options["count_only"],
+            chunk_size=options["batch_size"],
+            pause=options["pause"],
+        )
+    elif operation == "search-users":
+        search_users(
+            ops, arguments, options["output_format"], **given_options(options, "domain_name", "limit", "after")
+        )
+    elif operation == "add-alias":
+        add_alias(ops, arguments)
+    elif operation == "delete-aliases":
+        delete_aliases(
+            ops,
+            arguments,
+            options["output_format"],
+            options["count_only"],
+            chunk_size=options["batch_size"],
+            pause=options["pause"],
+        )
+    elif operation == "search-aliases":
+        search_aliases(
+            ops, arguments, options["output_format"], **given_options(options, "domain_name", "limit", "after")
+        )
+    elif operation == "stats":
+        stats(ops, arguments, options["output_format"])
+    elif operation == "reverse-aliases":
+        reverse_aliases(ops, arguments, options["output_format"])
+    elif operation == "import":
+        import_entries(ops, arguments, options["input_format"], options["batch_size"], options["workers"])
+    elif operation == "export":
+        export_maps(ops, arguments)
+    elif operation == "sync":
+        sync(ops, arguments, options["batch_size"], options["workers"], options["dry_run"])
+    else:
+        # if an operation is in click.Choice above but is not implemented here
+        click.echo("unexpected operation, this should never happen")
+        sys.exit(1)
+
+
+def run_batch(ops, arguments, options, commit_every):
+    if len(arguments) != 1:
+        click.echo("batch operation requires exactly one argument: script file path or '-' for standard input")
+        sys.exit(1)
+    (script_path,) = arguments
+
+    succeeded, failed, pending = 0, 0, 0
+    try:
+        with utils.open_input(script_path) as script, ops.engine.connect() as connection:
+            transaction = connection.begin()
+            for line_number, line in enumerate(script, 1):
+                try:
+                    operation, *arguments = shlex.split(line, comments=True) or [None]
+                except ValueError as e:
+                    click.echo(f"Line {line_number}: {str(e)}")
+                    failed += 1
+                    continue
+
+                if operation is None:
+                    continue
+
+                # add-user takes the password as the second argument in a batch
+                user_password = None
+                if operation == "add-user" and len(arguments) == 2:
+                    user_password = arguments.pop()
+
+                if operation not in OPERATIONS or operation in ("batch", "serve"):
+                    click.echo(f"Line {line_number}: unsupported operation '{operation}'")
+                    failed += 1
+                    continue
+                elif operation == "reset" and not options["force"]:
+                    click.echo(f"Line {line_number}: reset operation requires --force in a batch")
+                    failed += 1
+                    continue
+                elif operation == "add-user" and user_password is None:
+                    # the password would be read from standard input, which may be the script itself
+                    click.echo(f"Line {line_number}: add-user operation requires user email and password in a batch")
+                    failed += 1
+                    continue
+                elif operation in ("import", "sync") and script_path == '-' and '-' in arguments:
+                    # standard input holds the rest of the script
+                    click.echo(
+                        f"Line {line_number}: {operation} operation can not read standard input "
+                        "in a batch read from standard input"
+                    )
+                    failed += 1
+                    continue
+
+                # run every operation in a savepoint, so that a failure only undoes this operation
+                savepoint = connection.begin_nested()
+                try:
+                    dispatch(EngineOperations(connection), operation, arguments, options, user_password)
+                    savepoint.commit()
+                    succeeded += 1
+                    pending += 1
+                except (SystemExit, Exception) as e:
+                    savepoint.rollback()
+                    message = "" if isinstance(e, SystemExit) else f": {str(e)}"
+                    click.echo(f"Line {line_number}: {operation} operation failed{message}")
+                    failed += 1
+
+                if pending >= commit_every:
+                    transaction.commit()
+                    transaction = connection.begin()
+                    pending = 0
+
+            transaction.commit()
+    except (OSError, ValueError) as e:
+        click.echo(f"batch operation failed: {str(e)}")
+        sys.exit(1)
+
+    click.echo(f"Batch completed: {succeeded} operation(s) succeeded, {failed} failed")
+    if failed:
+        sys.exit(1)
+
+
+def run_server(ops, arguments, socket_path):
+    if len(arguments):
+        click.echo("serve operation expects no arguments")
+        sys.exit(1)
+    socket_path = socket_path or DEFAULT_SOCKET
+    click.echo(f"Serving Postfix SQL database operations on {socket_path}")
+    try:
+        server.serve(ops.engine, socket_path, lambda message: click.echo(message, err=True), ops.router.replicas)
+    except OSError as e:
+        click.echo(f"serve operation failed: {str(e)}")
+        sys.exit(1)
+
+
 @click.command()
 @click.argument(
     "operation",
-    type=click.Choice([
-        "reset",
-        "add-domain",
-        "search-domains",
-        "delete-domain",
-        "add-user",
-        "search-users",
-        "delete-user",
-        "add-alias",
-        "search-aliases",
-        "delete-aliases",
-    ]),
+    type=click.Choice(OPERATIONS),
 )
 @click.option("--force", is_flag=True, help="Force reset without confirmation")
-@click.option(
-    "--config", type=click.Path(exists=True), help="Path to configuration file", default='postfix-sql-ucli.yml'
-)
+@click.option("--config", type=click.Path(), help="Path to configuration file", default='postfix-sql-ucli.yml')
 @click.option(
     '--version',
     is_flag=True,
@@ -193,8 +616,100 @@ def del_search_aliases(engine, operation, arguments):
     is_eager=True,
 )
 @click.option("--verbose", is_flag=True, help="Verbose output")
+@click.option(
+    "--input-format",
+    type=click.Choice(["csv", "jsonl", "json"]),
+    help="Input file format for import operation (derived from file name by default)",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=500,
+    help="Number of entries written per transaction on import and sync or deleted per transaction on delete operations",
+)
+@click.option(
+    "--pause",
+    type=click.FloatRange(min=0),
+    default=0,
+    help="Seconds to wait between the transactions of delete operations",
+)
+@click.option("--prefix", is_flag=True, help="Delete all virtual users with emails starting with the given argument")
+@click.option("--count-only", is_flag=True, help="Only print the number of entries deleted by delete operations")
+@click.option(
+    "--workers",
+    type=click.IntRange(min=0),
+    default=1,
+    help="Number of worker processes for password hashing on import and sync (0 to use all CPUs)",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["json", "jsonl", "csv", "tsv", "table"]),
+    help="Write search results in a machine-readable format as they are fetched",
+)
+@click.option(
+    "--domain",
+    "domain_name",
+    help="Only search users or aliases (by source address) of the virtual domain with this name",
+)
+@click.option(
+    "--limit",
+    type=click.IntRange(min=1),
+    help="Maximum number of entries returned by search operations",
+)
+@click.option(
+    "--after",
+    help="Only return entries sorted after this key: domain name, user email or alias 'source[,destination]'",
+)
+@click.option("--dry-run", is_flag=True, help="Print the changes the sync operation would make without applying them")
+@click.option(
+    "--commit-every",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of operations committed together in a batch",
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False),
+    envvar='POSTFIX_SQL_UCLI_SOCKET',
+    help=f"Path to the daemon Unix socket ({DEFAULT_SOCKET} for serve operation by default), operations are"
+    " forwarded to the daemon if it is running, the daemon uses its own configuration",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Write a JSON report with wall time per phase, SQL statement count and time, fetched rows and peak memory"
+    " to standard error",
+)
+@click.option(
+    "--profile-output",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write cProfile statistics of the operation to this file (implies --profile)",
+)
 @click.argument("arguments", nargs=-1)
-def main(operation, force, config, verbose, arguments):
+def main(
+    operation,
+    force,
+    config,
+    verbose,
+    input_format,
+    batch_size,
+    pause,
+    prefix,
+    count_only,
+    workers,
+    output_format,
+    domain_name,
+    limit,
+    after,
+    dry_run,
+    commit_every,
+    socket_path,
+    profile,
+    profile_output,
+    arguments,
+):
     """Perform one of the following operations on Postfix SQL database:
 
     * `reset` operation: resets Postfix SQL database, i.e. drop and create following tables:
@@ -212,6 +727,7 @@ def main(operation, force, config, verbose, arguments):
        );
 
        CREATE UNIQUE INDEX name_idx ON virtual_domains (name);
+       CREATE INDEX name_pattern_idx ON virtual_domains (name text_pattern_ops);
 
        CREATE TABLE IF NOT EXISTS "virtual_users" (
                "id" SERIAL,
@@ -224,6 +740,8 @@ def main(operation, force, config, verbose, arguments):
 
 
        CREATE UNIQUE INDEX email_idx ON virtual_users (email);
+       CREATE INDEX ix_virtual_users_domain_id ON virtual_users (domain_id);
+       CREATE INDEX email_pattern_idx ON virtual_users (email text_pattern_ops);
 
        CREATE TABLE IF NOT EXISTS "virtual_aliases" (
                "id" SERIAL,
@@ -235,68 +753,148 @@ def main(operation, force, config, verbose, arguments):
        );
 
        CREATE INDEX source_idx ON virtual_aliases (source);
+       CREATE INDEX ix_virtual_aliases_domain_id ON virtual_aliases (domain_id);
+       CREATE UNIQUE INDEX source_destination_idx ON virtual_aliases (source, destination);
+       CREATE INDEX destination_source_idx ON virtual_aliases (destination, source);
+       CREATE INDEX source_pattern_idx ON virtual_aliases (source text_pattern_ops);
+       CREATE INDEX destination_pattern_idx ON virtual_aliases (destination text_pattern_ops);
+
+    The ``*_pattern_idx`` indexes serve prefix searches and are only created on PostgreSQL.
 
     * `add-domain` operation requires exactly one argument: domain name, adds a virtual domain entry to ``virtual_domains`` table and prints out the new entry to standard output.
 
+    * `delete-domain` operation requires exactly one argument: domain name, and deletes the virtual domain entry from ``virtual_domains`` table with all its virtual aliases and users. Aliases and users are deleted in chunks of ``--batch-size`` entries, every chunk is committed separately and followed by a pause of ``--pause`` seconds, so that Postfix lookups are not blocked for the duration of the whole deletion. Progress is printed after every chunk.
+
     * `search-domains` operation expects at most one argument: domain name pattern, and prints out virtual domains with names following the pattern (or all entries in case no pattern is provided) from ``virtual_domains`` table to standard output.
 
     * `add-user` operation requires exactly one argument: user email, adds a virtual user account entry to ``virtual_users`` table and prints out the new entry to standard output.
 
     * `search-users` operation expects at most one argument: user email pattern, prints out virtual users with emails following the pattern (or all entries in case no pattern is provided) from ``virtual_users`` table to standard output.
 
-    * `delete-user` operation requires exactly one argument: user email, and deletes a virtual user account entry with emails that matches exactly from ``virtual_users`` table and prints out ghe deleted virtual users entries to standard output.
+    * `delete-user` operation requires exactly one argument: user email, and deletes a virtual user account entry with emails that matches exactly (or all entries with emails starting with the argument if ``--prefix`` option is given) from ``virtual_users`` table and prints out ghe deleted virtual users entries to standard output.
 
     * `add-alias` operation requires exactly exactly two arguments: source and destination email addresses, adds a virtual alias entry to ``virtual_aliases`` table and prints out the new entry to standard output.
 
     * `search-aliases` operation expects at most two arguments: source and destination email patterns, prints out virtual aliases with emails following the pattern (or all entries in case no pattern is provided) from ``virtual_aliases`` table to standard output.
 
+    * `reverse-aliases` operation requires exactly one argument: destination email, and prints out the source addresses of virtual aliases forwarding to it from ``virtual_aliases`` table to standard output.
+
     * `delete-aliases` operation expects at most two arguments: source and destination email patterns, and deletes virtual alias entries with emails following the pattern (or all entries in case no pattern is provided) from ``virtual_aliases`` table and prints out the deleted virtual alias entries to standard output.
+
+    * `delete-user` and `delete-aliases` operations delete the entries in chunks of ``--batch-size`` entries ordered by their keys, every chunk is committed separately and followed by a pause of ``--pause`` seconds. With ``--format`` option the deleted entries are written in the given format after every chunk, with ``--count-only`` option the deleted entries are not returned by the database and only their number is printed.
+
+    * `stats` operation expects at most one argument: domain name pattern, and prints out the number of virtual users and aliases of every virtual domain with name following the pattern (or all domains in case no pattern is provided) followed by the totals, as a table or in the format given by ``--format`` option (the domain of the totals entry is null). The counts are computed by a single query using the indexes on ``domain_id`` columns.
+
+    * `import` operation requires exactly one argument: path to a CSV (with a header row), JSON Lines (``.jsonl``) or JSON (``.json``, an array of entries) file, optionally gzip-compressed, or '-' to read from standard input. Every entry has a ``type`` field (``domain``, ``user`` or ``alias``) and the fields ``name``, ``email`` and ``password`` or ``source`` and ``destination`` respectively. Entries are validated and written in batches of ``--batch-size`` entries per transaction, existing entries are skipped. Invalid entries are reported with their line numbers (their positions in the array for JSON files). User passwords are hashed in ``--workers`` processes in parallel with database writes.
+
+    * `export` operation requires exactly one argument: path to an existing output directory, and writes ``virtual_mailbox_domains``, ``virtual_mailbox_maps`` and ``virtual_alias_maps`` Postfix lookup table source files (aliases with the same source are joined into one line) and a Dovecot ``passwd`` file to it. Entries are streamed from the database, each file is replaced atomically once all files were written. Run ``postmap`` on the Postfix files to build the lookup tables, e.g. ``postmap lmdb:virtual_alias_maps``.
+
+    * `sync` operation requires exactly one argument: path to a YAML or JSON file with the desired state of ``domains``, ``users`` and ``aliases`` (or '-' for standard input), compares it with the entries streamed from the database and applies only the difference: missing entries are added, entries not in the desired state are deleted and passwords of users given with ``password_hash`` are updated if they differ. Changes are written in transactions of ``--batch-size`` entries, passwords of new users are hashed by ``--workers`` processes. With ``--dry-run`` option the planned changes are printed and nothing is written.
+
+    * `batch` operation requires exactly one argument: path to a script file or '-' to read from standard input. The script contains one operation with its arguments per line using the same syntax as on the command line (shell quoting rules apply, lines starting with ``#`` are ignored), `add-user` operation requires the user password as the second argument. `batch` and `serve` operations are not supported in a script, `import` and `sync` operations can not read standard input if the script is read from it. All operations are performed over a single database connection, each one in its own savepoint so that a failed operation does not undo the others. Operations are committed in groups of ``--commit-every`` operations. `reset` operation requires ``--force`` option.
+
+    * `serve` operation expects no arguments and starts a daemon accepting JSON Lines requests on the Unix socket given by ``--socket`` option. Each request is mapped onto a function in ``postfix_sql_ucli.operations`` module, requests from multiple clients are processed concurrently over a pool of database connections and every response reports the request processing time. The socket is ``postfix-sql-ucli.sock`` in the current directory unless ``--socket`` option is given. When ``--socket`` option (or ``POSTFIX_SQL_UCLI_SOCKET`` environment variable) is given and the daemon is running, `reset`, `add-*`, `search-*`, `reverse-aliases`, `stats`, `delete-user` and `delete-aliases` operations are forwarded to it and run on the database of the daemon configuration, ``--config`` option is ignored.
+
+    Patterns match entries starting with the given string, ``%`` and ``_`` characters in patterns match literally.
+
+    `search-users` and `search-aliases` operations accept ``--domain`` option to only search entries of the given virtual domain, aliases belong to the domain of their source address.
+
+    Search operations return entries sorted by domain name, user email or alias source and destination. ``--limit`` option limits the number of returned entries, ``--after`` option continues after the last entry of the previous page: ``--after`` value is the domain name, user email or alias source and destination joined by a comma. Every page is fetched with an index range scan, so later pages cost the same as the first one.
+
+    Search operations accept ``--format`` option to write the found entries in JSON, JSON Lines, CSV, TSV or table format without any other messages. The entries are streamed from the database and written out as they are fetched.
+
+    Transactions failing on a serialization failure, a deadlock or a lock timeout are retried with exponential backoff according to the ``retry`` section of the configuration file (5 attempts by default), the operation fails with an error message once all attempts failed. Operations of a `batch` are not retried, as they share the transaction of the batch.
+
+    Search, ``reverse-aliases``, ``stats`` and ``export`` operations run on the read replicas listed in the ``replicas`` section of the configuration file in round-robin order, a replica that can not be connected to is skipped and the primary database is used if none can. All other operations and the operations of a `batch` run on the primary database. Replicas may lag behind the primary database, so a search may not find an entry added right before.
+
+    With ``--profile`` option a JSON report is written to standard error when the operation finishes: the total wall time, the wall time of every phase (``import`` of the database modules, loading the ``config``, creating the ``engine``, ``connect``, ``query``, password ``hash`` and the rest of the ``operation``), the number and time of SQL statements, the number of fetched rows and the peak memory of the process. ``--profile-output`` option additionally writes cProfile statistics to the given file, e.g. for ``python -m pstats``.
     """  # noqa: E501, B950
 
-    # Load database configuration from YAML file
+    options = {
+        "force": force,
+        "input_format": input_format,
+        "batch_size": batch_size,
+        "pause": pause,
+        "prefix": prefix,
+        "count_only": count_only,
+        "workers": workers,
+        "output_format": output_format,
+        "domain_name": domain_name,
+        "limit": limit,
+        "after": after,
+        "dry_run": dry_run,
+    }
+
+    profiler = profiling.Profiler(profile, profile_output)
     try:
-        db_config = utils.load_database_config(config)
-    except Exception as e:
-        click.echo(f"Error opening configuration file '{config}': {str(e)}")
-        sys.exit(1)
+        with profiler:
+            run(profiler, operation, arguments, options, config, verbose, commit_every, socket_path)
+    finally:
+        if profiler.enabled:
+            click.echo(profiler.report_json(), err=True)
+
+
+def run(profiler, operation, arguments, options, config, verbose, commit_every, socket_path):
+    # Forward the operation to a running daemon, only if its socket is given explicitly: the daemon serves
+    # the database of its own configuration and receives the passwords of new users
+    if operation in REMOTE_OPERATIONS and socket_path and server.is_running(socket_path):
+        with server.Client(socket_path) as client:
+            try:
+                dispatch(client, operation, arguments, options)
+            except (OSError, RuntimeError) as e:
+                click.echo(f"{operation} operation failed: {str(e)}")
+                sys.exit(1)
+        return
 
-    # Construct the database URL
-    db_type = db_config['type']
-    if not db_type.startswith('sqlite'):
-        db_user = db_config['user']
-        db_password = db_config['password']
-        db_host = db_config['host']
-        db_port = db_config['port']
-        db_server = f'{db_user}:{db_password}@{db_host}:{db_port}'
-    else:
-        db_server = ''
+    # the configuration file is only required by the local database engine, not by the daemon clients
+    if not os.path.exists(config):
+        raise click.BadParameter(
+            f"Path '{config}' does not exist.", ctx=click.get_current_context(), param_hint="'--config'"
+        )
+
+    def connect():
+        # Load database configuration from YAML file
+        try:
+            with profiler.phase("config"):
+                db_config = utils.load_database_config(config)
+        except Exception as e:
+            click.echo(f"Error opening configuration file '{config}': {str(e)}")
+            sys.exit(1)
 
-    db_name = db_config['name']
+        # Create engines of the database and its read replicas
+        try:
+            with profiler.phase("engine"):
+                engines = [
+                    create_engine(utils.database_url(database), echo=verbose, **utils.engine_options(db_config))
+                    for database in [db_config] + db_config["replicas"]
+                ]
+        except Exception as e:
+            click.echo(f"Error creating database engine: {str(e)}")
+            sys.exit(1)
+        primary, *replica_engines = [profiler.instrument(engine) for engine in engines]
+        return replicas.ReplicaRouter(primary, replica_engines)
 
-    db_url = f'{db_type}://{db_server}/{db_name}'
+    if profiler.enabled:
+        # time the import of the operations module, SQLAlchemy and passlib separately
+        with profiler.phase("import"):
+            from . import operations  # noqa: F401
 
-    # Create an engine
-    engine = create_engine(db_url, echo=verbose)
+    ops = EngineOperations(connect=connect)
 
     # Perform the operation
-    if operation == "reset":
-        do_reset(engine, arguments, force)
-    elif operation in ["add-domain", "delete-domain"]:
-        add_del_domain(engine, operation, arguments)
-    elif operation == "search-domains":
-        search_domains(engine, arguments)
-    elif operation in ["add-user", "delete-user"]:
-        add_del_user(engine, operation, arguments)
-    elif operation == "search-users":
-        search_users(engine, arguments)
-    elif operation == "add-alias":
-        add_alias(engine, arguments)
-    elif operation in ["delete-aliases", "search-aliases"]:
-        del_search_aliases(engine, operation, arguments)
+    if operation == "batch":
+        run_batch(ops, arguments, options, commit_every)
+    elif operation == "serve":
+        run_server(ops, arguments, socket_path)
     else:
-        # if an operation is in click.Choice above but is not implemented here
-        click.echo("unexpected operation, this should never happen")
-        sys.exit(1)
+        try:
+            dispatch(ops, operation, arguments, options)
+        except Exception as e:
+            # the retry policy gave up on a serialization failure, deadlock or lock timeout
+            if not retry.is_transient(e):
+                raise
+            click.echo(f"{operation} operation failed, database is busy: {str(e.orig)}")
+            sys.exit(1)
 
 
 if __name__ == "__main__":
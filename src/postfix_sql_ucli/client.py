@@ -0,0 +1,192 @@
+"""Library API for programs managing the Postfix SQL database"""
+
+import collections
+import functools
+import inspect
+import time
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.exc import IntegrityError
+
+from . import models, operations, profiling, utils
+
+
+class DomainCache:
+    """Bounded least recently used cache of virtual domain IDs by domain name with a time to live
+
+    :param maxsize: maximum number of cached domains
+    :type maxsize: int
+    :param ttl: number of seconds a cached domain ID is used before it is resolved again
+    :type ttl: float"""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+
+    def get(self, domain_name):
+        """Get the cached ID of a domain
+
+        :returns: domain ID or None if not cached or expired
+        :rtype: int"""
+
+        entry = self._entries.get(domain_name)
+        if entry is None:
+            return None
+        domain_id, expires = entry
+        if expires <= time.monotonic():
+            del self._entries[domain_name]
+            return None
+        self._entries.move_to_end(domain_name)
+        return domain_id
+
+    def put(self, domain_name, domain_id):
+        self._entries[domain_name] = domain_id, time.monotonic() + self.ttl
+        self._entries.move_to_end(domain_name)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, domain_name=None):
+        """Remove a domain or all domains if `domain_name` is not set from the cache"""
+
+        if domain_name is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(domain_name, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class PostfixSQLClient:
+    """Functions of :mod:`postfix_sql_ucli.operations` module over a database connection kept open across calls
+
+    Operations are available as methods with the same signature except for the `engine` argument,
+    e.g. ``client.add_domain("example.com")``. Functions returning generators run on their own
+    connection from the pool of the engine, so that they can be interleaved with other calls.
+
+    The IDs of virtual domains are cached, so that adding many users and aliases does not resolve the
+    domain of every address again. The cache is updated by the domain writes of the client, entries
+    expire after `cache_ttl` seconds to pick up domains deleted by other clients. Adding an entry with
+    an ID of a domain deleted in the meantime is retried with the domain resolved by name if the
+    database reports the foreign key violation (SQLite only enforces foreign keys if enabled).
+
+    The client is not thread-safe, use a client per thread sharing the engine instead.
+
+    :param engine: SQLAlchemy Engine object or database URL
+    :type engine: object
+    :param cache_size: maximum number of cached domain IDs
+    :type cache_size: int
+    :param cache_ttl: number of seconds a cached domain ID is used
+    :type cache_ttl: float
+    :param engine_options: arguments passed to ``sqlalchemy.create_engine`` if `engine` is a URL"""
+
+    def __init__(self, engine, cache_size=1024, cache_ttl=300, **engine_options):
+        self._owns_engine = isinstance(engine, str)
+        self.engine = create_engine(engine, **engine_options) if self._owns_engine else engine
+        self.domains = DomainCache(cache_size, cache_ttl)
+        self._connection = None
+
+    @classmethod
+    def from_config(cls, config_file_path, **kwargs):
+        """Create a client connected to the database given in a configuration file,
+        see :func:`postfix_sql_ucli.utils.load_database_config`"""
+
+        db_config = utils.load_database_config(config_file_path)
+        return cls(utils.database_url(db_config), **kwargs, **utils.engine_options(db_config))
+
+    @property
+    def connection(self):
+        if self._connection is None or self._connection.closed or self._connection.invalidated:
+            self._connection = self.engine.connect()
+        return self._connection
+
+    def __getattr__(self, name):
+        function = getattr(operations, name, None)
+        if name.startswith("_") or not inspect.isfunction(function) or function.__module__ != operations.__name__:
+            raise AttributeError(name)
+        # a generator holds its connection until it is exhausted, run it on a connection of its own
+        return functools.partial(function, self.engine if inspect.isgeneratorfunction(function) else self.connection)
+
+    def domain_id(self, domain_name):
+        """Resolve the ID of a virtual domain using the cache
+
+        :param domain_name: string containing the domain name
+        :type domain_name: str
+        :returns: domain ID or None if the domain does not exist
+        :rtype: int"""
+
+        domain_id = self.domains.get(domain_name)
+        if domain_id is None:
+            domain_id = self.connection.scalar(
+                select(models.VirtualDomain.id).where(models.VirtualDomain.name == domain_name)
+            )
+            self.connection.rollback()  # end the transaction started by the query
+            if domain_id is not None:
+                self.domains.put(domain_name, domain_id)
+        return domain_id
+
+    def _add_with_domain(self, function, email, *args):
+        _, domain_name = email.split('@', 1)
+        domain_id = self.domain_id(domain_name)
+        if domain_id is None:
+            return None, False
+        try:
+            entries, added = function(self.connection, email, *args, domain_id=domain_id)
+            if entries is not None:
+                return entries, added
+        except IntegrityError:
+            pass
+        # the cached domain was deleted by another client, resolve the domain by name
+        self.domains.invalidate(domain_name)
+        return function(self.connection, email, *args)
+
+    def reset_database(self):
+        self.domains.invalidate()
+        operations.reset_database(self.connection)
+        self.connection.commit()
+
+    def add_domain(self, domain_name):
+        domains, added = operations.add_domain(self.connection, domain_name)
+        for domain in domains:
+            self.domains.put(domain["name"], domain["id"])
+        return domains, added
+
+    def delete_domain(self, domain_name, chunk_size=1000, pause=0):
+        self.domains.invalidate(domain_name)
+        try:
+            yield from operations.delete_domain(self.engine, domain_name, chunk_size, pause)
+        finally:
+            self.domains.invalidate(domain_name)
+
+    def add_user(self, user_email, user_password):
+        _, domain_name = user_email.split('@', 1)
+        if self.domain_id(domain_name) is None:
+            return None, False
+        # hash the password once for both attempts of _add_with_domain
+        with profiling.phase("hash"):
+            user_password_hash = utils.doveadm_pw_hash(user_password)
+        return self._add_with_domain(operations._add_user, user_email, user_password_hash)
+
+    def add_alias(self, source_email, destination_email):
+        return self._add_with_domain(operations.add_alias, source_email, destination_email)
+
+    def sync(self, plan, batch_size=500, workers=1):
+        # domains may be deleted and added again with a new ID
+        self.domains.invalidate()
+        return operations.sync(self.connection, plan, batch_size, workers)
+
+    def close(self):
+        """Close the connection and dispose of the engine if it was created by the client"""
+
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        if self._owns_engine:
+            self.engine.dispose()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
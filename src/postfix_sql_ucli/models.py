@@ -1,13 +1,24 @@
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, ForeignKey, Index, Integer, String
 from sqlalchemy.orm import declarative_base, relationship
 
 Base = declarative_base()
 
 
+def _pattern_index(name, column):
+    """Index serving prefix searches (``LIKE 'prefix%'``) on PostgreSQL
+
+    Plain btree indexes only serve ``LIKE`` on PostgreSQL databases with the C collation, indexes with
+    the ``text_pattern_ops`` operator class serve them regardless of the collation. Other databases
+    do not need a separate index, so it is only created on PostgreSQL."""
+
+    return Index(name, column, postgresql_ops={column: 'text_pattern_ops'}).ddl_if(dialect='postgresql')
+
+
 class VirtualDomain(Base):
     """Table containing virtual domains"""
 
     __tablename__ = 'virtual_domains'
+    __table_args__ = (_pattern_index('name_pattern_idx', 'name'),)
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False, index=True, unique=True)
@@ -32,9 +43,10 @@ class VirtualUser(Base):
     """Table containing virtual users per domain"""
 
     __tablename__ = 'virtual_users'
+    __table_args__ = (_pattern_index('email_pattern_idx', 'email'),)
 
     id = Column(Integer, primary_key=True)
-    domain_id = Column(Integer, ForeignKey('virtual_domains.id', ondelete='CASCADE'), nullable=False)
+    domain_id = Column(Integer, ForeignKey('virtual_domains.id', ondelete='CASCADE'), nullable=False, index=True)
     password = Column(String, nullable=False)
     email = Column(String, nullable=False, index=True, unique=True)
 
@@ -62,9 +74,16 @@ class VirtualAlias(Base):
     """Table containing virtual aliases per domain"""
 
     __tablename__ = 'virtual_aliases'
+    __table_args__ = (
+        Index('source_destination_idx', 'source', 'destination', unique=True),
+        # serves lookups by destination and covers reverse lookups of the sources forwarding to it
+        Index('destination_source_idx', 'destination', 'source'),
+        _pattern_index('source_pattern_idx', 'source'),
+        _pattern_index('destination_pattern_idx', 'destination'),
+    )
 
     id = Column(Integer, primary_key=True)
-    domain_id = Column(Integer, ForeignKey('virtual_domains.id', ondelete='CASCADE'), nullable=False)
+    domain_id = Column(Integer, ForeignKey('virtual_domains.id', ondelete='CASCADE'), nullable=False, index=True)
     source = Column(String, nullable=False, index=True)
     destination = Column(String, nullable=False)
 
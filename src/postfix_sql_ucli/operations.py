@@ -1,13 +1,258 @@
-from sqlalchemy import and_, delete, insert, select
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import itertools
+import os
+import time
+import weakref
+
+from sqlalchemy import Select, and_, delete, func, insert, literal, select, true, tuple_, update
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from sqlalchemy.orm import Session
 
-from . import models, utils
+from . import models, profiling, utils
+
+_upsert_dialects = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+    "mysql": mysql.insert,
+    "mariadb": mysql.insert,
+}
+
+
+# set while a function decorated with _retrying runs on a connection inside a transaction of the caller
+_joined = contextvars.ContextVar("joined", default=False)
+
+
+def _retrying(function):
+    """Decorate a function writing in its own transaction, so that it is run again on transient errors
+
+    The :class:`postfix_sql_ucli.retry.RetryPolicy` is taken from the ``retry`` execution option of the
+    engine passed as the first argument. Functions called on a connection inside a transaction are not
+    retried, the transaction of the caller is aborted by the error."""
+
+    @functools.wraps(function)
+    def wrapper(engine, *args, **kwargs):
+        policy = engine.get_execution_options().get("retry")
+        joined = isinstance(engine, Connection) and engine.in_transaction()
+        token = _joined.set(joined)
+        try:
+            if policy is None or joined:
+                return function(engine, *args, **kwargs)
+            return policy.call(function, engine, *args, **kwargs)
+        finally:
+            _joined.reset(token)
+
+    return wrapper
+
+
+def _commit(session):
+    """Commit the session, roll back the database transaction if the ``COMMIT`` fails
+
+    SQLite keeps the transaction open when ``COMMIT`` fails on a locked database, while SQLAlchemy
+    considers it finished and returns the connection to the pool with the uncommitted changes, where
+    they would be seen by the retried attempt and committed or rolled back by an unrelated one.
+    A session joining the transaction of the caller leaves it to the caller, only the savepoint of
+    the session is rolled back if releasing it fails, so that the caller can roll back to its own."""
+
+    connection = session.connection()
+    if _joined.get():
+        savepoint = connection.get_nested_transaction()
+        try:
+            session.commit()
+        except DBAPIError:
+            # SQLAlchemy keeps a savepoint that failed to be released as the pending nested transaction
+            if savepoint is not None and connection.get_nested_transaction() is savepoint:
+                savepoint.rollback()
+            raise
+        return
+
+    dbapi_connection = connection.connection.dbapi_connection
+    try:
+        session.commit()
+    except DBAPIError:
+        with contextlib.suppress(Exception):
+            dbapi_connection.rollback()
+        raise
 
 
 def _asdicts(results):
     return [dict(entry) for entry in results]
 
 
+def _startswith(column, prefix):
+    # wildcards in the prefix match literally, so that the search is served by an index;
+    # an empty prefix matches every entry and needs no filter
+    return column.startswith(prefix, autoescape=True) if prefix else true()
+
+
+def _domain_id(domain_name):
+    # scalar subquery resolving the domain id, so that entries are filtered on the indexed domain_id column
+    return select(models.VirtualDomain.id).where(models.VirtualDomain.name == domain_name).scalar_subquery()
+
+
+def _page(stmt, key_columns, limit, after):
+    # keyset pagination: continue after the last key of the previous page instead of skipping rows with OFFSET,
+    # so that every page is a range scan of the index on the key columns
+    if after is not None:
+        if isinstance(after, str):
+            stmt = stmt.where(key_columns[0] > after)
+        else:
+            stmt = stmt.where(tuple_(*key_columns) > tuple_(*after))
+    stmt = stmt.order_by(*key_columns)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return stmt
+
+
+def _delete_chunks(engine, model, criteria, key_columns, chunk_size, pause=0, returning=False):
+    """Delete entries matching the criteria in chunks, every chunk in its own transaction
+
+    The ids of the next chunk are selected in the order of `key_columns` after the last key of the
+    previous chunk, so that every chunk is a range scan of the index on the key columns, and the
+    entries are deleted by primary key, so that only the rows of the chunk are locked.
+
+    :param engine: SQLAlchemy Engine object
+    :param model: model class of the entries
+    :param criteria: SQL expression matching the entries to delete
+    :param key_columns: list of columns the chunks are ordered by
+    :param chunk_size: maximum number of entries deleted per transaction
+    :param pause: number of seconds to wait after every committed chunk
+    :param returning: return the deleted entries instead of counting them
+    :returns: generator yielding the list of deleted entries or the number of deleted entries per chunk
+    :rtype: generator"""
+
+    after = None
+    while True:
+        keys = []
+        chunk = _delete_chunk(engine, model, criteria, key_columns, chunk_size, after, returning, keys)
+        if not keys:
+            return
+        # the keyset only moves on once the chunk is committed
+        after = tuple(keys[-1][1:])
+        yield chunk
+        if pause:
+            time.sleep(pause)
+
+
+@_retrying
+def _delete_chunk(engine, model, criteria, key_columns, chunk_size, after, returning, keys):
+    """Delete the next chunk of entries matching the criteria in one transaction
+
+    The keys of the chunk are selected by the first attempt only, an attempt run again after a
+    failed ``COMMIT`` deletes the entries of these keys that are still present instead of selecting
+    the entries following `after` again, which would skip the entries its failed attempt deleted.
+
+    :param keys: empty list the keys of the chunk are added to, it stays empty if no entries are left
+    :returns: list of deleted entries or their number
+    :rtype: list or int"""
+
+    with Session(engine) as session:
+        if not keys:
+            keys.extend(
+                session.execute(
+                    _page(select(model.id, *key_columns).where(criteria), key_columns, chunk_size, after)
+                ).all()
+            )
+            if not keys:
+                return None
+        stmt = delete(model).where(model.id.in_([key[0] for key in keys]))
+        if returning:
+            chunk = _asdicts(session.scalars(stmt.returning(model)).all())
+        else:
+            chunk = session.execute(stmt).rowcount
+        _commit(session)
+    return chunk
+
+
+@_retrying
+def _delete_ids(engine, model, ids):
+    """Delete entries by primary key in one transaction
+
+    :returns: number of deleted entries
+    :rtype: int"""
+
+    with Session(engine) as session:
+        deleted = session.execute(delete(model).where(model.id.in_(ids))).rowcount
+        _commit(session)
+    return deleted
+
+
+# unique indexes targeted by ON CONFLICT per engine and table: True if present, False if missing,
+# e.g. the (source, destination) index of aliases in databases created by earlier versions
+_conflict_targets = weakref.WeakKeyDictionary()
+
+
+def _missing_conflict_target(error):
+    # PostgreSQL invalid_column_reference, SQLite rejects the statement before running it
+    orig = getattr(error, "orig", None)
+    sqlstate = getattr(orig, "pgcode", None) or getattr(orig, "sqlstate", None)
+    return sqlstate == "42P10" or "ON CONFLICT clause does not match" in str(orig)
+
+
+def _insert_ignore(session, model, columns, values, index_elements, key_clause):
+    """Insert a single entry unless it conflicts with an existing entry in one statement
+
+    PostgreSQL and SQLite use ``INSERT ... ON CONFLICT DO NOTHING RETURNING``, MySQL uses
+    ``INSERT IGNORE`` followed by a query for the new entry, other dialects fall back to a plain
+    ``INSERT`` in a savepoint. Tables without the unique index on PostgreSQL and SQLite fall back
+    to a query for the existing entry followed by a plain ``INSERT``, which is not race-free.
+
+    :param session: SQLAlchemy Session object
+    :param model: model class of the entry
+    :param columns: list of column names
+    :param values: list of column values or a Select statement providing them
+    :param index_elements: list of column names in the unique index that may conflict
+    :param key_clause: SQL expression matching the entry by its unique columns
+    :returns: list of inserted entries, empty if the entry conflicts with an existing entry
+              or the select statement did not return any rows
+    :rtype: list"""
+
+    dialect_name = session.get_bind().dialect.name
+    stmt = _upsert_dialects.get(dialect_name, insert)(model)
+    if isinstance(values, Select):
+        stmt = stmt.from_select(columns, values)
+    else:
+        stmt = stmt.values(dict(zip(columns, values)))
+
+    if dialect_name in ("postgresql", "sqlite"):
+        targets = _conflict_targets.setdefault(session.get_bind().engine, {})
+        present = targets.get(model.__tablename__)
+        if present is not False:
+            # a missing index aborts the transaction on PostgreSQL, the first statement runs in a savepoint
+            savepoint = present is None and dialect_name == "postgresql"
+            try:
+                with session.begin_nested() if savepoint else contextlib.nullcontext():
+                    entries = session.scalars(
+                        stmt.on_conflict_do_nothing(index_elements=index_elements).returning(model)
+                    ).all()
+            except DBAPIError as e:
+                if not _missing_conflict_target(e):
+                    raise
+                targets[model.__tablename__] = False
+            else:
+                targets[model.__tablename__] = True
+                return entries
+        if session.scalars(select(model.id).where(key_clause)).first() is not None:
+            return []
+        result = session.execute(stmt)
+    elif dialect_name in ("mysql", "mariadb"):
+        result = session.execute(stmt.prefix_with("IGNORE"))
+    else:
+        try:
+            with session.begin_nested():
+                result = session.execute(stmt)
+        except IntegrityError:
+            return []
+
+    if not result.rowcount:
+        return []
+    return session.scalars(select(model).where(key_clause)).all()
+
+
 def reset_database(engine):
     """Reset the exisitng Postfix database
 
@@ -18,6 +263,7 @@ def reset_database(engine):
     models.Base.metadata.create_all(engine)
 
 
+@_retrying
 def add_domain(engine, domain_name):
     """Add a new virtual domain
 
@@ -28,27 +274,19 @@ def add_domain(engine, domain_name):
     :returns: A tuple: list of entries in the database, a flag (True if a new entry was added, False otherwise)
     :rtype: tuple(list, bool)"""
 
-    # check if domain exists
-    domains = search_domains(engine, domain_name, True)
-
-    if len(domains):
-        return domains, False
-
-    # add virtual domain
+    # add virtual domain unless it exists
+    key_clause = models.VirtualDomain.name == domain_name
     with Session(engine) as session:
-        domains = session.scalars(
-            insert(models.VirtualDomain).returning(models.VirtualDomain),
-            [
-                {"name": domain_name},
-            ],
-        ).all()
+        domains = _asdicts(_insert_ignore(session, models.VirtualDomain, ["name"], [domain_name], ["name"], key_clause))
 
-        session.commit()  # write changes to the database
+        if len(domains):
+            _commit(session)  # write changes to the database
+            return domains, True
 
-        return _asdicts(domains), True
+        return _asdicts(session.scalars(select(models.VirtualDomain).where(key_clause)).all()), False
 
 
-def search_domains(engine, domain_name_pattern, exact=False):
+def search_domains(engine, domain_name_pattern, exact=False, limit=None, after=None):
     """Search virtual domains
 
     :param engine: SQLAlchemy Engine object
@@ -56,69 +294,170 @@ def search_domains(engine, domain_name_pattern, exact=False):
     :param domain_name_pattern: string containing the sought-for domain name pattern
     :type domain_name_pattern: str
     :param exact: If True pattern value must match exactly, otherwise match pattern
-                  from beginning of the string
+                  from beginning of the string, ``%`` and ``_`` characters match literally
     :type exact: bool
-    :returns: list of entries in the database
+    :param limit: maximum number of entries to return
+    :type limit: int
+    :param after: only return entries following the entry with this name in the sort order
+    :type after: str
+    :returns: list of entries in the database sorted by their keys
     :rtype: list"""
 
+    return list(iter_domains(engine, domain_name_pattern, exact, limit=limit, after=after))
+
+
+def _domains_query(domain_name_pattern, exact, limit, after):
+    if exact:
+        stmt = select(models.VirtualDomain).where(models.VirtualDomain.name == domain_name_pattern)
+    else:
+        stmt = select(models.VirtualDomain).where(_startswith(models.VirtualDomain.name, domain_name_pattern))
+    return _page(stmt, [models.VirtualDomain.name], limit, after)
+
+
+def iter_domains(engine, domain_name_pattern, exact=False, chunk_size=1000, limit=None, after=None):
+    """Iterate over virtual domains fetching them from a server-side cursor in chunks
+
+    :param engine: SQLAlchemy Engine object
+    :type engine: object
+    :param domain_name_pattern: string containing the sought-for domain name pattern
+    :type domain_name_pattern: str
+    :param exact: If True pattern value must match exactly, otherwise match pattern
+                  from beginning of the string, ``%`` and ``_`` characters match literally
+    :type exact: bool
+    :param chunk_size: number of entries fetched from the database at once
+    :type chunk_size: int
+    :param limit: maximum number of entries to return
+    :type limit: int
+    :param after: only return entries following the entry with this name in the sort order
+    :type after: str
+    :returns: generator yielding entries in the database
+    :rtype: generator"""
+
+    stmt = _domains_query(domain_name_pattern, exact, limit, after)
+
     # search domains
     with Session(engine) as session:
-        if exact:
-            results = session.scalars(
-                select(models.VirtualDomain).where(models.VirtualDomain.name == domain_name_pattern)
-            ).all()
-        else:
-            results = session.scalars(
-                select(models.VirtualDomain).where(models.VirtualDomain.name.startswith(domain_name_pattern))
-            ).all()
+        for entry in session.scalars(stmt.execution_options(yield_per=chunk_size)):
+            yield dict(entry)
+
 
-        return _asdicts(results)
+def delete_domain(engine, domain_name, chunk_size=1000, pause=0):
+    """Delete a virtual domain with all its virtual users and aliases in chunks
 
+    Aliases and users of the domain are deleted in chunks of at most `chunk_size` entries, every
+    chunk in its own transaction, so that locks on the tables are only held for a short time and
+    concurrent lookups are not blocked. The domain entry is deleted last. Deleted entries are
+    counted, not returned, so that memory use does not depend on the size of the domain.
 
-def add_user(engine, user_email, user_password):
+    :param engine: SQLAlchemy Engine object
+    :type engine: object
+    :param domain_name: string containing the domain name
+    :type domain_name: str
+    :param chunk_size: maximum number of entries deleted per transaction
+    :type chunk_size: int
+    :param pause: number of seconds to wait after every committed chunk
+    :type pause: float
+    :returns: generator yielding dictionaries with the number of entries deleted per chunk:
+              'users', 'aliases' and 'domains', nothing if the domain does not exist
+    :rtype: generator"""
+
+    with Session(engine) as session:
+        domain_id = session.scalar(select(models.VirtualDomain.id).where(models.VirtualDomain.name == domain_name))
+    if domain_id is None:
+        return
+
+    for model, key in [(models.VirtualAlias, "aliases"), (models.VirtualUser, "users")]:
+        for count in _delete_chunks(engine, model, model.domain_id == domain_id, [model.id], chunk_size, pause):
+            yield {"users": 0, "aliases": 0, "domains": 0, key: count}
+
+    yield {"users": 0, "aliases": 0, "domains": _delete_ids(engine, models.VirtualDomain, [domain_id])}
+
+
+def add_user(engine, user_email, user_password, domain_id=None):
     """Add a new virtual user
 
+    An existing user and a missing domain are detected by a query before the password is hashed,
+    the user is then added by a single race-free statement.
+
     :param engine: SQLAlchemy Engine object
     :type engine: object
     :param user_email: string containing the new user email account address
     :type user_email: str
     :param user_password: string containing the new user email account password
     :type user_password: str
+    :param domain_id: ID of the virtual domain of the email address if known, it is resolved from
+                      the domain name in the same statement otherwise
+    :type domain_id: int
     :returns: A tuple: list of entries in the database, a flag (True if a new entry was added, False otherwise)
     :rtype: tuple(list, bool)"""
 
-    # check if user email domain is present in the database
-    _, email_domain = user_email.split('@', 1)
+    # the password is only hashed if the user can be added
+    rejected = _reject_user(engine, user_email, domain_id)
+    if rejected is not None:
+        return rejected
 
-    domains = search_domains(engine, email_domain, True)
+    # hash user passowrd
+    with profiling.phase("hash"):
+        user_password_hash = utils.doveadm_pw_hash(user_password)
+    return _add_user(engine, user_email, user_password_hash, domain_id)
 
-    if len(domains) != 1:
-        return None, False
 
-    # check if user exists
-    users = search_users(engine, user_email, True)
+def _reject_user(engine, user_email, domain_id=None):
+    """Check in a single query whether a user exists or its domain is missing before its password is hashed
 
-    if len(users):
-        return users, False
+    :returns: result of :func:`add_user` if the user can not be added, None otherwise
+    :rtype: tuple(list, bool)"""
 
-    # hash user passowrd
-    user_password_hash = utils.doveadm_pw_hash(user_password)
+    _, email_domain = user_email.split('@', 1)
+    key_clause = models.VirtualUser.email == user_email
+    with Session(engine) as session:
+        user_id, found_domain_id = session.execute(
+            select(
+                select(models.VirtualUser.id).where(key_clause).scalar_subquery(),
+                literal(domain_id) if domain_id is not None else _domain_id(email_domain),
+            )
+        ).one()
+        if user_id is not None:
+            return _asdicts(session.scalars(select(models.VirtualUser).where(key_clause)).all()), False
+    if found_domain_id is None:
+        return None, False
+    return None
 
-    # add virtual user
+
+@_retrying
+def _add_user(engine, user_email, user_password_hash, domain_id=None):
+    # add virtual user unless it exists, resolving the domain ID in the same statement
+    _, email_domain = user_email.split('@', 1)
+    key_clause = models.VirtualUser.email == user_email
+    if domain_id is not None:
+        values = [domain_id, user_email, user_password_hash]
+    else:
+        values = select(models.VirtualDomain.id, literal(user_email), literal(user_password_hash)).where(
+            models.VirtualDomain.name == email_domain
+        )
     with Session(engine) as session:
-        users = session.scalars(
-            insert(models.VirtualUser).returning(models.VirtualUser),
-            [
-                {"domain_id": domains[0]["id"], "email": user_email, "password": user_password_hash},
-            ],
+        users = _asdicts(
+            _insert_ignore(
+                session,
+                models.VirtualUser,
+                ["domain_id", "email", "password"],
+                values,
+                ["email"],
+                key_clause,
+            )
         )
 
-        session.commit()  # write changes to the database
+        if len(users):
+            _commit(session)  # write changes to the database
+            return users, True
 
-        return _asdicts(users), True
+        # either the user exists or the domain is not present in the database
+        users = _asdicts(session.scalars(select(models.VirtualUser).where(key_clause)).all())
 
+        return (users or None), False
 
-def search_users(engine, user_email_pattern, exact=False):
+
+def search_users(engine, user_email_pattern, exact=False, domain_name=None, limit=None, after=None):
     """Search virtual users
 
     :param engine: SQLAlchemy Engine object
@@ -126,51 +465,115 @@ def search_users(engine, user_email_pattern, exact=False):
     :param user_email_pattern: string containing the sought-for user email address pattern
     :type user_email_pattern: str
     :param exact: If True pattern value must match exactly, otherwise match pattern
-                  from beginning of the string
+                  from beginning of the string, ``%`` and ``_`` characters match literally
     :type exact: bool
-    :returns: list of entries in the database
+    :param domain_name: only return users of the virtual domain with this name
+    :type domain_name: str
+    :param limit: maximum number of entries to return
+    :type limit: int
+    :param after: only return entries following the entry with this email in the sort order
+    :type after: str
+    :returns: list of entries in the database sorted by their keys
     :rtype: list"""
 
-    # search users
-    with Session(engine) as session:
-        if exact:
-            results = session.scalars(
-                select(models.VirtualUser).where(models.VirtualUser.email == user_email_pattern)
-            ).all()
-        else:
-            results = session.scalars(
-                select(models.VirtualUser).where(models.VirtualUser.email.startswith(user_email_pattern))
-            ).all()
+    return list(iter_users(engine, user_email_pattern, exact, domain_name=domain_name, limit=limit, after=after))
+
 
-        return _asdicts(results)
+def _users_query(user_email_pattern, exact, domain_name, limit, after):
+    if exact:
+        stmt = select(models.VirtualUser).where(models.VirtualUser.email == user_email_pattern)
+    else:
+        stmt = select(models.VirtualUser).where(_startswith(models.VirtualUser.email, user_email_pattern))
+    if domain_name is not None:
+        stmt = stmt.where(models.VirtualUser.domain_id == _domain_id(domain_name))
+    return _page(stmt, [models.VirtualUser.email], limit, after)
 
 
-def delete_user(engine, user_email_pattern):
-    """Delete virtual user
+def iter_users(engine, user_email_pattern, exact=False, chunk_size=1000, domain_name=None, limit=None, after=None):
+    """Iterate over virtual users fetching them from a server-side cursor in chunks
 
     :param engine: SQLAlchemy Engine object
     :type engine: object
-    :param user_email_pattern: string containing user email account address
+    :param user_email_pattern: string containing the sought-for user email address pattern
     :type user_email_pattern: str
-    :returns: list of entries in the database
-    :rtype: list"""
+    :param exact: If True pattern value must match exactly, otherwise match pattern
+                  from beginning of the string, ``%`` and ``_`` characters match literally
+    :type exact: bool
+    :param chunk_size: number of entries fetched from the database at once
+    :type chunk_size: int
+    :param domain_name: only return users of the virtual domain with this name
+    :type domain_name: str
+    :param limit: maximum number of entries to return
+    :type limit: int
+    :param after: only return entries following the entry with this email in the sort order
+    :type after: str
+    :returns: generator yielding entries in the database
+    :rtype: generator"""
+
+    stmt = _users_query(user_email_pattern, exact, domain_name, limit, after)
 
-    # delete virtual user
+    # search users
     with Session(engine) as session:
-        results = session.scalars(
-            delete(models.VirtualUser)
-            .where(models.VirtualUser.email == user_email_pattern)
-            .returning(models.VirtualUser)
-        ).all()
+        for entry in session.scalars(stmt.execution_options(yield_per=chunk_size)):
+            yield dict(entry)
 
-        results = _asdicts(results)
 
-        session.commit()  # write changes to the database
+def _user_criteria(user_email_pattern, prefix):
+    if prefix:
+        return _startswith(models.VirtualUser.email, user_email_pattern)
+    return models.VirtualUser.email == user_email_pattern
 
-        return results
 
+def delete_user(engine, user_email_pattern, prefix=False, chunk_size=1000, pause=0, count_only=False):
+    """Delete virtual users in chunks, every chunk in its own transaction
 
-def add_alias(engine, source_email, destination_email):
+    :param engine: SQLAlchemy Engine object
+    :type engine: object
+    :param user_email_pattern: string containing user email account address
+    :type user_email_pattern: str
+    :param prefix: delete all virtual users with emails starting with `user_email_pattern`,
+                   ``%`` and ``_`` characters in the pattern match literally
+    :type prefix: bool
+    :param chunk_size: maximum number of entries deleted per transaction
+    :type chunk_size: int
+    :param pause: number of seconds to wait after every committed chunk
+    :type pause: float
+    :param count_only: only count the deleted entries instead of returning them
+    :type count_only: bool
+    :returns: list of deleted entries or their number if `count_only` is set
+    :rtype: list or int"""
+
+    criteria = _user_criteria(user_email_pattern, prefix)
+    if count_only:
+        return sum(_delete_chunks(engine, models.VirtualUser, criteria, [models.VirtualUser.email], chunk_size, pause))
+    return list(iter_delete_users(engine, user_email_pattern, prefix, chunk_size, pause))
+
+
+def iter_delete_users(engine, user_email_pattern, prefix=False, chunk_size=1000, pause=0):
+    """Delete virtual users in chunks and yield the deleted entries after every committed chunk
+
+    :param engine: SQLAlchemy Engine object
+    :type engine: object
+    :param user_email_pattern: string containing user email account address
+    :type user_email_pattern: str
+    :param prefix: delete all virtual users with emails starting with `user_email_pattern`
+    :type prefix: bool
+    :param chunk_size: maximum number of entries deleted per transaction
+    :type chunk_size: int
+    :param pause: number of seconds to wait after every committed chunk
+    :type pause: float
+    :returns: generator yielding deleted entries as dictionaries
+    :rtype: generator"""
+
+    criteria = _user_criteria(user_email_pattern, prefix)
+    for chunk in _delete_chunks(
+        engine, models.VirtualUser, criteria, [models.VirtualUser.email], chunk_size, pause, returning=True
+    ):
+        yield from chunk
+
+
+@_retrying
+def add_alias(engine, source_email, destination_email, domain_id=None):
     """Add a new virtual alias
 
     :param engine: SQLAlchemy Engine object
@@ -179,39 +582,113 @@ def add_alias(engine, source_email, destination_email):
     :type source_email: str
     :param destination_email: string containing destination email address
     :type destination_email: str
+    :param domain_id: ID of the virtual domain of the source address if known, it is resolved from
+                      the domain name in the same statement otherwise
+    :type domain_id: int
     :returns: A tuple: list of entries in the database, a flag (True if a new entry was added, False otherwise)
     :rtype: tuple(list, bool)"""
 
-    # check email domain
+    # add virtual alias unless it exists, resolving the domain ID in the same statement
     _, source_email_domain = source_email.split('@', 1)
+    key_clause = and_(
+        models.VirtualAlias.source == source_email,
+        models.VirtualAlias.destination == destination_email,
+    )
+    if domain_id is not None:
+        values = [domain_id, source_email, destination_email]
+    else:
+        values = select(models.VirtualDomain.id, literal(source_email), literal(destination_email)).where(
+            models.VirtualDomain.name == source_email_domain
+        )
+    with Session(engine) as session:
+        aliases = _asdicts(
+            _insert_ignore(
+                session,
+                models.VirtualAlias,
+                ["domain_id", "source", "destination"],
+                values,
+                ["source", "destination"],
+                key_clause,
+            )
+        )
 
-    domains = search_domains(engine, source_email_domain, True)
+        if len(aliases):
+            _commit(session)  # write changes to the database
+            return aliases, True
 
-    if len(domains) != 1:
-        return None, False
+        # either the alias exists or the domain is not present in the database
+        aliases = _asdicts(session.scalars(select(models.VirtualAlias).where(key_clause)).all())
 
-    # check if user exists
-    aliases = search_aliases(engine, source_email, destination_email, True)
+        return (aliases or None), False
 
-    if len(aliases):
-        return aliases, False
 
-    # add virtual alias
-    with Session(engine) as session:
-        aliases = session.scalars(
-            insert(models.VirtualAlias).returning(models.VirtualAlias),
-            [
-                {"domain_id": domains[0]["id"], "source": source_email, "destination": destination_email},
-            ],
-        )
+def search_aliases(
+    engine, source_email_pattern, destination_email_pattern, exact=False, domain_name=None, limit=None, after=None
+):
+    """Search virtual aliases
 
-        session.commit()  # write changes to the database
+    :param engine: SQLAlchemy Engine object
+    :type engine: object
+    :param source_email_pattern: string containing the source email address pattern
+    :type source_email_pattern: str
+    :param destination_email_pattern: string containing the destination email address pattern
+    :type destination_email_pattern: str
+    :param exact: If True pattern value must match exactly, otherwise match pattern
+                  from beginning of the string, ``%`` and ``_`` characters match literally
+    :type exact: bool
+    :param domain_name: only return aliases with source addresses in the virtual domain with this name
+    :type domain_name: str
+    :param limit: maximum number of entries to return
+    :type limit: int
+    :param after: only return entries following the entry with this source address or (source, destination) tuple in the sort order
+    :type after: str or tuple
+    :returns: list of entries in the database sorted by their keys
+    :rtype: list"""
 
-        return _asdicts(aliases), True
+    return list(
+        iter_aliases(
+            engine,
+            source_email_pattern,
+            destination_email_pattern,
+            exact,
+            domain_name=domain_name,
+            limit=limit,
+            after=after,
+        )
+    )
 
 
-def search_aliases(engine, source_email_pattern, destination_email_pattern, exact=False):
-    """Search virtual users
+def _aliases_query(source_email_pattern, destination_email_pattern, exact, domain_name, limit, after):
+    if exact:
+        stmt = select(models.VirtualAlias).where(
+            and_(
+                models.VirtualAlias.source == source_email_pattern,
+                models.VirtualAlias.destination == destination_email_pattern,
+            )
+        )
+    else:
+        stmt = select(models.VirtualAlias).where(
+            and_(
+                _startswith(models.VirtualAlias.source, source_email_pattern),
+                _startswith(models.VirtualAlias.destination, destination_email_pattern),
+            )
+        )
+    if domain_name is not None:
+        stmt = stmt.where(models.VirtualAlias.domain_id == _domain_id(domain_name))
+    return _page(stmt, [models.VirtualAlias.source, models.VirtualAlias.destination], limit, after)
+
+
+def iter_aliases(
+    engine,
+    source_email_pattern,
+    destination_email_pattern,
+    exact=False,
+    chunk_size=1000,
+    domain_name=None,
+    limit=None,
+    after=None,
+):
+    """Iterate over virtual aliases fetching them from a server-side cursor in chunks
 
     :param engine: SQLAlchemy Engine object
     :type engine: object
@@ -220,37 +697,105 @@ def search_aliases(engine, source_email_pattern, destination_email_pattern, exac
     :param destination_email_pattern: string containing the destination email address pattern
     :type destination_email_pattern: str
     :param exact: If True pattern value must match exactly, otherwise match pattern
-                  from beginning of the string
+                  from beginning of the string, ``%`` and ``_`` characters match literally
     :type exact: bool
-    :returns: list of entries in the database
-    :rtype: list"""
+    :param chunk_size: number of entries fetched from the database at once
+    :type chunk_size: int
+    :param domain_name: only return aliases with source addresses in the virtual domain with this name
+    :type domain_name: str
+    :param limit: maximum number of entries to return
+    :type limit: int
+    :param after: only return entries following the entry with this source address or (source, destination) tuple in the sort order
+    :type after: str or tuple
+    :returns: generator yielding entries in the database
+    :rtype: generator"""
+
+    stmt = _aliases_query(source_email_pattern, destination_email_pattern, exact, domain_name, limit, after)
 
     # search aliases
     with Session(engine) as session:
-        if exact:
-            results = session.scalars(
-                select(models.VirtualAlias).where(
-                    and_(
-                        models.VirtualAlias.source == source_email_pattern,
-                        models.VirtualAlias.destination == destination_email_pattern,
-                    )
-                )
-            ).all()
-        else:
-            results = session.scalars(
-                select(models.VirtualAlias).where(
-                    and_(
-                        models.VirtualAlias.source.startswith(source_email_pattern),
-                        models.VirtualAlias.destination.startswith(destination_email_pattern),
-                    )
-                )
-            ).all()
+        for entry in session.scalars(stmt.execution_options(yield_per=chunk_size)):
+            yield dict(entry)
+
+
+def reverse_aliases(engine, destination_email):
+    """Search virtual aliases forwarding to a destination email address
+
+    :param engine: SQLAlchemy Engine object
+    :type engine: object
+    :param destination_email: string containing the destination email address
+    :type destination_email: str
+    :returns: list of entries with source and destination fields
+    :rtype: list"""
+
+    return list(iter_reverse_aliases(engine, destination_email))
+
+
+def _reverse_aliases_query(destination_email):
+    return (
+        select(models.VirtualAlias.source, models.VirtualAlias.destination)
+        .where(models.VirtualAlias.destination == destination_email)
+        .order_by(models.VirtualAlias.source)
+    )
+
+
+def iter_reverse_aliases(engine, destination_email, chunk_size=1000):
+    """Iterate over virtual aliases forwarding to a destination email address
+
+    Only the source and destination columns are fetched, so that the lookup is served by
+    an index-only scan of the (destination, source) index.
+
+    :param engine: SQLAlchemy Engine object
+    :type engine: object
+    :param destination_email: string containing the destination email address
+    :type destination_email: str
+    :param chunk_size: number of entries fetched from the database at once
+    :type chunk_size: int
+    :returns: generator yielding entries with source and destination fields
+    :rtype: generator"""
+
+    stmt = _reverse_aliases_query(destination_email)
+
+    with Session(engine) as session:
+        for entry in session.execute(stmt.execution_options(yield_per=chunk_size)):
+            yield entry._asdict()
+
+
+def _alias_criteria(source_email_pattern, destination_email_pattern):
+    return and_(
+        _startswith(models.VirtualAlias.source, source_email_pattern),
+        _startswith(models.VirtualAlias.destination, destination_email_pattern),
+    )
+
+
+def delete_aliases(engine, source_email_pattern, destination_email_pattern, chunk_size=1000, pause=0, count_only=False):
+    """Delete virtual aliases with source and destination addresses starting with the given patterns
+    in chunks, every chunk in its own transaction, ``%`` and ``_`` characters in the patterns match literally
+
+    :param engine: SQLAlchemy Engine object
+    :type engine: object
+    :param source_email_pattern: string containing the source email address pattern
+    :type source_email_pattern: str
+    :param destination_email_pattern: string containing the destination email address pattern
+    :type destination_email_pattern: str
+    :param chunk_size: maximum number of entries deleted per transaction
+    :type chunk_size: int
+    :param pause: number of seconds to wait after every committed chunk
+    :type pause: float
+    :param count_only: only count the deleted entries instead of returning them
+    :type count_only: bool
+    :returns: list of deleted entries or their number if `count_only` is set
+    :rtype: list or int"""
 
-        return _asdicts(results)
+    if count_only:
+        criteria = _alias_criteria(source_email_pattern, destination_email_pattern)
+        key_columns = [models.VirtualAlias.source, models.VirtualAlias.destination]
+        return sum(_delete_chunks(engine, models.VirtualAlias, criteria, key_columns, chunk_size, pause))
+    return list(iter_delete_aliases(engine, source_email_pattern, destination_email_pattern, chunk_size, pause))
 
 
-def delete_aliases(engine, source_email_pattern, destination_email_pattern):
-    """Delete virtual aliases
+def iter_delete_aliases(engine, source_email_pattern, destination_email_pattern, chunk_size=1000, pause=0):
+    """Delete virtual aliases in chunks and yield the deleted entries after every committed chunk
 
     :param engine: SQLAlchemy Engine object
     :type engine: object
@@ -258,24 +803,610 @@ def delete_aliases(engine, source_email_pattern, destination_email_pattern):
     :type source_email_pattern: str
     :param destination_email_pattern: string containing the destination email address pattern
     :type destination_email_pattern: str
-    :returns: list of entries in the database
+    :param chunk_size: maximum number of entries deleted per transaction
+    :type chunk_size: int
+    :param pause: number of seconds to wait after every committed chunk
+    :type pause: float
+    :returns: generator yielding deleted entries as dictionaries
+    :rtype: generator"""
+
+    criteria = _alias_criteria(source_email_pattern, destination_email_pattern)
+    key_columns = [models.VirtualAlias.source, models.VirtualAlias.destination]
+    for chunk in _delete_chunks(engine, models.VirtualAlias, criteria, key_columns, chunk_size, pause, returning=True):
+        yield from chunk
+
+
+def stats(engine, domain_name_pattern=''):
+    """Count virtual users and aliases per virtual domain
+
+    :param engine: SQLAlchemy Engine object
+    :type engine: object
+    :param domain_name_pattern: only count entries of virtual domains with names starting with this string
+    :type domain_name_pattern: str
+    :returns: list of entries with domain, users and aliases fields sorted by domain name,
+              followed by an entry with the totals and domain field set to None
     :rtype: list"""
 
-    # delete aliases
+    return list(iter_stats(engine, domain_name_pattern))
+
+
+def _stats_query(domain_name_pattern):
+    def count(model):
+        return (
+            select(func.count())
+            .select_from(model)
+            .where(model.domain_id == models.VirtualDomain.id)
+            .correlate(models.VirtualDomain)
+            .scalar_subquery()
+        )
+
+    return (
+        select(
+            models.VirtualDomain.name.label("domain"),
+            count(models.VirtualUser).label("users"),
+            count(models.VirtualAlias).label("aliases"),
+        )
+        .where(_startswith(models.VirtualDomain.name, domain_name_pattern))
+        .order_by(models.VirtualDomain.name)
+    )
+
+
+def iter_stats(engine, domain_name_pattern='', chunk_size=1000):
+    """Iterate over virtual user and alias counts per virtual domain computed in a single query
+
+    The counts are correlated subqueries served by the indexes on the domain_id columns, so that
+    only the entries of the selected domains are visited.
+
+    :param engine: SQLAlchemy Engine object
+    :type engine: object
+    :param domain_name_pattern: only count entries of virtual domains with names starting with this string
+    :type domain_name_pattern: str
+    :param chunk_size: number of entries fetched from the database at once
+    :type chunk_size: int
+    :returns: generator yielding entries with domain, users and aliases fields sorted by domain name,
+              followed by an entry with the totals and domain field set to None
+    :rtype: generator"""
+
+    stmt = _stats_query(domain_name_pattern)
+
+    total = {"domain": None, "users": 0, "aliases": 0}
+    with Session(engine) as session:
+        for entry in session.execute(stmt.execution_options(yield_per=chunk_size)):
+            total["users"] += entry.users
+            total["aliases"] += entry.aliases
+            yield entry._asdict()
+    yield total
+
+
+# names of the files written by export_maps
+EXPORT_FILES = {
+    "domains": "virtual_mailbox_domains",
+    "users": "virtual_mailbox_maps",
+    "aliases": "virtual_alias_maps",
+    "passwd": "passwd",
+}
+
+
+def _dovecot_password(password):
+    # hashes created by doveadm_pw_hash carry no scheme prefix, Dovecot expects it in a passwd-file
+    return password if password.startswith('{') else f'{{SHA512-CRYPT}}{password}'
+
+
+def export_maps(engine, directory, chunk_size=1000):
+    """Export virtual domains, users and aliases to Postfix lookup table source files and a Dovecot passwd-file
+
+    Following files are written to the output directory:
+
+    * ``virtual_mailbox_domains``: ``domain OK`` line per virtual domain
+    * ``virtual_mailbox_maps``: ``email OK`` line per virtual user
+    * ``virtual_alias_maps``: ``source destination[,destination...]`` line per alias source address
+    * ``passwd``: ``email:{SHA512-CRYPT}hash::::::`` line per virtual user
+
+    Entries are streamed from the database in chunks, sorted by their keys, so that memory use does not
+    depend on the number of entries. All files are replaced atomically once all of them were written.
+    The passwd-file is only readable by its owner.
+
+    :param engine: SQLAlchemy Engine object
+    :type engine: object
+    :param directory: path to the output directory
+    :type directory: str
+    :param chunk_size: number of entries fetched from the database at once
+    :type chunk_size: int
+    :returns: dictionary with the number of lines written per file
+    :rtype: dict"""
+
+    def rows(session, stmt):
+        return session.execute(stmt.execution_options(yield_per=chunk_size))
+
+    counts = dict.fromkeys(EXPORT_FILES.values(), 0)
+    with contextlib.ExitStack() as stack, Session(engine) as session:
+        files = {
+            key: stack.enter_context(
+                utils.atomic_write(os.path.join(directory, name), mode=0o600 if key == "passwd" else 0o644)
+            )
+            for key, name in EXPORT_FILES.items()
+        }
+
+        for (name,) in rows(session, select(models.VirtualDomain.name).order_by(models.VirtualDomain.name)):
+            files["domains"].write(f"{name} OK\n")
+            counts[EXPORT_FILES["domains"]] += 1
+
+        stmt = select(models.VirtualUser.email, models.VirtualUser.password).order_by(models.VirtualUser.email)
+        for email, password in rows(session, stmt):
+            files["users"].write(f"{email} OK\n")
+            files["passwd"].write(f"{email}:{_dovecot_password(password)}::::::\n")
+            counts[EXPORT_FILES["users"]] += 1
+            counts[EXPORT_FILES["passwd"]] += 1
+
+        # rows are sorted by source, so that all destinations of a source are adjacent
+        stmt = select(models.VirtualAlias.source, models.VirtualAlias.destination).order_by(
+            models.VirtualAlias.source, models.VirtualAlias.destination
+        )
+        for source, group in itertools.groupby(rows(session, stmt), key=lambda row: row.source):
+            files["aliases"].write(f"{source} {','.join(row.destination for row in group)}\n")
+            counts[EXPORT_FILES["aliases"]] += 1
+
+    return counts
+
+
+def _validate_entry(entry):
+    """Validate an entry to be imported
+
+    :returns: A tuple: entry type, dictionary with column values
+    :rtype: tuple(str, dict)
+    :raises ValueError: if the entry is malformed or contains invalid values"""
+
+    if entry is None:
+        raise ValueError("malformed entry")
+
+    entry_type = entry.get('type')
+    if entry_type == 'domain':
+        domain_name = entry.get('name') or ''
+        if not utils.is_valid_domain_name(domain_name):
+            raise ValueError(f"invalid domain name '{domain_name}'")
+        return entry_type, {"name": domain_name}
+    elif entry_type == 'user':
+        user_email = entry.get('email') or ''
+        if not utils.is_valid_email(user_email):
+            raise ValueError(f"invalid email address '{user_email}'")
+        user_password = entry.get('password')
+        if not user_password:
+            raise ValueError(f"missing password for user '{user_email}'")
+        return entry_type, {"email": user_email, "password": user_password}
+    elif entry_type == 'alias':
+        source, destination = entry.get('source') or '', entry.get('destination') or ''
+        if not (utils.is_valid_email(source, True) and utils.is_valid_email(destination, True)):
+            raise ValueError(f"invalid email address in alias '{source}' -> '{destination}'")
+        return entry_type, {"source": source, "destination": destination}
+    else:
+        raise ValueError(f"unknown entry type '{entry_type}'")
+
+
+@_retrying
+def _import_batch(engine, batch, password_hashes=None):
+    """Write a batch of validated entries in a single transaction
+
+    Entries added by a concurrent writer after they were looked up make the ``INSERT`` fail on the
+    unique index, the batch is then written again and these entries are skipped as existing entries.
+
+    :param password_hashes: dictionary mapping user emails to password hashes computed in advance,
+                            passwords are hashed on demand if not set
+    :returns: A tuple: number of added entries, number of skipped entries, list of errors
+    :rtype: tuple(int, int, list)"""
+
+    try:
+        return _write_batch(engine, batch, password_hashes)
+    except IntegrityError:
+        return _write_batch(engine, batch, password_hashes)
+
+
+def _write_batch(engine, batch, password_hashes):
+    added, skipped, errors = 0, 0, []
+
+    domains = {}
+    users = {}
+    aliases = {}
+    for line_number, entry_type, values in batch:
+        if entry_type == 'domain':
+            key, entries = values["name"], domains
+        elif entry_type == 'user':
+            key, entries = values["email"], users
+        else:
+            key, entries = (values["source"], values["destination"]), aliases
+        if key in entries:
+            skipped += 1
+        else:
+            entries[key] = line_number, values
+
     with Session(engine) as session:
-        results = session.scalars(
-            delete(models.VirtualAlias)
-            .where(
-                and_(
-                    models.VirtualAlias.source.startswith(source_email_pattern),
-                    models.VirtualAlias.destination.startswith(destination_email_pattern),
-                )
+        # add virtual domains
+        if domains:
+            existing = set(
+                session.scalars(select(models.VirtualDomain.name).where(models.VirtualDomain.name.in_(domains)))
+            )
+            skipped += len(existing)
+            new_domains = [values for name, (_, values) in domains.items() if name not in existing]
+            if new_domains:
+                session.execute(insert(models.VirtualDomain).values(new_domains))
+                added += len(new_domains)
+
+        # resolve domain IDs for users and aliases
+        domain_names = {email.split('@', 1)[1] for email in users}
+        domain_names.update(source.split('@', 1)[1] for source, _ in aliases)
+        domain_ids = {}
+        if domain_names:
+            domain_ids = dict(
+                session.execute(
+                    select(models.VirtualDomain.name, models.VirtualDomain.id).where(
+                        models.VirtualDomain.name.in_(domain_names)
+                    )
+                ).all()
+            )
+
+        # add virtual users
+        if users:
+            existing = set(session.scalars(select(models.VirtualUser.email).where(models.VirtualUser.email.in_(users))))
+            skipped += len(existing)
+            new_users = []
+            for email, (line_number, values) in users.items():
+                if email in existing:
+                    continue
+                _, email_domain = email.split('@', 1)
+                if email_domain not in domain_ids:
+                    errors.append((line_number, f"domain {email_domain} can not be used"))
+                    continue
+                if password_hashes is not None:
+                    password_hash = password_hashes[email]
+                else:
+                    with profiling.phase("hash"):
+                        password_hash = utils.doveadm_pw_hash(values["password"])
+                new_users.append({"domain_id": domain_ids[email_domain], "email": email, "password": password_hash})
+            if new_users:
+                session.execute(insert(models.VirtualUser).values(new_users))
+                added += len(new_users)
+
+        # add virtual aliases
+        if aliases:
+            existing = set(
+                session.execute(
+                    select(models.VirtualAlias.source, models.VirtualAlias.destination).where(
+                        models.VirtualAlias.source.in_({source for source, _ in aliases})
+                    )
+                ).all()
             )
-            .returning(models.VirtualAlias)
-        ).all()
+            new_aliases = []
+            for (source, destination), (line_number, values) in aliases.items():
+                if (source, destination) in existing:
+                    skipped += 1
+                    continue
+                _, source_domain = source.split('@', 1)
+                if source_domain not in domain_ids:
+                    errors.append((line_number, f"domain {source_domain} can not be used"))
+                    continue
+                new_aliases.append({"domain_id": domain_ids[source_domain], **values})
+            if new_aliases:
+                session.execute(insert(models.VirtualAlias).values(new_aliases))
+                added += len(new_aliases)
 
-        results = _asdicts(results)
+        _commit(session)  # write changes to the database
 
-        session.commit()  # write changes to the database
+    return added, skipped, errors
 
-        return results
+
+def _import_batches(entries, batch_size):
+    """Validate entries and group them into batches
+
+    :returns: generator yielding tuples: number of processed entries, list of valid entries, list of errors
+    :rtype: generator"""
+
+    batch, errors, processed = [], [], 0
+    for line_number, entry in entries:
+        processed += 1
+        try:
+            batch.append((line_number, *_validate_entry(entry)))
+        except ValueError as e:
+            errors.append((line_number, str(e)))
+
+        if len(batch) >= batch_size:
+            yield processed, batch, errors
+            batch, errors, processed = [], [], 0
+
+    if processed:
+        yield processed, batch, errors
+
+
+def import_entries(engine, entries, batch_size=500, workers=1):
+    """Import virtual domains, users and aliases in batches
+
+    Each entry is a dictionary with a ``type`` field and the fields required by the entry type:
+
+    * ``domain``: ``name``
+    * ``user``: ``email``, ``password`` (clear-text password)
+    * ``alias``: ``source``, ``destination``
+
+    Entries are validated, accumulated into batches and each batch is written using multi-row
+    ``INSERT`` statements in a single transaction. Entries that already exist are skipped.
+    Domains are added before users and aliases within the same batch.
+
+    With more than one worker, user passwords are hashed in a pool of worker processes and
+    the hashing of the next batch overlaps with writing the current batch to the database.
+
+    :param engine: SQLAlchemy Engine object
+    :type engine: object
+    :param entries: iterable of tuples: line number, dictionary with entry fields (or None for malformed entries)
+    :type entries: iterable
+    :param batch_size: maximum number of entries written in one transaction
+    :type batch_size: int
+    :param workers: number of worker processes for password hashing (number of CPUs if None)
+    :type workers: int
+    :returns: generator yielding a dictionary for every batch with the number of ``processed``, ``added``
+              and ``skipped`` entries and a list of ``errors``: tuples (line number, error message)
+    :rtype: generator"""
+
+    def _write(processed, batch, errors, emails=None, password_hashes=None):
+        if password_hashes is not None:
+            # wait for the hashing to complete
+            with profiling.phase("hash"):
+                password_hashes = dict(zip(emails, password_hashes))
+        added, skipped, batch_errors = _import_batch(engine, batch, password_hashes) if batch else (0, 0, [])
+        return {"processed": processed, "added": added, "skipped": skipped, "errors": errors + batch_errors}
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for processed, batch, errors in _import_batches(entries, batch_size):
+            yield _write(processed, batch, errors)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending = None
+        for processed, batch, errors in _import_batches(entries, batch_size):
+            users = {values["email"]: values["password"] for _, entry_type, values in batch if entry_type == 'user'}
+            # submit hashing of this batch before writing the previous one
+            hashes = utils.doveadm_pw_hash_many(users.values(), workers, executor=executor)
+            if pending is not None:
+                yield _write(*pending)
+            pending = processed, batch, errors, list(users), hashes
+        if pending is not None:
+            yield _write(*pending)
+
+
+# entry types of a desired state and the keys listing them
+STATE_KEYS = {"domain": "domains", "user": "users", "alias": "aliases"}
+
+
+def _desired_state(state):
+    """Validate a desired state
+
+    :returns: A tuple: set of domain names, dictionary mapping user emails to a tuple
+              (clear-text password, password hash), set of (source, destination) tuples
+    :rtype: tuple(set, dict, set)
+    :raises ValueError: if an entry is malformed, contains invalid values or uses a domain
+                        not listed in the desired state"""
+
+    domains, users, aliases = set(), {}, set()
+    for entry_type, key in STATE_KEYS.items():
+        for position, entry in enumerate(state.get(key) or [], 1):
+            if entry_type == 'domain' and isinstance(entry, str):
+                entry = {"name": entry}
+            try:
+                if not isinstance(entry, dict):
+                    raise ValueError("malformed entry")
+                entry = dict(entry, type=entry_type)
+                password_hash = entry.get('password_hash') if entry_type == 'user' else None
+                if password_hash:
+                    # the password is only needed when the user is created, the hash is used as is
+                    entry.setdefault('password', password_hash)
+                _, values = _validate_entry(entry)
+
+                if entry_type == 'domain':
+                    domains.add(values["name"])
+                    continue
+                email_domain = (values["email"] if entry_type == 'user' else values["source"]).split('@', 1)[1]
+                if email_domain not in domains:
+                    raise ValueError(f"domain {email_domain} is not listed in '{STATE_KEYS['domain']}'")
+                if entry_type == 'user':
+                    users[values["email"]] = (values["password"], password_hash)
+                else:
+                    aliases.add((values["source"], values["destination"]))
+            except ValueError as e:
+                raise ValueError(f"entry {position} of '{key}': {str(e)}") from None
+    return domains, users, aliases
+
+
+def plan_sync(engine, state, chunk_size=1000):
+    """Compute the changes bringing the database to a desired state
+
+    The desired state is a dictionary with optional ``domains``, ``users`` and ``aliases`` lists:
+
+    * domains are domain names (or dictionaries with a ``name`` field)
+    * users are dictionaries with ``email`` and ``password`` (clear-text password) or
+      ``password_hash`` fields, the password of an existing user is only updated if
+      ``password_hash`` is given and differs from the stored hash
+    * aliases are dictionaries with ``source`` and ``destination`` fields
+
+    The keys of the desired state are held in hash sets and the current entries are streamed
+    from the database and looked up one by one, so that only the differences are kept in memory.
+    Entries missing from the desired state are deleted, the domains of all users and aliases must
+    be listed in the desired state.
+
+    :param engine: SQLAlchemy Engine object
+    :type engine: object
+    :param state: dictionary with the desired state
+    :type state: dict
+    :param chunk_size: number of entries fetched from the database at once
+    :type chunk_size: int
+    :returns: dictionary with ``add``, ``update`` and ``delete`` dictionaries listing the entries
+              per entry type: 'domain', 'user' and 'alias'
+    :rtype: dict
+    :raises ValueError: if the desired state is invalid"""
+
+    domains, users, aliases = _desired_state(state)
+    missing_domains, missing_users, missing_aliases = set(domains), set(users), set(aliases)
+    plan = {
+        "add": {"domain": [], "user": [], "alias": []},
+        "update": {"user": []},
+        "delete": {"domain": [], "user": [], "alias": []},
+    }
+
+    with Session(engine) as session:
+        stmt = select(models.VirtualDomain.id, models.VirtualDomain.name).order_by(models.VirtualDomain.name)
+        for entry in session.execute(stmt.execution_options(yield_per=chunk_size)):
+            if entry.name in domains:
+                missing_domains.discard(entry.name)
+            else:
+                plan["delete"]["domain"].append(entry._asdict())
+
+        stmt = select(models.VirtualUser.id, models.VirtualUser.email, models.VirtualUser.password).order_by(
+            models.VirtualUser.email
+        )
+        for entry in session.execute(stmt.execution_options(yield_per=chunk_size)):
+            if entry.email not in users:
+                plan["delete"]["user"].append({"id": entry.id, "email": entry.email})
+                continue
+            missing_users.discard(entry.email)
+            _, password_hash = users[entry.email]
+            if password_hash and password_hash != entry.password:
+                plan["update"]["user"].append({"id": entry.id, "email": entry.email, "password": password_hash})
+
+        stmt = select(models.VirtualAlias.id, models.VirtualAlias.source, models.VirtualAlias.destination).order_by(
+            models.VirtualAlias.source, models.VirtualAlias.destination
+        )
+        for entry in session.execute(stmt.execution_options(yield_per=chunk_size)):
+            if (entry.source, entry.destination) in aliases:
+                missing_aliases.discard((entry.source, entry.destination))
+            else:
+                plan["delete"]["alias"].append(entry._asdict())
+
+    plan["add"]["domain"] = [{"name": name} for name in sorted(missing_domains)]
+    plan["add"]["user"] = [
+        {"email": email, "password": users[email][0], "password_hash": users[email][1]}
+        for email in sorted(missing_users)
+    ]
+    plan["add"]["alias"] = [
+        {"source": source, "destination": destination} for source, destination in sorted(missing_aliases)
+    ]
+    return plan
+
+
+def _sync_deletions(plan, batch_size):
+    """Group the entries deleted by a sync plan into batches, aliases and users before their domains
+
+    :returns: generator yielding tuples: model class, list of at most `batch_size` ids
+    :rtype: generator"""
+
+    for entry_type, model in [
+        ("alias", models.VirtualAlias),
+        ("user", models.VirtualUser),
+        ("domain", models.VirtualDomain),
+    ]:
+        ids = [entry["id"] for entry in plan["delete"][entry_type]]
+        for start in range(0, len(ids), batch_size):
+            yield model, ids[start : start + batch_size]
+
+
+def _sync_batches(plan, batch_size):
+    """Group the entries added by a sync plan into import batches, domains before users and aliases
+
+    :returns: list of tuples: batch of validated entries, dictionary mapping user emails to
+              password hashes given in the plan, dictionary mapping the other user emails to
+              clear-text passwords to hash
+    :rtype: list"""
+
+    additions = [
+        (position, entry_type, entry)
+        for entry_type in STATE_KEYS
+        for position, entry in enumerate(plan["add"][entry_type], 1)
+    ]
+    batches = []
+    for start in range(0, len(additions), batch_size):
+        batch, password_hashes = [], {}
+        for position, entry_type, entry in additions[start : start + batch_size]:
+            if entry_type == 'user':
+                if entry.get("password_hash"):
+                    password_hashes[entry["email"]] = entry["password_hash"]
+                entry = {"email": entry["email"], "password": entry["password"]}
+            batch.append((position, entry_type, entry))
+        clear = {
+            entry["email"]: entry["password"]
+            for _, entry_type, entry in batch
+            if entry_type == 'user' and entry["email"] not in password_hashes
+        }
+        batches.append((batch, password_hashes, clear))
+    return batches
+
+
+def _sync_updates(plan, batch_size):
+    """Group the password updates of a sync plan into batches
+
+    :returns: generator yielding lists of at most `batch_size` dictionaries with ``id`` and ``password``
+    :rtype: generator"""
+
+    updates = [{"id": entry["id"], "password": entry["password"]} for entry in plan["update"]["user"]]
+    for start in range(0, len(updates), batch_size):
+        yield updates[start : start + batch_size]
+
+
+@_retrying
+def _update_users(engine, values):
+    with Session(engine) as session:
+        # bulk UPDATE by primary key, executed as a single executemany statement
+        session.execute(update(models.VirtualUser), values)
+        _commit(session)
+
+
+def sync(engine, plan, batch_size=500, workers=1):
+    """Apply the changes computed by :func:`plan_sync` in batches
+
+    Aliases, users and domains are deleted first, then domains, users and aliases are added and
+    finally the passwords of users are updated. Every batch of at most `batch_size` entries is
+    written in its own transaction. Passwords of added users without a password hash are hashed
+    in a pool of `workers` worker processes, the hashing of the next batch overlaps with writing
+    the current batch to the database.
+
+    :param engine: SQLAlchemy Engine object
+    :type engine: object
+    :param plan: dictionary with the changes returned by :func:`plan_sync`
+    :type plan: dict
+    :param batch_size: maximum number of entries written in one transaction
+    :type batch_size: int
+    :param workers: number of worker processes for password hashing (number of CPUs if None)
+    :type workers: int
+    :returns: dictionary with the number of ``added``, ``updated`` and ``deleted`` entries and
+              a list of ``errors`` for entries that could not be added
+    :rtype: dict"""
+
+    result = {"added": 0, "updated": 0, "deleted": 0, "errors": []}
+
+    for model, ids in _sync_deletions(plan, batch_size):
+        result["deleted"] += _delete_ids(engine, model, ids)
+
+    batches = _sync_batches(plan, batch_size)
+
+    def _write(batch, password_hashes, emails, hashes):
+        # wait for the hashing to complete
+        with profiling.phase("hash"):
+            password_hashes.update(zip(emails, hashes))
+        added, _, errors = _import_batch(engine, batch, password_hashes)
+        result["added"] += added
+        result["errors"] += [message for _, message in errors]
+
+    workers = workers or os.cpu_count() or 1
+    parallel = workers > 1 and any(clear for _, _, clear in batches)
+    with concurrent.futures.ProcessPoolExecutor(workers) if parallel else contextlib.nullcontext() as executor:
+        pending = None
+        for batch, password_hashes, clear in batches:
+            # submit hashing of this batch before writing the previous one, hashes are computed
+            # right away without an executor
+            with profiling.phase("hash"):
+                hashes = utils.doveadm_pw_hash_many(clear.values(), workers, executor=executor)
+            if pending is not None:
+                _write(*pending)
+            pending = batch, password_hashes, list(clear), hashes
+        if pending is not None:
+            _write(*pending)
+
+    for values in _sync_updates(plan, batch_size):
+        _update_users(engine, values)
+        result["updated"] += len(values)
+
+    return result
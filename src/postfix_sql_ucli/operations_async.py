@@ -0,0 +1,370 @@
+"""Asynchronous variants of the functions of :mod:`postfix_sql_ucli.operations` module
+
+Every function takes a SQLAlchemy AsyncEngine created by ``sqlalchemy.ext.asyncio.create_async_engine``
+with an asyncio driver, e.g. ``sqlite+aiosqlite://``, ``postgresql+asyncpg://`` or ``mysql+aiomysql://``,
+instead of an Engine and otherwise accepts the same arguments. SQLAlchemy's asyncio extension requires
+the ``greenlet`` package, install the ``async`` extra to get it.
+
+Statements are executed by the synchronous implementation on an AsyncConnection (see
+``AsyncConnection.run_sync``), so that the event loop runs other tasks while a statement waits for the
+database. Generators are replaced by asynchronous generators streaming entries from a server-side
+cursor. Passwords are hashed in an executor (the default executor of the event loop if not given), so
+that hashing does not block the event loop either. Transactions failing on transient errors are run
+again after waiting with ``asyncio.sleep`` as configured by the ``retry`` execution option of the engine.
+"""
+
+import asyncio
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models, operations, retry, utils
+
+
+async def _run(engine, function, *args, **kwargs):
+    # functions of operations writing in their own transaction are retried here, so that the backoff
+    # does not block the event loop, retries nested in the function are disabled for the same reason
+    policy = engine.get_execution_options().get("retry")
+    unwrapped = getattr(function, "__wrapped__", None)
+    delays = policy.delays() if policy is not None and unwrapped is not None else iter(())
+    while True:
+        try:
+            async with engine.connect() as connection:
+                await connection.execution_options(retry=None)
+                # the operation commits its own transactions, commit statements executed outside of a session too
+                result = await connection.run_sync(unwrapped or function, *args, **kwargs)
+                await connection.commit()
+            return result
+        except Exception as e:
+            delay = next(delays, None)
+            if delay is None or not retry.is_transient(e):
+                raise
+        policy.retries += 1
+        await asyncio.sleep(delay)
+
+
+async def _hash(passwords, executor=None):
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*[loop.run_in_executor(executor, utils.doveadm_pw_hash, p) for p in passwords])
+
+
+async def _stream(engine, stmt, chunk_size, scalars=True):
+    async with AsyncSession(engine) as session:
+        stmt = stmt.execution_options(yield_per=chunk_size)
+        result = await (session.stream_scalars(stmt) if scalars else session.stream(stmt))
+        async for entry in result:
+            yield dict(entry) if scalars else entry._asdict()
+
+
+async def _delete_chunks(engine, model, criteria, key_columns, chunk_size, pause=0, returning=False):
+    after = None
+    while True:
+        keys = []
+        chunk = await _run(
+            engine, operations._delete_chunk, model, criteria, key_columns, chunk_size, after, returning, keys
+        )
+        if not keys:
+            return
+        after = tuple(keys[-1][1:])
+        yield chunk
+        if pause:
+            await asyncio.sleep(pause)
+
+
+async def reset_database(engine):
+    """Reset the exisitng Postfix database, see :func:`postfix_sql_ucli.operations.reset_database`"""
+
+    await _run(engine, operations.reset_database)
+
+
+async def add_domain(engine, domain_name):
+    """Add a new virtual domain, see :func:`postfix_sql_ucli.operations.add_domain`"""
+
+    return await _run(engine, operations.add_domain, domain_name)
+
+
+async def search_domains(engine, domain_name_pattern, exact=False, limit=None, after=None):
+    """Search virtual domains, see :func:`postfix_sql_ucli.operations.search_domains`"""
+
+    return await _run(engine, operations.search_domains, domain_name_pattern, exact, limit=limit, after=after)
+
+
+async def iter_domains(engine, domain_name_pattern, exact=False, chunk_size=1000, limit=None, after=None):
+    """Iterate over virtual domains, see :func:`postfix_sql_ucli.operations.iter_domains`
+
+    :returns: asynchronous generator yielding entries in the database
+    :rtype: async_generator"""
+
+    async for entry in _stream(engine, operations._domains_query(domain_name_pattern, exact, limit, after), chunk_size):
+        yield entry
+
+
+async def delete_domain(engine, domain_name, chunk_size=1000, pause=0):
+    """Delete a virtual domain with all its virtual users and aliases in chunks,
+    see :func:`postfix_sql_ucli.operations.delete_domain`
+
+    :returns: asynchronous generator yielding dictionaries with the number of entries deleted per chunk
+    :rtype: async_generator"""
+
+    async with AsyncSession(engine) as session:
+        domain_id = await session.scalar(
+            select(models.VirtualDomain.id).where(models.VirtualDomain.name == domain_name)
+        )
+    if domain_id is None:
+        return
+
+    for model, key in [(models.VirtualAlias, "aliases"), (models.VirtualUser, "users")]:
+        async for count in _delete_chunks(engine, model, model.domain_id == domain_id, [model.id], chunk_size, pause):
+            yield {"users": 0, "aliases": 0, "domains": 0, key: count}
+
+    yield {
+        "users": 0,
+        "aliases": 0,
+        "domains": await _run(engine, operations._delete_ids, models.VirtualDomain, [domain_id]),
+    }
+
+
+async def add_user(engine, user_email, user_password, domain_id=None, executor=None):
+    """Add a new virtual user, see :func:`postfix_sql_ucli.operations.add_user`
+
+    :param executor: executor to hash the password in, the default executor of the event loop if not set
+    :type executor: concurrent.futures.Executor"""
+
+    rejected = await _run(engine, operations._reject_user, user_email, domain_id)
+    if rejected is not None:
+        return rejected
+    (user_password_hash,) = await _hash([user_password], executor)
+    return await _run(engine, operations._add_user, user_email, user_password_hash, domain_id)
+
+
+async def search_users(engine, user_email_pattern, exact=False, domain_name=None, limit=None, after=None):
+    """Search virtual users, see :func:`postfix_sql_ucli.operations.search_users`"""
+
+    return await _run(
+        engine, operations.search_users, user_email_pattern, exact, domain_name=domain_name, limit=limit, after=after
+    )
+
+
+async def iter_users(
+    engine, user_email_pattern, exact=False, chunk_size=1000, domain_name=None, limit=None, after=None
+):
+    """Iterate over virtual users, see :func:`postfix_sql_ucli.operations.iter_users`
+
+    :returns: asynchronous generator yielding entries in the database
+    :rtype: async_generator"""
+
+    stmt = operations._users_query(user_email_pattern, exact, domain_name, limit, after)
+    async for entry in _stream(engine, stmt, chunk_size):
+        yield entry
+
+
+async def delete_user(engine, user_email_pattern, prefix=False, chunk_size=1000, pause=0, count_only=False):
+    """Delete virtual users in chunks, see :func:`postfix_sql_ucli.operations.delete_user`"""
+
+    if count_only:
+        criteria = operations._user_criteria(user_email_pattern, prefix)
+        key_columns = [models.VirtualUser.email]
+        return sum([
+            count
+            async for count in _delete_chunks(engine, models.VirtualUser, criteria, key_columns, chunk_size, pause)
+        ])
+    return [entry async for entry in iter_delete_users(engine, user_email_pattern, prefix, chunk_size, pause)]
+
+
+async def iter_delete_users(engine, user_email_pattern, prefix=False, chunk_size=1000, pause=0):
+    """Delete virtual users in chunks and yield the deleted entries after every committed chunk,
+    see :func:`postfix_sql_ucli.operations.iter_delete_users`
+
+    :returns: asynchronous generator yielding deleted entries as dictionaries
+    :rtype: async_generator"""
+
+    criteria = operations._user_criteria(user_email_pattern, prefix)
+    async for chunk in _delete_chunks(
+        engine, models.VirtualUser, criteria, [models.VirtualUser.email], chunk_size, pause, returning=True
+    ):
+        for entry in chunk:
+            yield entry
+
+
+async def add_alias(engine, source_email, destination_email, domain_id=None):
+    """Add a new virtual alias, see :func:`postfix_sql_ucli.operations.add_alias`"""
+
+    return await _run(engine, operations.add_alias, source_email, destination_email, domain_id)
+
+
+async def search_aliases(
+    engine, source_email_pattern, destination_email_pattern, exact=False, domain_name=None, limit=None, after=None
+):
+    """Search virtual aliases, see :func:`postfix_sql_ucli.operations.search_aliases`"""
+
+    return await _run(
+        engine,
+        operations.search_aliases,
+        source_email_pattern,
+        destination_email_pattern,
+        exact,
+        domain_name=domain_name,
+        limit=limit,
+        after=after,
+    )
+
+
+async def iter_aliases(
+    engine,
+    source_email_pattern,
+    destination_email_pattern,
+    exact=False,
+    chunk_size=1000,
+    domain_name=None,
+    limit=None,
+    after=None,
+):
+    """Iterate over virtual aliases, see :func:`postfix_sql_ucli.operations.iter_aliases`
+
+    :returns: asynchronous generator yielding entries in the database
+    :rtype: async_generator"""
+
+    stmt = operations._aliases_query(source_email_pattern, destination_email_pattern, exact, domain_name, limit, after)
+    async for entry in _stream(engine, stmt, chunk_size):
+        yield entry
+
+
+async def reverse_aliases(engine, destination_email):
+    """Find virtual aliases forwarding to an address, see :func:`postfix_sql_ucli.operations.reverse_aliases`"""
+
+    return await _run(engine, operations.reverse_aliases, destination_email)
+
+
+async def iter_reverse_aliases(engine, destination_email, chunk_size=1000):
+    """Iterate over virtual aliases forwarding to an address,
+    see :func:`postfix_sql_ucli.operations.iter_reverse_aliases`
+
+    :returns: asynchronous generator yielding entries with source and destination fields
+    :rtype: async_generator"""
+
+    async for entry in _stream(engine, operations._reverse_aliases_query(destination_email), chunk_size, False):
+        yield entry
+
+
+async def delete_aliases(
+    engine, source_email_pattern, destination_email_pattern, chunk_size=1000, pause=0, count_only=False
+):
+    """Delete virtual aliases in chunks, see :func:`postfix_sql_ucli.operations.delete_aliases`"""
+
+    if count_only:
+        criteria = operations._alias_criteria(source_email_pattern, destination_email_pattern)
+        key_columns = [models.VirtualAlias.source, models.VirtualAlias.destination]
+        return sum([
+            count
+            async for count in _delete_chunks(engine, models.VirtualAlias, criteria, key_columns, chunk_size, pause)
+        ])
+    return [
+        entry
+        async for entry in iter_delete_aliases(
+            engine, source_email_pattern, destination_email_pattern, chunk_size, pause
+        )
+    ]
+
+
+async def iter_delete_aliases(engine, source_email_pattern, destination_email_pattern, chunk_size=1000, pause=0):
+    """Delete virtual aliases in chunks and yield the deleted entries after every committed chunk,
+    see :func:`postfix_sql_ucli.operations.iter_delete_aliases`
+
+    :returns: asynchronous generator yielding deleted entries as dictionaries
+    :rtype: async_generator"""
+
+    criteria = operations._alias_criteria(source_email_pattern, destination_email_pattern)
+    key_columns = [models.VirtualAlias.source, models.VirtualAlias.destination]
+    async for chunk in _delete_chunks(
+        engine, models.VirtualAlias, criteria, key_columns, chunk_size, pause, returning=True
+    ):
+        for entry in chunk:
+            yield entry
+
+
+async def stats(engine, domain_name_pattern=''):
+    """Count virtual users and aliases per virtual domain, see :func:`postfix_sql_ucli.operations.stats`"""
+
+    return await _run(engine, operations.stats, domain_name_pattern)
+
+
+async def iter_stats(engine, domain_name_pattern='', chunk_size=1000):
+    """Iterate over virtual user and alias counts per virtual domain,
+    see :func:`postfix_sql_ucli.operations.iter_stats`
+
+    :returns: asynchronous generator yielding entries with domain, users and aliases fields sorted by domain name,
+              followed by an entry with the totals and domain field set to None
+    :rtype: async_generator"""
+
+    total = {"domain": None, "users": 0, "aliases": 0}
+    async for entry in _stream(engine, operations._stats_query(domain_name_pattern), chunk_size, False):
+        total["users"] += entry["users"]
+        total["aliases"] += entry["aliases"]
+        yield entry
+    yield total
+
+
+async def export_maps(engine, directory, chunk_size=1000):
+    """Export virtual domains, users and aliases to Postfix lookup table source files and a Dovecot
+    passwd-file, see :func:`postfix_sql_ucli.operations.export_maps`
+
+    The files are written on the event loop between the fetches of the chunks."""
+
+    return await _run(engine, operations.export_maps, directory, chunk_size)
+
+
+async def import_entries(engine, entries, batch_size=500, executor=None):
+    """Import virtual domains, users and aliases in batches, see :func:`postfix_sql_ucli.operations.import_entries`
+
+    The passwords of each batch are hashed concurrently in the executor before the batch is written.
+
+    :param executor: executor to hash the passwords in, the default executor of the event loop if not set
+    :type executor: concurrent.futures.Executor
+    :returns: asynchronous generator yielding a dictionary for every batch with the number of ``processed``,
+              ``added`` and ``skipped`` entries and a list of ``errors``: tuples (line number, error message)
+    :rtype: async_generator"""
+
+    for processed, batch, errors in operations._import_batches(entries, batch_size):
+        users = {values["email"]: values["password"] for _, entry_type, values in batch if entry_type == 'user'}
+        password_hashes = dict(zip(users, await _hash(users.values(), executor)))
+        added, skipped, batch_errors = (
+            await _run(engine, operations._import_batch, batch, password_hashes) if batch else (0, 0, [])
+        )
+        yield {"processed": processed, "added": added, "skipped": skipped, "errors": errors + batch_errors}
+
+
+async def plan_sync(engine, state, chunk_size=1000):
+    """Compute the changes bringing the database to a desired state, see :func:`postfix_sql_ucli.operations.plan_sync`"""
+
+    return await _run(engine, operations.plan_sync, state, chunk_size)
+
+
+async def sync(engine, plan, batch_size=500, executor=None):
+    """Apply the changes computed by :func:`plan_sync` in batches, see :func:`postfix_sql_ucli.operations.sync`
+
+    The passwords of added users without a password hash are hashed concurrently in the executor first.
+
+    :param executor: executor to hash the passwords in, the default executor of the event loop if not set
+    :type executor: concurrent.futures.Executor"""
+
+    result = {"added": 0, "updated": 0, "deleted": 0, "errors": []}
+
+    for model, ids in operations._sync_deletions(plan, batch_size):
+        result["deleted"] += await _run(engine, operations._delete_ids, model, ids)
+
+    batches = operations._sync_batches(plan, batch_size)
+    emails = [email for _, _, clear in batches for email in clear]
+    hashed = dict(
+        zip(emails, await _hash([password for _, _, clear in batches for password in clear.values()], executor))
+    )
+    for batch, password_hashes, clear in batches:
+        password_hashes.update((email, hashed[email]) for email in clear)
+        added, _, errors = await _run(engine, operations._import_batch, batch, password_hashes)
+        result["added"] += added
+        result["errors"] += [message for _, message in errors]
+
+    for values in operations._sync_updates(plan, batch_size):
+        await _run(engine, operations._update_users, values)
+        result["updated"] += len(values)
+
+    return result
@@ -0,0 +1,229 @@
+"""Instrumentation of command line invocations reporting where the time went
+
+Modules only needed by an enabled profiler, including SQLAlchemy, are imported on first use.
+"""
+
+import contextlib
+import contextvars
+import functools
+import sys
+import time
+
+# profiler of the running command, set while the profiler is entered
+_active = contextvars.ContextVar("profiler", default=None)
+
+
+def phase(name):
+    """Context manager timing the block as the given phase of the running profiler
+
+    Code that is not handed the profiler, e.g. the operations hashing passwords, reports its phases
+    here. The block is not timed if no enabled profiler is running in the current context."""
+
+    profiler = _active.get()
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.phase(name)
+
+
+class _CountingCursor:
+    """DBAPI cursor proxy counting the fetched rows"""
+
+    def __init__(self, cursor, profiler):
+        self._cursor = cursor
+        self._profiler = profiler
+
+    def _count(self, rows):
+        self._profiler.rows += len(rows)
+        return rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._profiler.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        return self._count(self._cursor.fetchmany(*args, **kwargs))
+
+    def fetchall(self):
+        return self._count(self._cursor.fetchall())
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._profiler.rows += 1
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class Profiler:
+    """Collect wall time per phase, SQL statement count and time, fetched rows and peak memory
+
+    Time is attributed to the innermost running phase, so that the phase times add up to the total
+    time. Statements are timed as the ``query`` phase and connecting to the database as the
+    ``connect`` phase of instrumented engines. A disabled profiler does nothing.
+
+    :param enabled: whether the profiler collects anything
+    :type enabled: bool
+    :param output: path to a file the cProfile statistics are written to or None
+    :type output: str"""
+
+    def __init__(self, enabled=True, output=None):
+        self.enabled = enabled or output is not None
+        self.output = output
+        self.phases = {}
+        self.statements = 0
+        self.statement_time = 0
+        self.rows = 0
+        self._stack = []
+        self.total = None
+        self._started = None
+        self._cprofile = None
+        self._token = None
+
+    def start(self, name):
+        """Start a phase, the running phase is paused until the phase is stopped"""
+
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self._stack:
+            self._account(now)
+        self._stack.append([name, now])
+
+    def stop(self):
+        """Stop the innermost running phase and resume the phase it paused
+
+        :returns: seconds since the phase was started or resumed
+        :rtype: float"""
+
+        if not self._stack:
+            return 0
+        now = time.perf_counter()
+        seconds = self._account(now)
+        self._stack.pop()
+        if self._stack:
+            self._stack[-1][1] = now
+        return seconds
+
+    def _account(self, now):
+        name, since = self._stack[-1]
+        self.phases[name] = self.phases.get(name, 0) + now - since
+        return now - since
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager timing the block as the given phase"""
+
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def timed(self, name, function):
+        """Wrap a function, so that its calls are timed as the given phase"""
+
+        if not self.enabled:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    def instrument(self, engine):
+        """Listen to the connection and cursor events of a SQLAlchemy engine
+
+        :param engine: SQLAlchemy Engine object
+        :type engine: object
+        :returns: the engine
+        :rtype: object"""
+
+        if not self.enabled:
+            return engine
+
+        from sqlalchemy import event
+
+        @event.listens_for(engine, "do_connect")
+        def do_connect(dialect, connection_record, cargs, cparams):
+            with self.phase("connect"):
+                return dialect.connect(*cargs, **cparams)
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+            self.statements += 1
+            self.start("query")
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+            # no phase is started while a statement runs
+            self.statement_time += self.stop()
+            if context is not None:
+                # rows are fetched from the cursor of the execution context
+                context.cursor = _CountingCursor(context.cursor, self)
+
+        @event.listens_for(engine, "handle_error")
+        def handle_error(exception_context):
+            if self._stack and self._stack[-1][0] == "query":
+                self.stop()
+
+        return engine
+
+    def __enter__(self):
+        if self.enabled:
+            if self.output is not None:
+                import cProfile
+
+                self._cprofile = cProfile.Profile()
+                self._cprofile.enable()
+            self._token = _active.set(self)
+            self._started = time.perf_counter()
+            self.start("operation")
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.enabled:
+            return
+        while self._stack:
+            self.stop()
+        self.total = time.perf_counter() - self._started
+        _active.reset(self._token)
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.output)
+
+    def peak_memory(self):
+        """Peak resident set size of the process in kilobytes or None if not available"""
+
+        try:
+            import resource
+        except ImportError:  # not available on Windows
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes elsewhere
+        return peak // 1024 if sys.platform == 'darwin' else peak
+
+    def report(self):
+        """Profiling report of the finished profiler
+
+        :returns: dictionary with the ``total`` wall time and the wall time of the ``phases`` in seconds,
+                  the number and time of executed SQL ``statements``, the number of fetched ``rows``
+                  and the ``peak_memory_kb`` of the process
+        :rtype: dict"""
+
+        return {
+            "total": round(self.total, 6),
+            "phases": {name: round(seconds, 6) for name, seconds in self.phases.items()},
+            "statements": {"count": self.statements, "time": round(self.statement_time, 6)},
+            "rows": self.rows,
+            "peak_memory_kb": self.peak_memory(),
+        }
+
+    def report_json(self):
+        import json
+
+        return json.dumps(self.report())
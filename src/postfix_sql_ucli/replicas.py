@@ -0,0 +1,76 @@
+"""Routing of read-only operations to read replicas of the database
+
+Only the standard library is imported here, so that the command line start-up does not load SQLAlchemy.
+"""
+
+import itertools
+import random
+
+# functions of the operations module that only read from the database; plan_sync is not listed,
+# as the changes it plans must be computed from the current state of the primary
+READ_OPERATIONS = frozenset({
+    "search_domains",
+    "iter_domains",
+    "search_users",
+    "iter_users",
+    "search_aliases",
+    "iter_aliases",
+    "reverse_aliases",
+    "iter_reverse_aliases",
+    "stats",
+    "iter_stats",
+    "export_maps",
+})
+
+
+class ReplicaRouter:
+    """Select the engine an operation runs on: read-only operations run on the replicas in round-robin
+    order, all other operations on the primary
+
+    A replica that can not be connected to is skipped, read-only operations run on the primary if no
+    replica can be connected to. Replicas may lag behind the primary, so an entry written by an
+    operation may not be found by a following search right away.
+
+    :param primary: SQLAlchemy Engine or Connection object of the primary database
+    :type primary: object
+    :param replicas: list of SQLAlchemy Engine objects of the read replicas
+    :type replicas: list
+    :param start: index of the first replica to use, random by default so that the load of
+                  short-lived processes is spread over all replicas
+    :type start: int"""
+
+    def __init__(self, primary, replicas=(), start=None):
+        self.primary = primary
+        self.replicas = list(replicas)
+        if start is None:
+            start = random.randrange(len(self.replicas)) if self.replicas else 0
+        self._counter = itertools.count(start)
+
+    def engine(self, operation):
+        """Engine to run an operation on
+
+        :param operation: name of the function in :mod:`postfix_sql_ucli.operations` module
+        :type operation: str
+        :returns: SQLAlchemy Engine or Connection object
+        :rtype: object"""
+
+        if operation not in READ_OPERATIONS or not self.replicas:
+            return self.primary
+        # next() of itertools.count is atomic, the router can be shared by threads
+        first = next(self._counter)
+        for n in range(len(self.replicas)):
+            replica = self.replicas[(first + n) % len(self.replicas)]
+            if self._reachable(replica):
+                return replica
+        return self.primary
+
+    @staticmethod
+    def _reachable(engine):
+        from sqlalchemy.exc import DBAPIError
+
+        try:
+            # the connection is returned to the pool and reused by the operation
+            engine.connect().close()
+        except DBAPIError:
+            return False
+        return True
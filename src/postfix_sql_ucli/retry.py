@@ -0,0 +1,110 @@
+"""Retry of transactions failing on transient database errors
+
+Only the standard library is imported here, so that the command line start-up does not load SQLAlchemy.
+"""
+
+import random
+import time
+
+# SQLSTATE codes of PostgreSQL errors resolved by running the transaction again:
+# serialization_failure, deadlock_detected and lock_not_available
+POSTGRESQL_TRANSIENT = {"40001", "40P01", "55P03"}
+
+# MySQL error codes: ER_LOCK_DEADLOCK and ER_LOCK_WAIT_TIMEOUT
+MYSQL_TRANSIENT = {1213, 1205}
+
+# SQLite reports a busy database once the busy timeout expired
+SQLITE_TRANSIENT = ("database is locked", "database table is locked")
+
+
+def is_transient(error):
+    """Check whether an exception is a serialization failure, a deadlock or a lock timeout
+
+    :param error: exception raised by SQLAlchemy
+    :type error: Exception
+    :returns: True if running the transaction again may succeed
+    :rtype: bool"""
+
+    from sqlalchemy.exc import DBAPIError
+
+    if not isinstance(error, DBAPIError) or error.orig is None:
+        return False
+    orig = error.orig
+
+    # psycopg2 and psycopg report the SQLSTATE as `pgcode` or `sqlstate`, asyncpg as `sqlstate`
+    sqlstate = getattr(orig, "pgcode", None) or getattr(orig, "sqlstate", None)
+    if sqlstate is not None:
+        return sqlstate in POSTGRESQL_TRANSIENT
+
+    # MySQL drivers pass the error code as the first argument
+    if orig.args and isinstance(orig.args[0], int):
+        return orig.args[0] in MYSQL_TRANSIENT
+
+    message = str(orig).lower()
+    return any(text in message for text in SQLITE_TRANSIENT)
+
+
+class RetryPolicy:
+    """Run a function writing in a transaction again when it fails on a transient error
+
+    The n-th retry waits a random time between zero and ``backoff * 2 ** (n - 1)`` seconds capped at
+    `max_backoff` ("full jitter"), so that writers colliding on the same rows do not collide again.
+
+    :param attempts: maximum number of attempts, 1 disables retries
+    :type attempts: int
+    :param backoff: seconds to wait before the first retry
+    :type backoff: float
+    :param max_backoff: maximum number of seconds to wait before a retry
+    :type max_backoff: float
+    :param jitter: randomize the waiting time, wait the full time otherwise
+    :type jitter: bool"""
+
+    def __init__(self, attempts=5, backoff=0.05, max_backoff=2, jitter=True):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retries = 0
+
+    def delay(self, retry):
+        """Number of seconds to wait before the given retry (starting from 1)"""
+
+        delay = min(self.max_backoff, self.backoff * 2 ** (retry - 1))
+        return random.uniform(0, delay) if self.jitter else delay
+
+    def delays(self):
+        """Iterate over the number of seconds to wait before every retry
+
+        Callers that can not block while waiting, e.g. coroutines, run the attempts themselves:
+        an attempt failing on a transient error is followed by the next delay and a retry, the
+        error is raised once the delays are exhausted.
+
+        :returns: generator yielding ``attempts - 1`` delays
+        :rtype: generator"""
+
+        for retry in range(1, self.attempts):
+            yield self.delay(retry)
+
+    def call(self, function, *args, **kwargs):
+        """Call a function, call it again after a delay if it raises a transient error
+
+        The function must roll back its transaction before raising, e.g. by using a ``Session``
+        in a ``with`` block. The last error is raised once all attempts failed.
+
+        :returns: result of the function"""
+
+        for delay in self.delays():
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+            self.retries += 1
+            time.sleep(delay)
+        return function(*args, **kwargs)
+
+    def __repr__(self):
+        return (
+            f"RetryPolicy(attempts={self.attempts}, backoff={self.backoff}, "
+            f"max_backoff={self.max_backoff}, jitter={self.jitter})"
+        )
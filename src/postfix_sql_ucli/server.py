@@ -0,0 +1,231 @@
+import json
+import os
+import socket
+import socketserver
+import sys
+import time
+
+from .replicas import ReplicaRouter
+
+# operations available to clients of the daemon, generators are streamed row by row
+REMOTE_OPERATIONS = {
+    "reset_database",
+    "add_domain",
+    "search_domains",
+    "iter_domains",
+    "add_user",
+    "search_users",
+    "iter_users",
+    "delete_user",
+    "iter_delete_users",
+    "add_alias",
+    "search_aliases",
+    "iter_aliases",
+    "reverse_aliases",
+    "iter_reverse_aliases",
+    "delete_aliases",
+    "iter_delete_aliases",
+    "stats",
+    "iter_stats",
+}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Handle JSON Lines requests from a single client connection
+
+    Every request is a JSON object on a single line with following fields:
+
+    * ``id``: optional request identifier copied to the responses
+    * ``method``: name of a function in :mod:`postfix_sql_ucli.operations`
+    * ``params``: list of positional arguments to the function following the `engine` argument
+    * ``kwargs``: optional object with keyword arguments to the function
+
+    The response is a JSON object with the same ``id``, the ``result`` of the function call or
+    an ``error`` message and the request processing time in ``elapsed_ms``. Functions returning
+    generators produce one ``{"id": ..., "row": ...}`` line per entry before the final response."""
+
+    def handle(self):
+        from . import operations
+
+        for line in self.rfile:
+            if not line.strip():
+                continue
+
+            start = time.perf_counter()
+            request_id, method = None, None
+            try:
+                request = json.loads(line)
+                request_id, method, params = request.get("id"), request.get("method"), request.get("params", [])
+                if method not in REMOTE_OPERATIONS:
+                    raise ValueError(f"unsupported method '{method}'")
+
+                engine = self.server.router.engine(method)
+                result = getattr(operations, method)(engine, *params, **request.get("kwargs", {}))
+                if method.startswith("iter_"):
+                    count = 0
+                    for row in result:
+                        self._send({"id": request_id, "row": row})
+                        count += 1
+                    result = count
+                response = {"id": request_id, "result": result}
+            except Exception as e:
+                response = {"id": request_id, "error": str(e)}
+
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            response["elapsed_ms"] = round(elapsed_ms, 3)
+            self.server.log(f"{method} {'failed' if 'error' in response else 'ok'} in {elapsed_ms:.1f} ms")
+            self._send(response)
+
+    def _send(self, response):
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server handling every client connection in a separate thread
+
+    Read-only operations are served by the `replicas` in round-robin order if given."""
+
+    daemon_threads = True
+
+    def __init__(self, engine, socket_path, log=None, replicas=()):
+        self.engine = engine
+        self.router = ReplicaRouter(engine, replicas)
+        self.log = log or (lambda message: print(message, file=sys.stderr, flush=True))
+        super().__init__(socket_path, RequestHandler)
+        # the daemon has full access to the database, restrict the socket to the owner
+        os.chmod(socket_path, 0o600)
+
+
+def is_running(socket_path):
+    """Check if a daemon accepts connections on a Unix socket
+
+    :param socket_path: path to the Unix socket
+    :type socket_path: str
+    :returns: True if a connection could be established, False otherwise
+    :rtype: bool"""
+
+    if not socket_path or not os.path.exists(socket_path):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+    except OSError:
+        return False
+    return True
+
+
+def serve(engine, socket_path, log=None, replicas=()):
+    """Serve requests on a Unix socket until interrupted
+
+    :param engine: SQLAlchemy Engine object shared by all client connections
+    :type engine: object
+    :param socket_path: path to the Unix socket
+    :type socket_path: str
+    :param log: function called with a message for every processed request
+    :type log: callable
+    :param replicas: SQLAlchemy Engine objects of read replicas serving read-only operations
+    :type replicas: list"""
+
+    if is_running(socket_path):
+        raise OSError(f"another daemon is already serving on '{socket_path}'")
+    if os.path.exists(socket_path):
+        # remove a stale socket left by a daemon that did not shut down cleanly
+        os.unlink(socket_path)
+
+    # open the first pooled connection before accepting requests
+    with engine.connect():
+        pass
+
+    with Server(engine, socket_path, log, replicas) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
+
+
+class Client:
+    """Client forwarding calls of :mod:`postfix_sql_ucli.operations` functions to a daemon
+
+    Functions are available as methods with the same signature except for the `engine` argument,
+    e.g. ``client.add_domain("example.com")``."""
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._socket = None
+        self._stream = None
+        self._request_id = 0
+
+    def __getattr__(self, name):
+        if name not in REMOTE_OPERATIONS:
+            raise AttributeError(name)
+
+        if name.startswith("iter_"):
+            return lambda *params, **kwargs: self.iter_call(name, *params, **kwargs)
+        return lambda *params, **kwargs: self.call(name, *params, **kwargs)
+
+    def _request(self, method, params, kwargs):
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(self.socket_path)
+            self._stream = self._socket.makefile('rwb')
+
+        self._request_id += 1
+        request = {"id": self._request_id, "method": method, "params": list(params)}
+        if kwargs:
+            request["kwargs"] = kwargs
+        self._stream.write(json.dumps(request).encode('utf-8') + b'\n')
+        self._stream.flush()
+
+        for line in self._stream:
+            response = json.loads(line)
+            if "error" in response:
+                raise RuntimeError(response["error"])
+            yield response
+            if "result" in response:
+                return
+        raise ConnectionError(f"daemon on '{self.socket_path}' closed the connection")
+
+    def call(self, method, *params, **kwargs):
+        """Call an operation on the daemon
+
+        :param method: name of the function in :mod:`postfix_sql_ucli.operations`
+        :type method: str
+        :returns: result of the function call
+        :raises RuntimeError: if the operation failed on the daemon"""
+
+        for response in self._request(method, params, kwargs):
+            if "result" in response:
+                return response["result"]
+
+    def iter_call(self, method, *params, **kwargs):
+        """Call an operation returning a generator on the daemon and iterate over the streamed entries
+
+        :param method: name of the function in :mod:`postfix_sql_ucli.operations`
+        :type method: str
+        :returns: generator yielding entries
+        :rtype: generator
+        :raises RuntimeError: if the operation failed on the daemon"""
+
+        responses = self._request(method, params, kwargs)
+        try:
+            for response in responses:
+                if "row" in response:
+                    yield response["row"]
+        finally:
+            # read the remaining entries if the iteration was stopped early
+            for _ in responses:
+                pass
+
+    def close(self):
+        if self._socket is not None:
+            self._stream.close()
+            self._socket.close()
+            self._socket = self._stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
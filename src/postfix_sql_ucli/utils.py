@@ -1,8 +1,15 @@
+import contextlib
+import csv
+import functools
 import getpass
+import gzip
+import io
+import itertools
+import json
+import os
 import re
-
-import passlib.hash
-import yaml
+import sys
+import tempfile
 
 email_account_regexp = re.compile(r'^[a-zA-Z0-9._%+-]+$')
 domain_regexp = re.compile(r'^[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
@@ -39,6 +46,13 @@ def is_valid_domain_name(domain_name):
     return domain_regexp.match(domain_name) is not None
 
 
+@functools.lru_cache(maxsize=1)
+def _doveadm_pw_handler():
+    import passlib.hash
+
+    return passlib.hash.sha512_crypt.using(rounds=5000)
+
+
 def doveadm_pw_hash(password, salt=None):
     """Encrypt a clear-text password string as doveadm password hash
 
@@ -46,7 +60,43 @@ def doveadm_pw_hash(password, salt=None):
     :type password: str
     :returns: string containg the corresponding password hash
     :rtype: str"""
-    return passlib.hash.sha512_crypt.using(salt=salt, rounds=5000).hash(password)
+    if salt is None:
+        return _doveadm_pw_handler().hash(password)
+    return _doveadm_pw_handler().using(salt=salt).hash(password)
+
+
+def doveadm_pw_hash_many(passwords, workers=None, executor=None):
+    """Encrypt clear-text password strings as doveadm password hashes using a pool of worker processes
+
+    :param passwords: list of strings containing the clear-text passwords
+    :type passwords: list
+    :param workers: number of worker processes (number of CPUs by default),
+                    if set to 1 passwords are hashed in the current process
+    :type workers: int
+    :param executor: existing executor to submit the hashing to, the hashing is submitted right away and
+                     an iterator yielding the hashes once they are computed is returned, so that the caller
+                     can do other work in the meantime; `workers` only sets the chunk size if set
+    :type executor: concurrent.futures.Executor
+    :returns: list of strings containg the corresponding password hashes (iterator if `executor` is set)
+    :rtype: list"""
+    passwords = list(passwords)
+    workers = workers or os.cpu_count() or 1
+
+    if executor is not None:
+        return executor.map(doveadm_pw_hash, passwords, chunksize=_hash_chunksize(passwords, workers))
+
+    if workers == 1 or len(passwords) < 2:
+        return [doveadm_pw_hash(password) for password in passwords]
+
+    import concurrent.futures
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(doveadm_pw_hash, passwords, chunksize=_hash_chunksize(passwords, workers)))
+
+
+def _hash_chunksize(passwords, workers):
+    # a few chunks per worker to balance the load while limiting inter-process communication
+    return max(1, len(passwords) // (4 * workers))
 
 
 def get_password(max_count=-1):
@@ -76,36 +126,406 @@ def get_password(max_count=-1):
     return password_input
 
 
+# options of the `engine` configuration section and their accepted types
+engine_option_types = {
+    'poolclass': str,
+    'pool_size': int,
+    'max_overflow': int,
+    'pool_timeout': (int, float),
+    'pool_recycle': int,
+    'pool_pre_ping': bool,
+    'pool_use_lifo': bool,
+    'pool_reset_on_return': (str, type(None)),
+    'isolation_level': str,
+    'connect_args': dict,
+    'execution_options': dict,
+    'executemany_mode': str,
+    'insertmanyvalues_page_size': int,
+    'use_insertmanyvalues': bool,
+}
+
+# options of the `retry` configuration section and their accepted types
+retry_option_types = {
+    'attempts': int,
+    'backoff': (int, float),
+    'max_backoff': (int, float),
+    'jitter': bool,
+}
+
+pool_classes = ('QueuePool', 'NullPool', 'StaticPool', 'SingletonThreadPool', 'AssertionPool')
+
+
 def load_database_config(config_file_path):
     """Load database configuration from a YAML file with following format:
 
     :: code_block::yaml
        database:
+         url: str # full SQLAlchemy database URL, replaces all the fields below
          name: str # database name or file path
          type: str # database type, see https://docs.sqlalchemy.org/en/20/dialects/index.html
          host: str # database host
          port: str # database port
          user: str # database user
          password: str # database password
+       replicas: # optional, read replicas used by read-only operations
+         - url: str # full SQLAlchemy database URL or the fields of the database object
+       engine: # optional, arguments passed to sqlalchemy.create_engine for the database and the replicas
+         poolclass: str # QueuePool, NullPool, StaticPool, SingletonThreadPool or AssertionPool
+         pool_size: int # number of connections kept open in the pool
+         max_overflow: int # number of connections opened above pool_size
+         pool_timeout: float # seconds to wait for a connection from the pool
+         pool_recycle: int # seconds after which a connection is replaced
+         pool_pre_ping: bool # test connections for liveness when checked out
+         pool_use_lifo: bool # reuse the most recently returned connection first
+         pool_reset_on_return: str # rollback, commit or null
+         isolation_level: str # e.g. READ COMMITTED, SERIALIZABLE or AUTOCOMMIT
+         connect_args: dict # arguments passed to the DBAPI connect() function
+         execution_options: dict # default execution options of all connections
+         executemany_mode: str # psycopg2 only: values_only, values_plus_batch
+         insertmanyvalues_page_size: int # rows per multi-row INSERT statement
+         use_insertmanyvalues: bool # batch executemany INSERT statements with RETURNING
+       retry: # optional, retry of transactions failing on serialization failures, deadlocks and lock timeouts
+         attempts: int # maximum number of attempts, 1 disables retries (default: 5)
+         backoff: float # seconds to wait before the first retry, doubled for every retry (default: 0.05)
+         max_backoff: float # maximum number of seconds to wait before a retry (default: 2)
+         jitter: bool # wait a random time up to the backoff (default: true)
 
     :param config_file_path: path to configuration file
     :type config_file_path: str
-    :returns: dictionary with databse configuration
+    :returns: dictionary with databse configuration, the validated `engine` and `retry` sections
+              are available under the 'engine' and 'retry' keys (empty dictionaries if not present),
+              the list of `replicas` under the 'replicas' key (empty list if not present)
     :rtype: dict"""
 
+    import yaml
+
     # Load the YAML configuration file
     with open(config_file_path, 'r', encoding='utf-8') as config_file:
         config = yaml.safe_load(config_file)
 
-    if (
-        config is None
-        or ('database' not in config)
-        or any(x not in config["database"] for x in ['name', 'type'])
+    if not isinstance(config, dict) or not _is_database(config.get('database')):
+        raise ValueError("required object 'database' with all required fields not found")
+
+    replicas = config.get('replicas') or []
+    if not isinstance(replicas, list):
+        raise ValueError("object 'replicas' must be a list of databases")
+    for n, replica in enumerate(replicas, 1):
+        if not _is_database(replica):
+            raise ValueError(f"replica {n} does not have all required fields of a database")
+
+    engine_config = config.get('engine') or {}
+    if not isinstance(engine_config, dict):
+        raise ValueError("object 'engine' must be a mapping of engine options")
+
+    for option, value in engine_config.items():
+        if option not in engine_option_types:
+            raise ValueError(f"unsupported engine option '{option}'")
+        # bool is a subclass of int, do not accept it where a number is expected
+        if not isinstance(value, engine_option_types[option]) or (
+            isinstance(value, bool) and engine_option_types[option] is not bool
+        ):
+            raise ValueError(f"invalid value for engine option '{option}': {value!r}")
+
+    if engine_config.get('poolclass', 'QueuePool') not in pool_classes:
+        raise ValueError(f"unsupported pool class '{engine_config['poolclass']}'")
+
+    retry_config = config.get('retry') or {}
+    if not isinstance(retry_config, dict):
+        raise ValueError("object 'retry' must be a mapping of retry options")
+
+    for option, value in retry_config.items():
+        if option not in retry_option_types:
+            raise ValueError(f"unsupported retry option '{option}'")
+        if (
+            not isinstance(value, retry_option_types[option])
+            or (isinstance(value, bool) and retry_option_types[option] is not bool)
+            or (option == 'attempts' and value < 1)
+            or (retry_option_types[option] is not bool and value < 0)
+        ):
+            raise ValueError(f"invalid value for retry option '{option}': {value!r}")
+
+    return dict(config["database"], engine=engine_config, retry=retry_config, replicas=replicas)
+
+
+def _is_database(database):
+    # a database is given by a URL or by all the fields the URL is constructed from
+    return isinstance(database, dict) and (
+        'url' in database
         or (
-            not config["database"]["type"].startswith('sqlite')
-            and any(x not in config["database"] for x in ['user', 'password', 'host', 'port'])
+            all(x in database for x in ['name', 'type'])
+            and (
+                database['type'].startswith('sqlite')
+                or all(x in database for x in ['user', 'password', 'host', 'port'])
+            )
         )
-    ):
-        raise ValueError("required object 'database' with all required fields not found")
+    )
+
+
+def database_url(db_config):
+    """Construct the database URL from the database configuration
+
+    :param db_config: dictionary with database configuration as returned by :func:`load_database_config`
+    :type db_config: dict
+    :returns: string containing the SQLAlchemy database URL
+    :rtype: str"""
+
+    if 'url' in db_config:
+        return db_config['url']
+
+    db_type = db_config['type']
+    if not db_type.startswith('sqlite'):
+        db_user = db_config['user']
+        db_password = db_config['password']
+        db_host = db_config['host']
+        db_port = db_config['port']
+        db_server = f'{db_user}:{db_password}@{db_host}:{db_port}'
+    else:
+        db_server = ''
+
+    db_name = db_config['name']
+
+    return f'{db_type}://{db_server}/{db_name}'
+
+
+def engine_options(db_config):
+    """Convert the `engine` configuration section into keyword arguments of `sqlalchemy.create_engine`
+
+    The :class:`postfix_sql_ucli.retry.RetryPolicy` configured by the `retry` section is passed
+    in the ``retry`` execution option if the configuration has a `retry` key.
+
+    :param db_config: dictionary with database configuration as returned by :func:`load_database_config`
+    :type db_config: dict
+    :returns: dictionary with keyword arguments
+    :rtype: dict"""
+
+    options = dict(db_config.get('engine') or {})
+    if 'poolclass' in options:
+        import sqlalchemy.pool
+
+        options['poolclass'] = getattr(sqlalchemy.pool, options['poolclass'])
+    if 'retry' in db_config:
+        from .retry import RetryPolicy
+
+        options['execution_options'] = dict(
+            options.get('execution_options') or {}, retry=RetryPolicy(**db_config['retry'])
+        )
+    return options
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode=0o644):
+    """Open a text file for writing that replaces the file at the given path only once fully written
+
+    Content is written to a temporary file in the same directory, which is flushed to disk and renamed
+    over the target path on exit, so that readers never see a partially written file. The temporary
+    file is removed and the target path is left untouched if an exception is raised.
+
+    :param path: path to the target file
+    :type path: str
+    :param mode: permission bits of the target file
+    :type mode: int
+    :returns: context manager providing a text stream
+    :rtype: io.TextIOWrapper"""
+
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=f'.{name}.', suffix='.tmp', dir=directory)
+    try:
+        with open(fd, 'w', encoding='utf-8', newline='\n') as stream:
+            yield stream
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+@contextlib.contextmanager
+def open_input(path):
+    """Open a text input stream for reading, transparently decompressing gzip data
+
+    :param path: path to the input file or '-' for standard input
+    :type path: str
+    :returns: context manager providing a text stream, standard input is left open on exit
+    :rtype: io.TextIOWrapper"""
+
+    if path == '-':
+        raw_stream = sys.stdin.buffer
+        if not hasattr(raw_stream, 'peek'):
+            raw_stream = io.BufferedReader(raw_stream)
+    else:
+        raw_stream = open(path, 'rb')
+
+    stream = raw_stream
+    try:
+        # check for the gzip magic number without consuming the input
+        if stream.peek(2)[:2] == b'\x1f\x8b':
+            stream = gzip.GzipFile(fileobj=stream, mode='rb')
+
+        text_stream = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+        try:
+            yield text_stream
+        finally:
+            text_stream.detach()
+    finally:
+        if stream is not raw_stream:
+            stream.close()
+        if path != '-':
+            raw_stream.close()
+
+
+def read_entries(path, input_format=None):
+    """Read entries one by one from a CSV file with a header row, a JSON Lines file or a JSON file
+    containing an array of entries
+
+    JSON Lines and CSV files are streamed, a JSON file is parsed as a whole and its entries are
+    numbered by their position in the array instead of their line number.
+
+    :param path: path to the input file or '-' for standard input
+    :type path: str
+    :param input_format: input file format: 'csv', 'jsonl' or 'json'. If not set, the format is
+                         derived from the file name extension, CSV is used by default.
+    :type input_format: str
+    :returns: generator yielding tuples: line number, dictionary with entry fields
+              (None if the line could not be parsed)
+    :rtype: generator
+    :raises ValueError: if a JSON file can not be parsed or does not contain an array"""
+
+    if input_format is None:
+        name = path[:-3] if path.endswith('.gz') else path
+        if name.endswith('.json'):
+            input_format = 'json'
+        else:
+            input_format = 'jsonl' if name.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+    with open_input(path) as stream:
+        if input_format == 'csv':
+            reader = csv.DictReader(stream)
+            for entry in reader:
+                yield reader.line_num, entry
+        elif input_format == 'jsonl':
+            for line_number, line in enumerate(stream, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    entry = None
+                yield line_number, entry if isinstance(entry, dict) else None
+        elif input_format == 'json':
+            try:
+                entries = json.load(stream)
+            except ValueError as e:
+                raise ValueError(f"invalid JSON input: {str(e)}") from None
+            if not isinstance(entries, list):
+                raise ValueError("JSON input must be an array of entries, use JSON Lines for one entry per line")
+            for position, entry in enumerate(entries, 1):
+                yield position, entry if isinstance(entry, dict) else None
+        else:
+            raise ValueError(f"unsupported input format '{input_format}'")
+
+
+def load_state(path):
+    """Load a desired state of virtual domains, users and aliases from a YAML or JSON file
+    with following format (gzip-compressed files are decompressed transparently):
+
+    :: code_block::yaml
+       domains:
+         - example.com
+       users:
+         - email: user@example.com
+           password: str # clear-text password, hashed when the user is created
+         - email: other@example.com
+           password_hash: str # password hash, stored as is
+       aliases:
+         - source: postmaster@example.com
+           destination: user@example.com
+
+    :param path: path to the input file or '-' for standard input
+    :type path: str
+    :returns: dictionary with 'domains', 'users' and 'aliases' lists
+    :rtype: dict
+    :raises ValueError: if the file can not be parsed or is not a mapping of these lists"""
+
+    name = path[:-3] if path.endswith('.gz') else path
+    with open_input(path) as stream:
+        if name.endswith('.json'):
+            state = json.load(stream)
+        else:
+            import yaml
+
+            try:
+                state = yaml.safe_load(stream)
+            except yaml.YAMLError as e:
+                raise ValueError(f"invalid YAML in '{path}': {str(e)}") from None
+
+    if state is None:
+        state = {}
+    if not isinstance(state, dict):
+        raise ValueError("desired state must be a mapping of 'domains', 'users' and 'aliases' lists")
+    for key, value in state.items():
+        if key not in ('domains', 'users', 'aliases'):
+            raise ValueError(f"unsupported key '{key}' in desired state")
+        if not isinstance(value, list) and value is not None:
+            raise ValueError(f"'{key}' in desired state must be a list")
+    return {key: state.get(key) or [] for key in ('domains', 'users', 'aliases')}
+
+
+def write_entries(entries, output_format, stream, table_sample=100):
+    """Write entries to a text stream one by one as they arrive
+
+    :param entries: iterable of dictionaries with the same keys
+    :type entries: iterable
+    :param output_format: output format: 'json', 'jsonl', 'csv', 'tsv' or 'table'
+    :type output_format: str
+    :param stream: text stream to write to
+    :type stream: io.TextIOBase
+    :param table_sample: number of leading entries used to compute column widths in 'table' format
+    :type table_sample: int
+    :returns: number of entries written
+    :rtype: int"""
+
+    count = 0
+    if output_format == 'jsonl':
+        for entry in entries:
+            stream.write(json.dumps(entry) + '\n')
+            count += 1
+    elif output_format == 'json':
+        stream.write('[')
+        for entry in entries:
+            stream.write((',\n ' if count else '\n ') + json.dumps(entry))
+            count += 1
+        stream.write('\n]\n' if count else ']\n')
+    elif output_format in ('csv', 'tsv'):
+        writer = None
+        for entry in entries:
+            if writer is None:
+                writer = csv.DictWriter(
+                    stream,
+                    fieldnames=list(entry),
+                    delimiter=',' if output_format == 'csv' else '\t',
+                    lineterminator='\n',
+                )
+                writer.writeheader()
+            writer.writerow(entry)
+            count += 1
+    elif output_format == 'table':
+        entries = iter(entries)
+        sample = [entry for _, entry in zip(range(table_sample), entries)]
+        if sample:
+            columns = list(sample[0])
+            widths = [max(len(str(column)), *(len(str(entry[column])) for entry in sample)) for column in columns]
+
+            def write_row(values):
+                stream.write('  '.join(str(value).ljust(width) for value, width in zip(values, widths)).rstrip() + '\n')
+
+            write_row(columns)
+            write_row('-' * width for width in widths)
+            for entry in itertools.chain(sample, entries):
+                write_row(entry[column] for column in columns)
+                count += 1
+    else:
+        raise ValueError(f"unsupported output format '{output_format}'")
 
-    return config["database"]
+    return count
@@ -1,9 +1,16 @@
+import json
+import pstats
+import sqlite3
+import subprocess
+import sys
 import unittest.mock
 
 import pytest
 from click.testing import CliRunner
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
 
-from postfix_sql_ucli import __version__, cli, operations
+from postfix_sql_ucli import __version__, cli, operations, server, utils
 
 
 @pytest.fixture
@@ -46,6 +53,48 @@ def test_cli_reset(runner, monkeypatch):
     assert result.output.strip() == 'reset operation expects no arguments'
 
 
+def test_cli_engine_config(runner, monkeypatch, tmp_path):
+
+    config = tmp_path / "config.yml"
+    config.write_text(
+        "database:\n  url: sqlite:///test.sqlite\nengine:\n  pool_size: 2\n  pool_pre_ping: true\n"
+        "  connect_args:\n    timeout: 5\n"
+    )
+
+    mock_create_engine = unittest.mock.Mock()
+    monkeypatch.setattr(cli, 'create_engine', mock_create_engine)
+    mock_create_engine.return_value = "engine"
+
+    mock_reset_database = unittest.mock.Mock()
+    monkeypatch.setattr(operations, 'reset_database', mock_reset_database)
+
+    result = runner.invoke(cli.main, ['reset', '--force', '--config', str(config)])
+    assert result.exit_code == 0
+    assert not result.exception
+    mock_create_engine.assert_called_with(
+        "sqlite:///test.sqlite",
+        echo=False,
+        pool_size=2,
+        pool_pre_ping=True,
+        connect_args={"timeout": 5},
+        execution_options={"retry": unittest.mock.ANY},
+    )
+    mock_reset_database.assert_called_with("engine")
+
+    mock_create_engine.side_effect = TypeError("invalid argument")
+    result = runner.invoke(cli.main, ['reset', '--force', '--config', str(config)])
+    assert result.exit_code == 1
+    assert result.output.strip() == 'Reset Postfix SQL database\nError creating database engine: invalid argument'
+
+    config.write_text("database:\n  url: sqlite:///test.sqlite\nengine:\n  pool_size: many\n")
+    result = runner.invoke(cli.main, ['reset', '--force', '--config', str(config)])
+    assert result.exit_code == 1
+    assert result.output.strip() == (
+        "Reset Postfix SQL database\n"
+        f"Error opening configuration file '{config}': invalid value for engine option 'pool_size': 'many'"
+    )
+
+
 def test_cli_add_domain(runner, monkeypatch):
 
     mock_create_engine = unittest.mock.Mock()
@@ -71,6 +120,14 @@ def test_cli_add_domain(runner, monkeypatch):
     )
     mock_add_domain.assert_called_with("engine", "other.org")
 
+    mock_add_domain.side_effect = OperationalError("INSERT", {}, sqlite3.OperationalError("database is locked"))
+    result = runner.invoke(cli.main, ['add-domain', '--config', 'tests/postfix-sql-ucli.yml', 'other.org'])
+    assert result.exit_code == 1
+    assert result.output.strip() == (
+        'Adding virtual domain: other.org\nadd-domain operation failed, database is busy: database is locked'
+    )
+    mock_add_domain.side_effect = None
+
     result = runner.invoke(cli.main, ['add-domain', '--config', 'tests/postfix-sql-ucli.yml'])
     assert result.exit_code == 1
     assert result.exception
@@ -82,6 +139,45 @@ def test_cli_add_domain(runner, monkeypatch):
     assert result.output.strip() == "add-domain operation failed: invalid domain name 'invalid'"
 
 
+def test_cli_delete_domain(runner, monkeypatch):
+
+    mock_create_engine = unittest.mock.Mock()
+    monkeypatch.setattr(cli, 'create_engine', mock_create_engine)
+    mock_create_engine.return_value = "engine"
+
+    mock_delete_domain = unittest.mock.Mock()
+    monkeypatch.setattr(operations, 'delete_domain', mock_delete_domain)
+
+    mock_delete_domain.return_value = iter([
+        {"users": 0, "aliases": 2, "domains": 0},
+        {"users": 3, "aliases": 0, "domains": 0},
+        {"users": 0, "aliases": 0, "domains": 1},
+    ])
+    result = runner.invoke(
+        cli.main,
+        ['delete-domain', '--config', 'tests/postfix-sql-ucli.yml', '--batch-size', '3', '--pause', '0.1', 'test.com'],
+    )
+    assert result.exit_code == 0
+    assert not result.exception
+    assert result.output.strip() == (
+        'Deleting virtual domain: test.com\n'
+        'Deleted 2 virtual alias(es) and 0 virtual user(s)\n'
+        'Deleted 2 virtual alias(es) and 3 virtual user(s)\n'
+        'Deleted virtual domain test.com with 3 virtual user(s) and 2 virtual alias(es)'
+    )
+    mock_delete_domain.assert_called_with("engine", "test.com", 3, 0.1)
+
+    mock_delete_domain.return_value = iter([])
+    result = runner.invoke(cli.main, ['delete-domain', '--config', 'tests/postfix-sql-ucli.yml', 'other.org'])
+    assert result.exit_code == 0
+    assert result.output.strip() == 'Deleting virtual domain: other.org\nNo virtual domains deleted'
+    mock_delete_domain.assert_called_with("engine", "other.org", 500, 0)
+
+    result = runner.invoke(cli.main, ['delete-domain', '--config', 'tests/postfix-sql-ucli.yml'])
+    assert result.exit_code == 1
+    assert result.output.strip() == 'delete-domain operation requires exactly one argument: domain name'
+
+
 def test_cli_search_domains(runner, monkeypatch):
 
     mock_create_engine = unittest.mock.Mock()
@@ -221,14 +317,14 @@ def test_cli_delete_user(runner, monkeypatch):
         == """Deleting virtual user account: user@test.com
 Deleted virtual user account(s): user@test.com"""
     )
-    mock_delete_user.assert_called_with("engine", "user@test.com")
+    mock_delete_user.assert_called_with("engine", "user@test.com", chunk_size=500, pause=0)
 
     mock_delete_user.return_value = []
     result = runner.invoke(cli.main, ['delete-user', '--config', 'tests/postfix-sql-ucli.yml', 'user@other.org'])
     assert result.exit_code == 0
     assert not result.exception
     assert result.output.strip() == 'Deleting virtual user account: user@other.org\nNo virtual user accounts deleted'
-    mock_delete_user.assert_called_with("engine", "user@other.org")
+    mock_delete_user.assert_called_with("engine", "user@other.org", chunk_size=500, pause=0)
 
     result = runner.invoke(cli.main, ['delete-user', '--config', 'tests/postfix-sql-ucli.yml'])
     assert result.exit_code == 1
@@ -240,6 +336,45 @@ Deleted virtual user account(s): user@test.com"""
     assert result.exception
     assert result.output.strip() == "delete-user operation failed: invalid email address 'invalid'"
 
+    mock_delete_user.return_value = ["user1@test.com", "user2@test.com"]
+    result = runner.invoke(
+        cli.main, ['delete-user', '--config', 'tests/postfix-sql-ucli.yml', '--prefix', '--batch-size', '10', 'user']
+    )
+    assert result.exit_code == 0
+    assert result.output.strip() == (
+        'Deleting virtual user accounts starting with: user\n'
+        'Deleted virtual user account(s): user1@test.com, user2@test.com'
+    )
+    mock_delete_user.assert_called_with("engine", "user", chunk_size=10, pause=0, prefix=True)
+
+    mock_delete_user.return_value = 2
+    result = runner.invoke(
+        cli.main, ['delete-user', '--config', 'tests/postfix-sql-ucli.yml', '--prefix', '--count-only', 'user']
+    )
+    assert result.exit_code == 0
+    assert result.output.strip() == 'Deleted 2 virtual user account(s)'
+    mock_delete_user.assert_called_with("engine", "user", count_only=True, chunk_size=500, pause=0, prefix=True)
+
+    mock_iter_delete_users = unittest.mock.Mock()
+    monkeypatch.setattr(operations, 'iter_delete_users', mock_iter_delete_users)
+    mock_iter_delete_users.return_value = iter([{"id": 1, "domain_id": 1, "email": "user@test.com"}])
+    result = runner.invoke(
+        cli.main,
+        [
+            'delete-user',
+            '--config',
+            'tests/postfix-sql-ucli.yml',
+            '--format',
+            'jsonl',
+            '--pause',
+            '0.5',
+            'user@test.com',
+        ],
+    )
+    assert result.exit_code == 0
+    assert result.output == '{"id": 1, "domain_id": 1, "email": "user@test.com"}\n'
+    mock_iter_delete_users.assert_called_with("engine", "user@test.com", chunk_size=500, pause=0.5)
+
 
 def test_cli_add_alias(runner, monkeypatch):
 
@@ -374,7 +509,7 @@ def test_cli_delete_aliases(runner, monkeypatch):
         == """Deleting virtual alias(es): @test.com -> @other.org
 Deleted virtual alias(es): aliases"""
     )
-    mock_delete_alias.assert_called_with("engine", '@test.com', '@other.org')
+    mock_delete_alias.assert_called_with("engine", '@test.com', '@other.org', chunk_size=500, pause=0)
 
     mock_delete_alias.return_value = []
     result = runner.invoke(
@@ -385,7 +520,26 @@ Deleted virtual alias(es): aliases"""
     assert (
         result.output.strip() == 'Deleting virtual alias(es): @unknown.org -> @anywhere.org\nNo virtual aliases deleted'
     )
-    mock_delete_alias.assert_called_with("engine", '@unknown.org', '@anywhere.org')
+    mock_delete_alias.assert_called_with("engine", '@unknown.org', '@anywhere.org', chunk_size=500, pause=0)
+
+    mock_delete_alias.return_value = 3
+    result = runner.invoke(
+        cli.main,
+        ['delete-aliases', '--config', 'tests/postfix-sql-ucli.yml', '--count-only', '--batch-size', '2', '@test.com'],
+    )
+    assert result.exit_code == 0
+    assert result.output.strip() == 'Deleted 3 virtual alias(es)'
+    mock_delete_alias.assert_called_with("engine", '@test.com', '', count_only=True, chunk_size=2, pause=0)
+
+    mock_iter_delete_aliases = unittest.mock.Mock()
+    monkeypatch.setattr(operations, 'iter_delete_aliases', mock_iter_delete_aliases)
+    mock_iter_delete_aliases.return_value = iter([{"source": "@test.com", "destination": "user@other.org"}])
+    result = runner.invoke(cli.main, ['delete-aliases', '--config', 'tests/postfix-sql-ucli.yml', '--format', 'csv'])
+    assert result.exit_code == 0
+    assert result.output == 'source,destination\n@test.com,user@other.org\n'
+    mock_iter_delete_aliases.assert_called_with("engine", '', '', chunk_size=500, pause=0)
+
+    mock_delete_alias.return_value = []
 
     result = runner.invoke(
         cli.main, ['delete-aliases', '--config', 'tests/postfix-sql-ucli.yml', 'too', 'many', 'args']
@@ -416,3 +570,583 @@ Deleted virtual alias(es): aliases"""
             == f"""Deleting virtual alias(es): {source} -> {destination}
 No virtual aliases deleted"""
         )
+
+
+def test_cli_sync(runner, monkeypatch):
+
+    mock_create_engine = unittest.mock.Mock()
+    monkeypatch.setattr(cli, 'create_engine', mock_create_engine)
+    mock_create_engine.return_value = "engine"
+
+    mock_plan_sync = unittest.mock.Mock()
+    monkeypatch.setattr(operations, 'plan_sync', mock_plan_sync)
+    mock_sync = unittest.mock.Mock()
+    monkeypatch.setattr(operations, 'sync', mock_sync)
+
+    mock_plan_sync.return_value = {
+        "add": {
+            "domain": [{"name": "new.net"}],
+            "user": [{"email": "user@new.net", "password": "secret", "password_hash": None}],
+            "alias": [],
+        },
+        "update": {"user": [{"id": 3, "email": "user@test.com", "password": "hash"}]},
+        "delete": {"domain": [], "user": [], "alias": [{"id": 1, "source": "@old.org", "destination": "user@old.org"}]},
+    }
+    state = "domains: [new.net]\nusers:\n  - email: user@new.net\n    password: secret\n"
+
+    result = runner.invoke(cli.main, ['sync', '--config', 'tests/postfix-sql-ucli.yml', '--dry-run', '-'], input=state)
+    assert result.exit_code == 0
+    assert not result.exception
+    assert result.output.strip() == (
+        '- alias @old.org -> user@old.org\n'
+        '+ domain new.net\n'
+        '+ user user@new.net\n'
+        '~ user user@test.com\n'
+        'Plan: 2 to add, 1 to update, 1 to delete'
+    )
+    mock_plan_sync.assert_called_with(
+        "engine",
+        {"domains": ["new.net"], "users": [{"email": "user@new.net", "password": "secret"}], "aliases": []},
+    )
+    mock_sync.assert_not_called()
+
+    mock_sync.return_value = {"added": 2, "updated": 1, "deleted": 1, "errors": []}
+    result = runner.invoke(
+        cli.main, ['sync', '--config', 'tests/postfix-sql-ucli.yml', '--batch-size', '10', '-'], input=state
+    )
+    assert result.exit_code == 0
+    lines = result.output.strip().split('\n')
+    assert lines[0] == 'Synchronizing with -: 2 to add, 1 to update, 1 to delete'
+    assert lines[1].startswith('Sync completed in ')
+    assert lines[1].endswith('2 added, 1 updated, 1 deleted')
+    mock_sync.assert_called_with("engine", mock_plan_sync.return_value, 10, 1)
+
+    mock_sync.return_value = {"added": 1, "updated": 1, "deleted": 1, "errors": ["domain new.net can not be used"]}
+    result = runner.invoke(cli.main, ['sync', '--config', 'tests/postfix-sql-ucli.yml', '-'], input=state)
+    assert result.exit_code == 1
+    assert result.output.strip().split('\n')[1] == 'domain new.net can not be used'
+
+    mock_plan_sync.return_value = {
+        "add": {"domain": [], "user": [], "alias": []},
+        "update": {"user": []},
+        "delete": {"domain": [], "user": [], "alias": []},
+    }
+    mock_sync.reset_mock()
+    result = runner.invoke(cli.main, ['sync', '--config', 'tests/postfix-sql-ucli.yml', '-'], input=state)
+    assert result.exit_code == 0
+    assert result.output.strip() == 'Database is in sync with the desired state, nothing to do'
+    mock_sync.assert_not_called()
+
+    mock_plan_sync.side_effect = ValueError("entry 1 of 'domains': invalid domain name 'invalid'")
+    result = runner.invoke(cli.main, ['sync', '--config', 'tests/postfix-sql-ucli.yml', '-'], input=state)
+    assert result.exit_code == 1
+    assert result.output.strip() == "sync operation failed: entry 1 of 'domains': invalid domain name 'invalid'"
+
+    result = runner.invoke(cli.main, ['sync', '--config', 'tests/postfix-sql-ucli.yml'])
+    assert result.exit_code == 1
+    assert (
+        result.output.strip()
+        == "sync operation requires exactly one argument: desired state file path or '-' for standard input"
+    )
+
+
+def test_cli_import(runner, monkeypatch):
+
+    mock_create_engine = unittest.mock.Mock()
+    monkeypatch.setattr(cli, 'create_engine', mock_create_engine)
+    mock_create_engine.return_value = "engine"
+
+    mock_import_entries = unittest.mock.Mock()
+    monkeypatch.setattr(operations, 'import_entries', mock_import_entries)
+
+    mock_import_entries.return_value = [
+        {"processed": 2, "added": 1, "skipped": 1, "errors": []},
+    ]
+    result = runner.invoke(
+        cli.main,
+        ['import', '--config', 'tests/postfix-sql-ucli.yml', '--batch-size', '2', '--workers', '4', '-'],
+        input="type,name\ndomain,test.com\ndomain,other.org\n",
+    )
+    assert result.exit_code == 0
+    assert not result.exception
+    lines = result.output.strip().split('\n')
+    assert lines[0] == 'Importing virtual domains, users and aliases from -'
+    assert lines[1].startswith('Processed 2 entries in ')
+    assert lines[1].endswith('1 added, 1 skipped, 0 failed')
+    args, kwargs = mock_import_entries.call_args
+    assert args[0] == "engine"
+    assert args[2:] == (2, 4)
+
+    mock_import_entries.return_value = [
+        {"processed": 2, "added": 0, "skipped": 0, "errors": [(2, "malformed entry"), (3, "malformed entry")]},
+    ]
+    result = runner.invoke(cli.main, ['import', '--config', 'tests/postfix-sql-ucli.yml', '-'])
+    assert result.exit_code == 1
+    assert result.exception
+    lines = result.output.strip().split('\n')
+    assert lines[1:3] == ['Line 2: malformed entry', 'Line 3: malformed entry']
+    assert lines[3].endswith('0 added, 0 skipped, 2 failed')
+
+    mock_import_entries.side_effect = lambda engine, entries, batch_size, workers: list(entries)
+    result = runner.invoke(cli.main, ['import', '--config', 'tests/postfix-sql-ucli.yml', 'tests/non-existent.csv'])
+    assert result.exit_code == 1
+    assert result.exception
+    assert result.output.strip().split('\n')[-1].startswith('import operation failed: ')
+
+    result = runner.invoke(cli.main, ['import', '--config', 'tests/postfix-sql-ucli.yml'])
+    assert result.exit_code == 1
+    assert result.exception
+    assert (
+        result.output.strip()
+        == "import operation requires exactly one argument: input file path or '-' for standard input"
+    )
+
+
+def test_cli_search_domain_name(runner, monkeypatch):
+
+    mock_create_engine = unittest.mock.Mock()
+    monkeypatch.setattr(cli, 'create_engine', mock_create_engine)
+    mock_create_engine.return_value = "engine"
+
+    mock_search_users = unittest.mock.Mock()
+    monkeypatch.setattr(operations, 'search_users', mock_search_users)
+    mock_search_aliases = unittest.mock.Mock()
+    monkeypatch.setattr(operations, 'search_aliases', mock_search_aliases)
+    mock_iter_users = unittest.mock.Mock()
+    monkeypatch.setattr(operations, 'iter_users', mock_iter_users)
+
+    mock_search_users.return_value = ["user1"]
+    result = runner.invoke(
+        cli.main, ['search-users', '--config', 'tests/postfix-sql-ucli.yml', '--domain', 'test.com', 'user']
+    )
+    assert result.exit_code == 0
+    assert not result.exception
+    assert (
+        result.output.strip()
+        == 'Searching virtual user accounts for user in test.com\nFound virtual user account(s): user1'
+    )
+    mock_search_users.assert_called_with("engine", "user", domain_name="test.com")
+
+    mock_search_aliases.return_value = []
+    result = runner.invoke(
+        cli.main, ['search-aliases', '--config', 'tests/postfix-sql-ucli.yml', '--domain', 'test.com']
+    )
+    assert result.exit_code == 0
+    assert not result.exception
+    assert result.output.strip() == 'Searching virtual aliases for  ->  in test.com\nNo virtual aliases found'
+    mock_search_aliases.assert_called_with("engine", "", "", domain_name="test.com")
+
+    mock_iter_users.return_value = iter([{"id": 1}])
+    result = runner.invoke(
+        cli.main,
+        ['search-users', '--config', 'tests/postfix-sql-ucli.yml', '--domain', 'test.com', '--format', 'jsonl'],
+    )
+    assert result.exit_code == 0
+    assert result.output == '{"id": 1}\n'
+    mock_iter_users.assert_called_with("engine", "", domain_name="test.com")
+
+
+def test_cli_search_pages(runner, monkeypatch):
+
+    mock_create_engine = unittest.mock.Mock()
+    monkeypatch.setattr(cli, 'create_engine', mock_create_engine)
+    mock_create_engine.return_value = "engine"
+
+    mock_search_domains = unittest.mock.Mock()
+    monkeypatch.setattr(operations, 'search_domains', mock_search_domains)
+    mock_search_aliases = unittest.mock.Mock()
+    monkeypatch.setattr(operations, 'search_aliases', mock_search_aliases)
+
+    mock_search_domains.return_value = [{"id": 1, "name": "a.com"}, {"id": 2, "name": "b.com"}]
+    result = runner.invoke(
+        cli.main, ['search-domains', '--config', 'tests/postfix-sql-ucli.yml', '--limit', '2', '--after', 'Z.com']
+    )
+    assert result.exit_code == 0
+    assert not result.exception
+    assert result.output.strip().split('\n')[-1] == "More entries may follow, continue with: --after 'b.com'"
+    mock_search_domains.assert_called_with("engine", "", limit=2, after="Z.com")
+
+    result = runner.invoke(cli.main, ['search-domains', '--config', 'tests/postfix-sql-ucli.yml', '--limit', '3'])
+    assert result.exit_code == 0
+    assert "More entries" not in result.output
+    mock_search_domains.assert_called_with("engine", "", limit=3)
+
+    mock_search_aliases.return_value = [{"source": "info@a.com", "destination": "user@a.com"}]
+    result = runner.invoke(
+        cli.main,
+        ['search-aliases', '--config', 'tests/postfix-sql-ucli.yml', '--limit', '1', '--after', 'admin@a.com,x@a.com'],
+    )
+    assert result.exit_code == 0
+    assert result.output.strip().split('\n')[-1] == (
+        "More entries may follow, continue with: --after 'info@a.com,user@a.com'"
+    )
+    mock_search_aliases.assert_called_with("engine", "", "", limit=1, after=["admin@a.com", "x@a.com"])
+
+    result = runner.invoke(
+        cli.main, ['search-aliases', '--config', 'tests/postfix-sql-ucli.yml', '--after', 'info@a.com']
+    )
+    assert result.exit_code == 0
+    mock_search_aliases.assert_called_with("engine", "", "", after="info@a.com")
+
+    result = runner.invoke(cli.main, ['search-domains', '--config', 'tests/postfix-sql-ucli.yml', '--limit', '0'])
+    assert result.exit_code == 2
+
+
+def test_cli_stats(runner, monkeypatch):
+
+    mock_create_engine = unittest.mock.Mock()
+    monkeypatch.setattr(cli, 'create_engine', mock_create_engine)
+    mock_create_engine.return_value = "engine"
+
+    mock_iter_stats = unittest.mock.Mock()
+    monkeypatch.setattr(operations, 'iter_stats', mock_iter_stats)
+
+    entries = [{"domain": "test.com", "users": 2, "aliases": 10}, {"domain": None, "users": 2, "aliases": 10}]
+
+    mock_iter_stats.return_value = iter(entries)
+    result = runner.invoke(cli.main, ['stats', '--config', 'tests/postfix-sql-ucli.yml'])
+    assert result.exit_code == 0
+    assert not result.exception
+    assert result.output == (
+        'domain    users  aliases\n' '--------  -----  -------\n' 'test.com  2      10\n' '(total)   2      10\n'
+    )
+    mock_iter_stats.assert_called_with("engine", "")
+
+    mock_iter_stats.return_value = iter(entries)
+    result = runner.invoke(cli.main, ['stats', '--config', 'tests/postfix-sql-ucli.yml', '--format', 'csv', 'test'])
+    assert result.exit_code == 0
+    assert result.output == 'domain,users,aliases\ntest.com,2,10\n,2,10\n'
+    mock_iter_stats.assert_called_with("engine", "test")
+
+    result = runner.invoke(cli.main, ['stats', '--config', 'tests/postfix-sql-ucli.yml', 'a', 'b'])
+    assert result.exit_code == 1
+    assert result.output.strip() == 'stats operation expects at most one argument: domain name pattern'
+
+
+def test_cli_reverse_aliases(runner, monkeypatch):
+
+    mock_create_engine = unittest.mock.Mock()
+    monkeypatch.setattr(cli, 'create_engine', mock_create_engine)
+    mock_create_engine.return_value = "engine"
+
+    mock_reverse_aliases = unittest.mock.Mock()
+    monkeypatch.setattr(operations, 'reverse_aliases', mock_reverse_aliases)
+
+    mock_reverse_aliases.return_value = [
+        {"source": "info@test.com", "destination": "user@test.com"},
+        {"source": "sales@test.com", "destination": "user@test.com"},
+    ]
+    result = runner.invoke(cli.main, ['reverse-aliases', '--config', 'tests/postfix-sql-ucli.yml', 'user@test.com'])
+    assert result.exit_code == 0
+    assert not result.exception
+    assert result.output.strip() == (
+        'Searching virtual aliases forwarding to user@test.com\n'
+        'Found virtual alias(es): info@test.com, sales@test.com'
+    )
+    mock_reverse_aliases.assert_called_with("engine", "user@test.com")
+
+    mock_reverse_aliases.return_value = []
+    result = runner.invoke(cli.main, ['reverse-aliases', '--config', 'tests/postfix-sql-ucli.yml', 'other@test.com'])
+    assert result.exit_code == 0
+    assert result.output.strip() == 'Searching virtual aliases forwarding to other@test.com\nNo virtual aliases found'
+
+    result = runner.invoke(cli.main, ['reverse-aliases', '--config', 'tests/postfix-sql-ucli.yml'])
+    assert result.exit_code == 1
+    assert result.output.strip() == 'reverse-aliases operation requires exactly one argument: destination email'
+
+
+def test_cli_search_format(runner, monkeypatch):
+
+    mock_create_engine = unittest.mock.Mock()
+    monkeypatch.setattr(cli, 'create_engine', mock_create_engine)
+    mock_create_engine.return_value = "engine"
+
+    for operation, function, arguments in [
+        ('search-domains', 'iter_domains', ('test',)),
+        ('search-users', 'iter_users', ('user',)),
+        ('search-aliases', 'iter_aliases', ('source', 'destination')),
+        ('reverse-aliases', 'iter_reverse_aliases', ('destination',)),
+    ]:
+        mock_iter = unittest.mock.Mock()
+        monkeypatch.setattr(operations, function, mock_iter)
+        mock_iter.return_value = iter([{"id": 1, "name": "test.com"}])
+
+        result = runner.invoke(
+            cli.main, [operation, '--config', 'tests/postfix-sql-ucli.yml', '--format', 'jsonl', *arguments]
+        )
+        assert result.exit_code == 0
+        assert not result.exception
+        assert result.output == '{"id": 1, "name": "test.com"}\n'
+        mock_iter.assert_called_with("engine", *arguments)
+
+
+def test_cli_export(runner, monkeypatch):
+
+    mock_create_engine = unittest.mock.Mock()
+    monkeypatch.setattr(cli, 'create_engine', mock_create_engine)
+    mock_create_engine.return_value = "engine"
+
+    mock_export_maps = unittest.mock.Mock()
+    monkeypatch.setattr(operations, 'export_maps', mock_export_maps)
+
+    mock_export_maps.return_value = {"virtual_mailbox_domains": 2, "passwd": 3}
+    result = runner.invoke(cli.main, ['export', '--config', 'tests/postfix-sql-ucli.yml', 'maps'])
+    assert result.exit_code == 0
+    assert not result.exception
+    lines = result.output.strip().split('\n')
+    assert lines[:3] == [
+        'Exporting virtual domains, users and aliases to maps',
+        'Wrote 2 entries to virtual_mailbox_domains',
+        'Wrote 3 entries to passwd',
+    ]
+    assert lines[3].startswith('Export completed in ')
+    mock_export_maps.assert_called_with("engine", "maps")
+
+    mock_export_maps.side_effect = FileNotFoundError("No such file or directory")
+    result = runner.invoke(cli.main, ['export', '--config', 'tests/postfix-sql-ucli.yml', 'maps'])
+    assert result.exit_code == 1
+    assert result.output.strip().endswith('export operation failed: No such file or directory')
+
+    result = runner.invoke(cli.main, ['export', '--config', 'tests/postfix-sql-ucli.yml'])
+    assert result.exit_code == 1
+    assert result.output.strip() == 'export operation requires exactly one argument: output directory path'
+
+
+@pytest.mark.parametrize("commit_every", ["1", "2"])
+def test_cli_batch(runner, monkeypatch, tmp_path, commit_every):
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.sqlite'}")
+    monkeypatch.setattr(cli, 'create_engine', unittest.mock.Mock(return_value=engine))
+    monkeypatch.setattr(utils, 'doveadm_pw_hash', unittest.mock.Mock(return_value="hash"))
+
+    script = """# provision test.com
+reset
+add-domain test.com
+add-user user@test.com 'pass word'
+add-user user@unknown.org password
+add-alias alias@test.com user@test.com
+add-domain invalid
+batch nested.txt
+search-users user@
+"""
+    result = runner.invoke(
+        cli.main,
+        ['batch', '--config', 'tests/postfix-sql-ucli.yml', '--force', '--commit-every', commit_every, '-'],
+        input=script,
+    )
+    assert result.exit_code == 1
+    assert result.exception
+    lines = result.output.strip().split('\n')
+    assert lines[-1] == 'Batch completed: 5 operation(s) succeeded, 3 failed'
+    assert 'Line 5: add-user operation failed' in lines
+    assert "add-domain operation failed: invalid domain name 'invalid'" in lines
+    assert 'Line 7: add-domain operation failed' in lines
+    assert "Line 8: unsupported operation 'batch'" in lines
+    assert (
+        "Found virtual user account(s): {'id': 1, 'domain_id': 1, 'email': 'user@test.com', 'password': 'hash'}"
+        in lines
+    )
+    utils.doveadm_pw_hash.assert_any_call('pass word')
+
+    assert [domain["name"] for domain in operations.search_domains(engine, "")] == ["test.com"]
+    assert [alias["source"] for alias in operations.search_aliases(engine, "", "")] == ["alias@test.com"]
+
+    result = runner.invoke(cli.main, ['batch', '--config', 'tests/postfix-sql-ucli.yml', '-'], input="reset\n")
+    assert result.exit_code == 1
+    assert result.output.strip().split('\n') == [
+        'Line 1: reset operation requires --force in a batch',
+        'Batch completed: 0 operation(s) succeeded, 1 failed',
+    ]
+
+    # the line following add-user is not read as the password
+    result = runner.invoke(
+        cli.main,
+        ['batch', '--config', 'tests/postfix-sql-ucli.yml', '-'],
+        input="add-user other@test.com\nadd-domain other.com\nserve\nimport -\nsync --dry-run -\nadd-domain last.com\n",
+    )
+    assert result.exit_code == 1
+    lines = result.output.strip().split('\n')
+    assert lines[0] == 'Line 1: add-user operation requires user email and password in a batch'
+    assert "Line 3: unsupported operation 'serve'" in lines
+    # the lines following import and sync are not read as their input
+    assert 'Line 4: import operation can not read standard input in a batch read from standard input' in lines
+    assert 'Line 5: sync operation can not read standard input in a batch read from standard input' in lines
+    assert lines[-1] == 'Batch completed: 2 operation(s) succeeded, 4 failed'
+    assert [user["email"] for user in operations.search_users(engine, "")] == ["user@test.com"]
+
+    result = runner.invoke(cli.main, ['batch', '--config', 'tests/postfix-sql-ucli.yml'])
+    assert result.exit_code == 1
+    assert result.exception
+    assert (
+        result.output.strip()
+        == "batch operation requires exactly one argument: script file path or '-' for standard input"
+    )
+
+
+def test_cli_batch_commit_failure(runner, monkeypatch, tmp_path):
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.sqlite'}")
+    operations.reset_database(engine)
+    monkeypatch.setattr(cli, 'create_engine', unittest.mock.Mock(return_value=engine))
+    state = {"adding": False, "failed": False}
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # releasing the savepoint of the session adding second.com fails
+        if "second.com" in str(parameters):
+            state["adding"] = True
+        elif state["adding"] and not state["failed"] and statement.startswith("RELEASE SAVEPOINT"):
+            state["failed"] = True
+            raise OperationalError(statement, parameters, sqlite3.OperationalError("database is locked"))
+
+    result = runner.invoke(
+        cli.main,
+        ['batch', '--config', 'tests/postfix-sql-ucli.yml', '-'],
+        input="add-domain first.com\nadd-domain second.com\nadd-domain third.com\n",
+    )
+    assert result.exit_code == 1
+    lines = result.output.strip().split('\n')
+    assert [line for line in lines if line.startswith('Line ')] == [
+        'Line 2: add-domain operation failed: (sqlite3.OperationalError) database is locked'
+    ]
+    assert lines[-1] == 'Batch completed: 2 operation(s) succeeded, 1 failed'
+    # the operations before the failed one are committed with the group
+    assert [domain["name"] for domain in operations.search_domains(engine, "")] == ["first.com", "third.com"]
+    engine.dispose()
+
+
+def test_cli_replicas(runner, tmp_path):
+
+    for name in ["primary", "replica"]:
+        engine = create_engine(f"sqlite:///{tmp_path / name}.sqlite")
+        operations.reset_database(engine)
+        operations.add_domain(engine, f"{name}.com")
+        engine.dispose()
+
+    config = tmp_path / "config.yml"
+    config.write_text(
+        f"database:\n  type: sqlite\n  name: {tmp_path / 'primary.sqlite'}\n"
+        f"replicas:\n  - url: sqlite:///{tmp_path / 'missing' / 'replica.sqlite'}\n"
+        f"  - type: sqlite\n    name: {tmp_path / 'replica.sqlite'}\n"
+    )
+
+    result = runner.invoke(cli.main, ['add-domain', '--config', str(config), 'new.com'])
+    assert result.exit_code == 0
+    assert not result.exception
+
+    # the unreachable replica is skipped
+    for _ in range(2):
+        result = runner.invoke(cli.main, ['search-domains', '--config', str(config)])
+        assert result.exit_code == 0
+        assert "'name': 'replica.com'" in result.output
+        assert "primary.com" not in result.output
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'primary.sqlite'}")
+    assert [domain["name"] for domain in operations.search_domains(engine, "")] == ["new.com", "primary.com"]
+    engine.dispose()
+
+
+def test_cli_profile(runner, monkeypatch, tmp_path):
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.sqlite'}")
+    monkeypatch.setattr(cli, 'create_engine', unittest.mock.Mock(return_value=engine))
+    mock_doveadm_pw_hash = unittest.mock.Mock(return_value="hash")
+    monkeypatch.setattr(utils, 'doveadm_pw_hash', mock_doveadm_pw_hash)
+    operations.reset_database(engine)
+    operations.add_domain(engine, "test.com")
+    engine.dispose()
+
+    profile_output = tmp_path / "profile.out"
+    result = runner.invoke(
+        cli.main,
+        [
+            'add-user',
+            '--config',
+            'tests/postfix-sql-ucli.yml',
+            '--profile-output',
+            str(profile_output),
+            'user@test.com',
+        ],
+        input="password\npassword\n",
+    )
+    assert result.exit_code == 0
+    assert not result.exception
+    assert "Created new virtual user" in result.stdout
+    report = json.loads(result.stderr)
+    assert {"operation", "import", "config", "engine", "connect", "hash", "query"} == set(report["phases"])
+    assert report["total"] == pytest.approx(sum(report["phases"].values()), abs=1e-3)
+    # the check of the user before hashing and the INSERT
+    assert report["statements"]["count"] == 2
+    assert report["statements"]["time"] == pytest.approx(report["phases"]["query"], abs=1e-6)
+    assert report["rows"] == 2
+    assert report["peak_memory_kb"] > 0
+    assert pstats.Stats(str(profile_output)).total_calls > 0
+    # hashing is timed where the operations call it, the function is not replaced
+    assert utils.doveadm_pw_hash is mock_doveadm_pw_hash
+
+    result = runner.invoke(cli.main, ['search-users', '--config', 'tests/postfix-sql-ucli.yml', '--profile', 'user'])
+    assert result.exit_code == 0
+    report = json.loads(result.stderr)
+    assert report["statements"]["count"] == 1
+    assert report["rows"] == 1
+    assert "hash" not in report["phases"]
+
+    result = runner.invoke(cli.main, ['search-users', '--config', 'tests/postfix-sql-ucli.yml', 'user'])
+    assert result.exit_code == 0
+    assert result.stderr == ""
+
+
+def test_cli_serve(runner, monkeypatch):
+
+    mock_create_engine = unittest.mock.Mock()
+    monkeypatch.setattr(cli, 'create_engine', mock_create_engine)
+    mock_create_engine.return_value = "engine"
+
+    mock_serve = unittest.mock.Mock()
+    monkeypatch.setattr(server, 'serve', mock_serve)
+
+    result = runner.invoke(cli.main, ['serve', '--config', 'tests/postfix-sql-ucli.yml', '--socket', 'test.sock'])
+    assert result.exit_code == 0
+    assert not result.exception
+    assert result.output.strip() == 'Serving Postfix SQL database operations on test.sock'
+    assert mock_serve.call_args.args[:2] == ("engine", "test.sock")
+
+    mock_serve.side_effect = OSError("another daemon is already serving on 'test.sock'")
+    result = runner.invoke(cli.main, ['serve', '--config', 'tests/postfix-sql-ucli.yml', '--socket', 'test.sock'])
+    assert result.exit_code == 1
+    assert result.output.strip().split('\n')[-1] == (
+        "serve operation failed: another daemon is already serving on 'test.sock'"
+    )
+
+    result = runner.invoke(cli.main, ['serve', '--config', 'tests/postfix-sql-ucli.yml', 'unexpected'])
+    assert result.exit_code == 1
+    assert result.output.strip() == 'serve operation expects no arguments'
+
+    mock_serve.side_effect = None
+    result = runner.invoke(cli.main, ['serve', '--config', 'tests/postfix-sql-ucli.yml'])
+    assert result.exit_code == 0
+    assert mock_serve.call_args.args[:2] == ("engine", cli.DEFAULT_SOCKET)
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ['--version'],
+        ['--help'],
+        ['add-domain', '--config', 'tests/postfix-sql-ucli.yml', 'invalid'],
+        ['add-user', '--config', 'tests/postfix-sql-ucli.yml'],
+    ],
+)
+def test_cli_lazy_imports(args):
+
+    probe = f"""
+import sys
+from postfix_sql_ucli import cli
+try:
+    cli.main({args!r})
+except SystemExit:
+    pass
+print('imported:', ','.join(module for module in ('sqlalchemy', 'passlib', 'yaml') if module in sys.modules))
+"""
+    result = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, check=True)
+    assert result.stdout.strip().split('\n')[-1] == 'imported:'
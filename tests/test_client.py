@@ -0,0 +1,139 @@
+import os
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import pytest
+from sqlalchemy import create_engine, event
+
+from postfix_sql_ucli import operations, utils
+from postfix_sql_ucli.client import DomainCache, PostfixSQLClient
+
+
+def test_domain_cache(monkeypatch):
+    now = [0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+
+    cache = DomainCache(maxsize=2, ttl=10)
+    cache.put("a.com", 1)
+    cache.put("b.com", 2)
+    assert cache.get("a.com") == 1
+    # b.com is the least recently used entry
+    cache.put("c.com", 3)
+    assert (cache.get("a.com"), cache.get("b.com"), cache.get("c.com")) == (1, None, 3)
+
+    now[0] = 10
+    assert cache.get("a.com") is None
+    assert len(cache) == 1
+
+    cache.invalidate("c.com")
+    cache.invalidate("unknown.com")
+    assert len(cache) == 0
+
+
+def test_from_config(monkeypatch):
+    mock_create_engine = unittest.mock.Mock()
+    monkeypatch.setattr('postfix_sql_ucli.client.create_engine', mock_create_engine)
+
+    with PostfixSQLClient.from_config(
+        os.path.join(os.path.dirname(__file__), 'postfix-sql-ucli.yml'), cache_ttl=5
+    ) as client:
+        assert client.domains.ttl == 5
+
+    mock_create_engine.assert_called_once_with(
+        "sqlite:///tests/test.sqlite", execution_options={"retry": unittest.mock.ANY}
+    )
+    mock_create_engine.return_value.dispose.assert_called_once_with()
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.directory.name, 'test.sqlite')}")
+
+        @event.listens_for(self.engine, "connect")
+        def enable_foreign_keys(dbapi_connection, connection_record):
+            dbapi_connection.execute("PRAGMA foreign_keys = ON")
+
+        self.statements = []
+
+        @event.listens_for(self.engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            self.statements.append(statement)
+
+        self.client = PostfixSQLClient(self.engine)
+        self.client.reset_database()
+
+    def tearDown(self):
+        self.client.close()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_operations(self):
+        self.assertEqual(([{"id": 1, "name": "test.com"}], True), self.client.add_domain("test.com"))
+        self.assertEqual(1, self.client.domain_id("test.com"))
+
+        del self.statements[:]
+        for n in range(3):
+            _, added = self.client.add_user(f"user{n}@test.com", "password")
+            self.assertTrue(added)
+        _, added = self.client.add_alias("@test.com", "user0@test.com")
+        self.assertTrue(added)
+        # the domain is not resolved again, a single statement per entry
+        self.assertEqual(4, len(self.statements))
+
+        with unittest.mock.patch.object(utils, "doveadm_pw_hash") as doveadm_pw_hash:
+            self.assertEqual((None, False), self.client.add_user("user@unknown.org", "password"))
+        doveadm_pw_hash.assert_not_called()
+        self.assertEqual(
+            ["user0@test.com", "user1@test.com"], [user["email"] for user in self.client.search_users("", limit=2)]
+        )
+        self.assertEqual(
+            ["user2@test.com"], [user["email"] for user in self.client.iter_users("", after="user1@test.com")]
+        )
+        self.assertEqual(3, len(operations.search_users(self.engine, "")))
+
+        with pytest.raises(AttributeError):
+            self.client.create_engine  # noqa: B018
+
+    def test_delete_domain(self):
+        self.client.add_domain("test.com")
+        self.client.add_user("user@test.com", "password")
+
+        self.assertEqual(
+            [{"users": 1, "aliases": 0, "domains": 0}, {"users": 0, "aliases": 0, "domains": 1}],
+            list(self.client.delete_domain("test.com")),
+        )
+        self.assertEqual(0, len(self.client.domains))
+        self.assertEqual((None, False), self.client.add_user("user@test.com", "password"))
+
+        # the domain is added again with a new ID
+        self.client.add_domain("other.org")
+        [domain], _ = self.client.add_domain("test.com")
+        self.assertNotEqual(1, domain["id"])
+        users, added = self.client.add_user("user@test.com", "password")
+        self.assertTrue(added)
+        self.assertEqual(domain["id"], users[0]["domain_id"])
+
+    def test_stale_domain_id(self):
+        self.client.add_domain("test.com")
+        self.client.add_domain("other.org")
+
+        # another client deletes the cached domain and adds it again
+        list(operations.delete_domain(self.engine, "test.com"))
+        operations.add_domain(self.engine, "test.com")
+        self.assertEqual(1, self.client.domains.get("test.com"))
+
+        with unittest.mock.patch.object(utils, "doveadm_pw_hash", return_value="hash") as doveadm_pw_hash:
+            users, added = self.client.add_user("user@test.com", "password")
+        self.assertTrue(added)
+        self.assertEqual(3, users[0]["domain_id"])
+        # the password is hashed once for both attempts
+        doveadm_pw_hash.assert_called_once_with("password")
+        self.assertEqual(3, self.client.domain_id("test.com"))
+
+        # another client deletes the cached domain
+        list(operations.delete_domain(self.engine, "other.org"))
+        self.assertEqual((None, False), self.client.add_alias("alias@other.org", "user@test.com"))
+        self.assertIsNone(self.client.domains.get("other.org"))
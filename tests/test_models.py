@@ -0,0 +1,54 @@
+import pytest
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+
+from postfix_sql_ucli import models
+
+
+@pytest.mark.parametrize(
+    ("table", "index_name", "expected"),
+    [
+        (
+            "virtual_domains",
+            "name_pattern_idx",
+            "CREATE INDEX name_pattern_idx ON virtual_domains (name text_pattern_ops)",
+        ),
+        (
+            "virtual_users",
+            "email_pattern_idx",
+            "CREATE INDEX email_pattern_idx ON virtual_users (email text_pattern_ops)",
+        ),
+        (
+            "virtual_aliases",
+            "source_pattern_idx",
+            "CREATE INDEX source_pattern_idx ON virtual_aliases (source text_pattern_ops)",
+        ),
+        (
+            "virtual_aliases",
+            "destination_pattern_idx",
+            "CREATE INDEX destination_pattern_idx ON virtual_aliases (destination text_pattern_ops)",
+        ),
+    ],
+)
+def test_pattern_indexes_postgresql(table, index_name, expected):
+
+    (index,) = [index for index in models.Base.metadata.tables[table].indexes if index.name == index_name]
+    actual = str(CreateIndex(index).compile(dialect=postgresql.dialect())).strip()
+    assert actual == expected
+
+
+def test_pattern_indexes_sqlite():
+
+    engine = create_engine('sqlite:///:memory:')
+    models.Base.metadata.create_all(engine)
+
+    inspector = inspect(engine)
+    index_names = {index["name"] for table in models.Base.metadata.tables for index in inspector.get_indexes(table)}
+    assert {
+        "source_destination_idx",
+        "destination_source_idx",
+        "ix_virtual_users_domain_id",
+        "ix_virtual_aliases_domain_id",
+    } <= index_names
+    assert not any(name.endswith("_pattern_idx") for name in index_names)
@@ -1,7 +1,12 @@
+import concurrent.futures
+import os
+import tempfile
 import unittest
 import unittest.mock
 
-from sqlalchemy import create_engine
+import passlib.hash
+import pytest
+from sqlalchemy import create_engine, event, select
 
 from postfix_sql_ucli import models, operations
 
@@ -21,6 +26,47 @@ def test_reset_database(monkeypatch):
     mock_create_all.assert_called_with(engine)
 
 
+# upgrade of databases created before the unique (source, destination) index of aliases, see README
+ALIAS_INDEX_MIGRATION = [
+    "DELETE FROM virtual_aliases WHERE id NOT IN ("
+    "SELECT id FROM (SELECT MIN(id) AS id FROM virtual_aliases GROUP BY source, destination) AS first_aliases)",
+    "CREATE UNIQUE INDEX source_destination_idx ON virtual_aliases (source, destination)",
+]
+
+
+def test_add_alias_without_unique_index(tmp_path):
+
+    url = f"sqlite:///{tmp_path / 'test.sqlite'}"
+    engine = create_engine(url)
+    operations.reset_database(engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DROP INDEX source_destination_idx")
+    operations.add_domain(engine, "test.com")
+
+    expected = [{"id": 1, "domain_id": 1, "source": "source@test.com", "destination": "destination@other.org"}]
+    assert operations.add_alias(engine, "source@test.com", "destination@other.org") == (expected, True)
+    assert operations.add_alias(engine, "source@test.com", "destination@other.org") == (expected, False)
+    assert operations.add_alias(engine, "source@other.org", "destination@other.org") == (None, False)
+
+    # duplicates added before the upgrade are removed by the migration
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "INSERT INTO virtual_aliases (domain_id, source, destination) "
+            "VALUES (1, 'source@test.com', 'destination@other.org')"
+        )
+        for statement in ALIAS_INDEX_MIGRATION:
+            connection.exec_driver_sql(statement)
+    engine.dispose()
+
+    engine = create_engine(url)
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    assert operations.add_alias(engine, "source@test.com", "destination@other.org") == (expected, False)
+    assert "ON CONFLICT" in statements[0]
+    assert operations.search_aliases(engine, "source@test.com", "") == expected
+    engine.dispose()
+
+
 class TestOperation(unittest.TestCase):
     def setUp(self):
         self.engine = create_engine('sqlite:///:memory:')
@@ -50,11 +96,13 @@ class TestOperation(unittest.TestCase):
         for domain in ["test.com", "other.org"]:
             operations.add_domain(self.engine, domain)
 
-        queries = ["test", "other", "%.com"]
+        queries = ["test", "other", "%.com", "t_st", ""]
         expected_results = [
             [{"id": 1, "name": "test.com"}],
             [{"id": 2, "name": "other.org"}],
-            [{"id": 1, "name": "test.com"}],
+            [],
+            [],
+            [{"id": 2, "name": "other.org"}, {"id": 1, "name": "test.com"}],
         ]
 
         for query, expected in zip(queries, expected_results):
@@ -114,14 +162,15 @@ class TestOperation(unittest.TestCase):
 
             operations.add_user(self.engine, email, password)
 
-        queries = ["user", "user@test.com", "%.org"]
+        queries = ["user", "user@test.com", "%.org", "user@other_org"]
         expected_results = [
             [
-                {"id": 1, "domain_id": 1, "email": "user@test.com", "password": "password_test.com"},
                 {"id": 2, "domain_id": 2, "email": "user@other.org", "password": "password_other.org"},
+                {"id": 1, "domain_id": 1, "email": "user@test.com", "password": "password_test.com"},
             ],
             [{"id": 1, "domain_id": 1, "email": "user@test.com", "password": "password_test.com"}],
-            [{"id": 2, "domain_id": 2, "email": "user@other.org", "password": "password_other.org"}],
+            [],
+            [],
         ]
 
         for query, expected in zip(queries, expected_results):
@@ -225,6 +274,200 @@ class TestOperation(unittest.TestCase):
 
         self.assertEqual([], aliases)
 
+    @unittest.mock.patch('postfix_sql_ucli.utils.doveadm_pw_hash')
+    def test_search_domain_name(self, mock_doveadm_pw_hash):
+        operations.reset_database(self.engine)
+
+        mock_doveadm_pw_hash.return_value = "hash"
+
+        for domain in ["test.com", "other.org"]:
+            operations.add_domain(self.engine, domain)
+            operations.add_user(self.engine, "user@" + domain, "password")
+            operations.add_alias(self.engine, "alias@" + domain, "user@test.com")
+
+        users = operations.search_users(self.engine, "", domain_name="other.org")
+
+        self.assertEqual([{"id": 2, "domain_id": 2, "email": "user@other.org", "password": "hash"}], users)
+        self.assertEqual([], operations.search_users(self.engine, "", domain_name="unknown.org"))
+
+        aliases = list(operations.iter_aliases(self.engine, "", "user@test.com", domain_name="test.com"))
+
+        self.assertEqual(
+            [{"id": 1, "domain_id": 1, "source": "alias@test.com", "destination": "user@test.com"}], aliases
+        )
+        self.assertEqual([], operations.search_aliases(self.engine, "alias@test.com", "", domain_name="other.org"))
+
+        # the domain is filtered on the indexed domain_id column
+        with self.engine.connect() as connection:
+            plan = " ".join(
+                row[-1]
+                for row in connection.exec_driver_sql(
+                    "EXPLAIN QUERY PLAN SELECT * FROM virtual_users WHERE domain_id = "
+                    "(SELECT id FROM virtual_domains WHERE name = 'test.com')"
+                )
+            )
+        self.assertIn("INDEX ix_virtual_users_domain_id", plan)
+
+    @unittest.mock.patch('postfix_sql_ucli.utils.doveadm_pw_hash')
+    def test_search_pages(self, mock_doveadm_pw_hash):
+        operations.reset_database(self.engine)
+
+        mock_doveadm_pw_hash.return_value = "hash"
+
+        for domain in ["c.com", "a.com", "b.com"]:
+            operations.add_domain(self.engine, domain)
+            operations.add_user(self.engine, "user@" + domain, "password")
+        for destination in ["z@a.com", "y@a.com"]:
+            operations.add_alias(self.engine, "info@a.com", destination)
+        operations.add_alias(self.engine, "admin@a.com", "x@a.com")
+
+        def names(entries, *keys):
+            return [tuple(entry[key] for key in keys) for entry in entries]
+
+        self.assertEqual([("a.com",), ("b.com",)], names(operations.search_domains(self.engine, "", limit=2), "name"))
+        self.assertEqual(
+            [("c.com",)], names(operations.search_domains(self.engine, "", limit=2, after="b.com"), "name")
+        )
+        self.assertEqual(
+            [("user@b.com",), ("user@c.com",)],
+            names(operations.search_users(self.engine, "user@", after="user@a.com"), "email"),
+        )
+        self.assertEqual(
+            [("user@b.com",)],
+            names(operations.iter_users(self.engine, "", domain_name="b.com", limit=5, after="user@a.com"), "email"),
+        )
+
+        aliases = operations.search_aliases(self.engine, "", "", limit=2)
+        self.assertEqual(
+            [("admin@a.com", "x@a.com"), ("info@a.com", "y@a.com")], names(aliases, "source", "destination")
+        )
+        aliases = operations.search_aliases(self.engine, "", "", limit=2, after=("info@a.com", "y@a.com"))
+        self.assertEqual([("info@a.com", "z@a.com")], names(aliases, "source", "destination"))
+        aliases = operations.search_aliases(self.engine, "", "", after="admin@a.com")
+        self.assertEqual(
+            [("info@a.com", "y@a.com"), ("info@a.com", "z@a.com")], names(aliases, "source", "destination")
+        )
+
+        # pages are served by the index on the key column without sorting or skipping rows
+        stmt = operations._page(
+            select(models.VirtualUser), [models.VirtualUser.email], limit=10, after="user@a.com"
+        ).where(models.VirtualUser.email.startswith("user"))
+        with self.engine.connect() as connection:
+            compiled = stmt.compile(connection, compile_kwargs={"literal_binds": True})
+            plan = " ".join(row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}"))
+        self.assertIn("USING INDEX ix_virtual_users_email", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    @unittest.mock.patch('postfix_sql_ucli.utils.doveadm_pw_hash')
+    def test_stats(self, mock_doveadm_pw_hash):
+        operations.reset_database(self.engine)
+
+        mock_doveadm_pw_hash.return_value = "hash"
+
+        for domain in ["test.com", "other.org", "empty.net"]:
+            operations.add_domain(self.engine, domain)
+        for email in ["user1@test.com", "user2@test.com", "user@other.org"]:
+            operations.add_user(self.engine, email, "password")
+        operations.add_alias(self.engine, "@other.org", "user@other.org")
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            entries = operations.stats(self.engine)
+        finally:
+            event.remove(self.engine, "before_cursor_execute", before_cursor_execute)
+
+        self.assertEqual(
+            [
+                {"domain": "empty.net", "users": 0, "aliases": 0},
+                {"domain": "other.org", "users": 1, "aliases": 1},
+                {"domain": "test.com", "users": 2, "aliases": 0},
+                {"domain": None, "users": 3, "aliases": 1},
+            ],
+            entries,
+        )
+        self.assertEqual(1, len(statements))
+
+        self.assertEqual(
+            [{"domain": "test.com", "users": 2, "aliases": 0}, {"domain": None, "users": 2, "aliases": 0}],
+            list(operations.iter_stats(self.engine, "te")),
+        )
+        self.assertEqual([{"domain": None, "users": 0, "aliases": 0}], operations.stats(self.engine, "unknown"))
+
+    @unittest.mock.patch('postfix_sql_ucli.utils.doveadm_pw_hash')
+    def test_delete_domain(self, mock_doveadm_pw_hash):
+        operations.reset_database(self.engine)
+
+        mock_doveadm_pw_hash.return_value = "hash"
+
+        for domain in ["test.com", "other.org"]:
+            operations.add_domain(self.engine, domain)
+            for n in range(3):
+                operations.add_user(self.engine, f"user{n}@{domain}", "password")
+            operations.add_alias(self.engine, f"@{domain}", f"user0@{domain}")
+            operations.add_alias(self.engine, f"postmaster@{domain}", f"user1@{domain}")
+
+        self.assertEqual([], list(operations.delete_domain(self.engine, "unknown.net")))
+
+        progress = list(operations.delete_domain(self.engine, "test.com", chunk_size=2))
+        self.assertEqual(
+            [
+                {"users": 0, "aliases": 2, "domains": 0},
+                {"users": 2, "aliases": 0, "domains": 0},
+                {"users": 1, "aliases": 0, "domains": 0},
+                {"users": 0, "aliases": 0, "domains": 1},
+            ],
+            progress,
+        )
+
+        self.assertEqual([{"id": 2, "name": "other.org"}], operations.search_domains(self.engine, ""))
+        self.assertEqual(
+            ["user0@other.org", "user1@other.org", "user2@other.org"],
+            [user["email"] for user in operations.search_users(self.engine, "")],
+        )
+        self.assertEqual(
+            [("@other.org", "user0@other.org"), ("postmaster@other.org", "user1@other.org")],
+            [(alias["source"], alias["destination"]) for alias in operations.search_aliases(self.engine, "", "")],
+        )
+
+        with unittest.mock.patch("time.sleep") as mock_sleep:
+            list(operations.delete_domain(self.engine, "other.org", chunk_size=1000, pause=0.5))
+        self.assertEqual([unittest.mock.call(0.5)] * 2, mock_sleep.call_args_list)
+        self.assertEqual([], operations.search_domains(self.engine, ""))
+        self.assertEqual([], operations.search_users(self.engine, ""))
+
+    def test_reverse_aliases(self):
+        operations.reset_database(self.engine)
+
+        operations.add_domain(self.engine, "test.com")
+        operations.add_alias(self.engine, "sales@test.com", "user@test.com")
+        operations.add_alias(self.engine, "info@test.com", "user@test.com")
+        operations.add_alias(self.engine, "info@test.com", "other@test.com")
+
+        aliases = operations.reverse_aliases(self.engine, "user@test.com")
+
+        self.assertEqual(
+            [
+                {"source": "info@test.com", "destination": "user@test.com"},
+                {"source": "sales@test.com", "destination": "user@test.com"},
+            ],
+            aliases,
+        )
+        self.assertEqual([], operations.reverse_aliases(self.engine, "user@test"))
+
+        # the lookup is served by the (destination, source) index alone
+        stmt = select(models.VirtualAlias.source, models.VirtualAlias.destination).where(
+            models.VirtualAlias.destination == "user@test.com"
+        )
+        with self.engine.connect() as connection:
+            compiled = stmt.compile(connection, compile_kwargs={"literal_binds": True})
+            plan = " ".join(row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}"))
+        self.assertIn("COVERING INDEX destination_source_idx", plan)
+
     def test_delete_aliases(self):
         operations.reset_database(self.engine)
 
@@ -246,10 +489,18 @@ class TestOperation(unittest.TestCase):
 
         operations.add_alias(self.engine, source_email, "destination1@other.org")
         operations.add_alias(self.engine, source_email, "destination2@other.org")
-        operations.add_alias(self.engine, source_email, "destination3@another.org")
+        operations.add_alias(self.engine, source_email, "other3@another.org")
 
         aliases = operations.delete_aliases(self.engine, "", "%@other.org")
 
+        self.assertEqual([], aliases)
+
+        aliases = operations.delete_aliases(self.engine, "source%", "destination_")
+
+        self.assertEqual([], aliases)
+
+        aliases = operations.delete_aliases(self.engine, "", "destination")
+
         self.assertEqual(
             [
                 {"id": 1, "domain_id": 1, "source": source_email, "destination": "destination1@other.org"},
@@ -258,16 +509,343 @@ class TestOperation(unittest.TestCase):
             aliases,
         )
 
-        aliases = operations.delete_aliases(self.engine, "", "destination3@other.org")
+        aliases = operations.delete_aliases(self.engine, "", "other3@other.org")
 
         self.assertEqual([], aliases)
 
-        aliases = operations.delete_aliases(self.engine, "", "destination3@another.org")
+        aliases = operations.delete_aliases(self.engine, "", "other3@another.org")
 
         self.assertEqual(
-            [{"id": 3, "domain_id": 1, "source": source_email, "destination": "destination3@another.org"}], aliases
+            [{"id": 3, "domain_id": 1, "source": source_email, "destination": "other3@another.org"}], aliases
         )
 
         aliases = operations.search_aliases(self.engine, "", "")
 
         self.assertEqual([], aliases)
+
+    @unittest.mock.patch('postfix_sql_ucli.utils.doveadm_pw_hash')
+    def test_delete_chunks(self, mock_doveadm_pw_hash):
+        operations.reset_database(self.engine)
+
+        mock_doveadm_pw_hash.return_value = "hash"
+
+        operations.add_domain(self.engine, "test.com")
+        for n in range(5):
+            operations.add_user(self.engine, f"user{n}@test.com", "password")
+            operations.add_alias(self.engine, f"alias{n}@test.com", f"user{n}@test.com")
+        operations.add_user(self.engine, "user_x@test.com", "password")
+
+        # every chunk is committed before its entries are yielded
+        deleted = operations.iter_delete_aliases(self.engine, "alias", "", chunk_size=2)
+        self.assertEqual("alias0@test.com", next(deleted)["source"])
+        self.assertEqual(3, len(operations.search_aliases(self.engine, "", "")))
+        self.assertEqual(
+            ["alias1@test.com", "alias2@test.com", "alias3@test.com", "alias4@test.com"],
+            [alias["source"] for alias in deleted],
+        )
+
+        self.assertEqual([], operations.delete_user(self.engine, "user"))
+        self.assertEqual(
+            ["user_x@test.com"],
+            [user["email"] for user in operations.delete_user(self.engine, "user_", prefix=True, chunk_size=1)],
+        )
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            count = operations.delete_user(self.engine, "user", prefix=True, chunk_size=2, count_only=True)
+        finally:
+            event.remove(self.engine, "before_cursor_execute", before_cursor_execute)
+
+        self.assertEqual(5, count)
+        self.assertEqual([], operations.search_users(self.engine, ""))
+        # three chunks of deletes and the final empty select, deleted entries are not returned
+        self.assertEqual(7, len(statements))
+        self.assertFalse(any("RETURNING" in statement for statement in statements))
+
+        self.assertEqual(0, operations.delete_aliases(self.engine, "", "", count_only=True))
+
+    @unittest.mock.patch('postfix_sql_ucli.utils.doveadm_pw_hash')
+    def test_sync(self, mock_doveadm_pw_hash):
+        operations.reset_database(self.engine)
+
+        mock_doveadm_pw_hash.side_effect = lambda password, salt=None: "hash_" + password
+
+        for domain in ["old.org", "test.com"]:
+            operations.add_domain(self.engine, domain)
+        for email in ["user@old.org", "user1@test.com", "user2@test.com"]:
+            operations.add_user(self.engine, email, "password")
+        operations.add_alias(self.engine, "@old.org", "user@old.org")
+        operations.add_alias(self.engine, "postmaster@test.com", "user1@test.com")
+
+        state = {
+            "domains": ["test.com", {"name": "new.net"}],
+            "users": [
+                {"email": "user1@test.com", "password": "ignored"},
+                {"email": "user2@test.com", "password_hash": "new_hash"},
+                {"email": "user@new.net", "password": "secret"},
+            ],
+            "aliases": [
+                {"source": "postmaster@test.com", "destination": "user1@test.com"},
+                {"source": "@new.net", "destination": "user@new.net"},
+            ],
+        }
+
+        plan = operations.plan_sync(self.engine, state, chunk_size=1)
+        self.assertEqual(
+            {
+                "add": {
+                    "domain": [{"name": "new.net"}],
+                    "user": [{"email": "user@new.net", "password": "secret", "password_hash": None}],
+                    "alias": [{"source": "@new.net", "destination": "user@new.net"}],
+                },
+                "update": {"user": [{"id": 3, "email": "user2@test.com", "password": "new_hash"}]},
+                "delete": {
+                    "domain": [{"id": 1, "name": "old.org"}],
+                    "user": [{"id": 1, "email": "user@old.org"}],
+                    "alias": [{"id": 1, "source": "@old.org", "destination": "user@old.org"}],
+                },
+            },
+            plan,
+        )
+
+        result = operations.sync(self.engine, plan, batch_size=2)
+        self.assertEqual({"added": 3, "updated": 1, "deleted": 3, "errors": []}, result)
+
+        self.assertEqual(
+            ["new.net", "test.com"], [domain["name"] for domain in operations.search_domains(self.engine, "")]
+        )
+        self.assertEqual(
+            [
+                ("user1@test.com", "hash_password"),
+                ("user2@test.com", "new_hash"),
+                ("user@new.net", "hash_secret"),
+            ],
+            [(user["email"], user["password"]) for user in operations.search_users(self.engine, "")],
+        )
+        self.assertEqual(
+            [("@new.net", "user@new.net"), ("postmaster@test.com", "user1@test.com")],
+            [(alias["source"], alias["destination"]) for alias in operations.search_aliases(self.engine, "", "")],
+        )
+
+        # the database is in the desired state, a new plan is empty and writes nothing
+        plan = operations.plan_sync(self.engine, state)
+        self.assertFalse(any(entries for changes in plan.values() for entries in changes.values()))
+        self.assertEqual({"added": 0, "updated": 0, "deleted": 0, "errors": []}, operations.sync(self.engine, plan))
+
+        for state, message in [
+            ({"domains": ["invalid"]}, "entry 1 of 'domains': invalid domain name 'invalid'"),
+            ({"domains": [["test.com"]]}, "entry 1 of 'domains': malformed entry"),
+            ({"users": [{"email": "user@test.com"}]}, "entry 1 of 'users': missing password for user 'user@test.com'"),
+            (
+                {"domains": ["test.com"], "aliases": [{"source": "@other.org", "destination": "user@test.com"}]},
+                "entry 1 of 'aliases': domain other.org is not listed in 'domains'",
+            ),
+        ]:
+            with pytest.raises(ValueError, match=message):
+                operations.plan_sync(self.engine, state)
+
+    @unittest.mock.patch('postfix_sql_ucli.utils.doveadm_pw_hash')
+    def test_import_entries(self, mock_doveadm_pw_hash):
+        operations.reset_database(self.engine)
+
+        mock_doveadm_pw_hash.return_value = "hash"
+
+        operations.add_domain(self.engine, "test.com")
+
+        entries = [
+            (2, {"type": "domain", "name": "test.com"}),
+            (3, {"type": "domain", "name": "other.org"}),
+            (4, {"type": "user", "email": "user@other.org", "password": "password"}),
+            (5, {"type": "user", "email": "user@unknown.org", "password": "password"}),
+            (6, {"type": "alias", "source": "@test.com", "destination": "user@other.org"}),
+            (7, {"type": "alias", "source": "@test.com", "destination": "user@other.org"}),
+            (8, {"type": "user", "email": "invalid", "password": "password"}),
+            (9, {"type": "mailbox"}),
+            (10, None),
+        ]
+
+        results = list(operations.import_entries(self.engine, entries, batch_size=3))
+
+        self.assertEqual(
+            [
+                {"processed": 3, "added": 2, "skipped": 1, "errors": []},
+                {"processed": 3, "added": 1, "skipped": 1, "errors": [(5, "domain unknown.org can not be used")]},
+                {
+                    "processed": 3,
+                    "added": 0,
+                    "skipped": 0,
+                    "errors": [
+                        (8, "invalid email address 'invalid'"),
+                        (9, "unknown entry type 'mailbox'"),
+                        (10, "malformed entry"),
+                    ],
+                },
+            ],
+            results,
+        )
+
+        self.assertEqual(
+            [{"id": 1, "domain_id": 2, "email": "user@other.org", "password": "hash"}],
+            operations.search_users(self.engine, ""),
+        )
+        self.assertEqual(
+            [{"id": 1, "domain_id": 1, "source": "@test.com", "destination": "user@other.org"}],
+            operations.search_aliases(self.engine, "", ""),
+        )
+
+    def test_sync_workers(self):
+        operations.reset_database(self.engine)
+
+        state = {
+            "domains": ["test.com"],
+            "users": [{"email": f"user{n}@test.com", "password": f"password{n}"} for n in range(1, 6)],
+        }
+        plan = operations.plan_sync(self.engine, state)
+
+        executors = []
+        process_pool_executor = concurrent.futures.ProcessPoolExecutor
+
+        def executor(workers):
+            executors.append(workers)
+            return process_pool_executor(workers)
+
+        with unittest.mock.patch('concurrent.futures.ProcessPoolExecutor', executor):
+            result = operations.sync(self.engine, plan, batch_size=2, workers=2)
+        self.assertEqual({"added": 6, "updated": 0, "deleted": 0, "errors": []}, result)
+        # a single pool hashes the passwords of all batches
+        self.assertEqual([2], executors)
+
+        users = operations.search_users(self.engine, "")
+        self.assertEqual(5, len(users))
+        for user in users:
+            password = "password" + user["email"][len("user")]
+            self.assertTrue(passlib.hash.sha512_crypt.verify(password, user["password"]))
+
+    def test_import_entries_workers(self):
+        operations.reset_database(self.engine)
+
+        entries = [
+            (1, {"type": "domain", "name": "test.com"}),
+            (2, {"type": "user", "email": "user1@test.com", "password": "password1"}),
+            (3, {"type": "user", "email": "user2@test.com", "password": "password2"}),
+            (4, {"type": "user", "email": "user3@test.com", "password": "password3"}),
+        ]
+
+        results = list(operations.import_entries(self.engine, entries, batch_size=2, workers=2))
+
+        self.assertEqual(
+            [
+                {"processed": 2, "added": 2, "skipped": 0, "errors": []},
+                {"processed": 2, "added": 2, "skipped": 0, "errors": []},
+            ],
+            results,
+        )
+
+        users = operations.search_users(self.engine, "")
+        self.assertEqual(["user1@test.com", "user2@test.com", "user3@test.com"], [user["email"] for user in users])
+        for index, user in enumerate(users, 1):
+            self.assertTrue(passlib.hash.sha512_crypt.verify(f"password{index}", user["password"]))
+
+    @unittest.mock.patch('postfix_sql_ucli.utils.doveadm_pw_hash')
+    def test_add_single_statement(self, mock_doveadm_pw_hash):
+        operations.reset_database(self.engine)
+
+        mock_doveadm_pw_hash.return_value = "password"
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            operations.add_domain(self.engine, "test.com")
+            operations.add_user(self.engine, "user@test.com", "password")
+            operations.add_alias(self.engine, "alias@test.com", "user@test.com")
+        finally:
+            event.remove(self.engine, "before_cursor_execute", before_cursor_execute)
+
+        # every entry is written by a single statement, the user is checked by a SELECT before hashing
+        self.assertEqual(4, len(statements))
+        self.assertTrue(statements[1].startswith("SELECT"))
+        for statement in statements[:1] + statements[2:]:
+            self.assertTrue(statement.startswith("INSERT INTO"))
+            self.assertIn("ON CONFLICT", statement)
+
+    @unittest.mock.patch('postfix_sql_ucli.utils.doveadm_pw_hash')
+    def test_add_user_hash(self, mock_doveadm_pw_hash):
+        operations.reset_database(self.engine)
+        mock_doveadm_pw_hash.return_value = "hash"
+        operations.add_domain(self.engine, "test.com")
+
+        # the password is not hashed if the user can not be added
+        self.assertEqual((None, False), operations.add_user(self.engine, "user@unknown.org", "password"))
+        mock_doveadm_pw_hash.assert_not_called()
+
+        users, added = operations.add_user(self.engine, "user@test.com", "password")
+        self.assertTrue(added)
+        mock_doveadm_pw_hash.assert_called_once_with("password")
+
+        self.assertEqual((users, False), operations.add_user(self.engine, "user@test.com", "other"))
+        mock_doveadm_pw_hash.assert_called_once_with("password")
+
+    def test_iter_entries(self):
+        operations.reset_database(self.engine)
+
+        for domain in ["test.com", "other.org"]:
+            operations.add_domain(self.engine, domain)
+            operations.add_alias(self.engine, "source@" + domain, "destination@" + domain)
+
+        domains = operations.iter_domains(self.engine, "", chunk_size=1)
+
+        self.assertFalse(isinstance(domains, list))
+        self.assertEqual([{"id": 2, "name": "other.org"}, {"id": 1, "name": "test.com"}], list(domains))
+        self.assertEqual([], list(operations.iter_users(self.engine, "", chunk_size=1)))
+        self.assertEqual(
+            [{"id": 2, "domain_id": 2, "source": "source@other.org", "destination": "destination@other.org"}],
+            list(operations.iter_aliases(self.engine, "source@other.org", "", chunk_size=1)),
+        )
+
+    @unittest.mock.patch('postfix_sql_ucli.utils.doveadm_pw_hash')
+    def test_export_maps(self, mock_doveadm_pw_hash):
+        operations.reset_database(self.engine)
+
+        mock_doveadm_pw_hash.return_value = "$6$salt$hash"
+
+        for domain in ["test.com", "other.org"]:
+            operations.add_domain(self.engine, domain)
+        operations.add_user(self.engine, "user@test.com", "password")
+        operations.add_user(self.engine, "admin@other.org", "password")
+        operations.add_alias(self.engine, "postmaster@test.com", "user@test.com")
+        operations.add_alias(self.engine, "@other.org", "user@test.com")
+        operations.add_alias(self.engine, "postmaster@test.com", "admin@other.org")
+
+        with tempfile.TemporaryDirectory() as directory:
+            counts = operations.export_maps(self.engine, directory, chunk_size=1)
+
+            self.assertEqual(
+                {"virtual_mailbox_domains": 2, "virtual_mailbox_maps": 2, "virtual_alias_maps": 2, "passwd": 2},
+                counts,
+            )
+
+            def read(name):
+                with open(os.path.join(directory, name), encoding='utf-8') as stream:
+                    return stream.read()
+
+            self.assertEqual("other.org OK\ntest.com OK\n", read("virtual_mailbox_domains"))
+            self.assertEqual("admin@other.org OK\nuser@test.com OK\n", read("virtual_mailbox_maps"))
+            self.assertEqual(
+                "@other.org user@test.com\npostmaster@test.com admin@other.org,user@test.com\n",
+                read("virtual_alias_maps"),
+            )
+            self.assertEqual(
+                "admin@other.org:{SHA512-CRYPT}$6$salt$hash::::::\nuser@test.com:{SHA512-CRYPT}$6$salt$hash::::::\n",
+                read("passwd"),
+            )
+            self.assertEqual(0o600, os.stat(os.path.join(directory, "passwd")).st_mode & 0o777)
+            self.assertEqual(sorted(counts), sorted(os.listdir(directory)))
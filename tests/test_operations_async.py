@@ -0,0 +1,215 @@
+import asyncio
+import inspect
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import pytest
+
+pytest.importorskip("aiosqlite")
+pytest.importorskip("greenlet")
+
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.ext.asyncio import create_async_engine  # noqa: E402
+
+from postfix_sql_ucli import operations, operations_async, retry  # noqa: E402
+
+
+def test_mirrors_operations(public_functions):
+    functions = public_functions(operations_async)
+    assert set(functions) == set(public_functions(operations))
+
+    for name, function in public_functions(operations).items():
+        # generators are mirrored by asynchronous generators, other functions by coroutines
+        if inspect.isgeneratorfunction(function):
+            assert inspect.isasyncgenfunction(functions[name]), name
+        else:
+            assert inspect.iscoroutinefunction(functions[name]), name
+
+
+async def collect(generator):
+    return [entry async for entry in generator]
+
+
+class TestOperationAsync(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(self.directory.name, 'test.sqlite')}")
+        await operations_async.reset_database(self.engine)
+
+        self.hashing_threads = set()
+
+        def doveadm_pw_hash(password, salt=None):
+            self.hashing_threads.add(threading.get_ident())
+            return "hash_" + password
+
+        patcher = unittest.mock.patch('postfix_sql_ucli.utils.doveadm_pw_hash', doveadm_pw_hash)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self.engine.dispose()
+        self.directory.cleanup()
+
+    async def test_add_search(self):
+        self.assertEqual(
+            ([{"id": 1, "name": "test.com"}], True), await operations_async.add_domain(self.engine, "test.com")
+        )
+        self.assertEqual(
+            ([{"id": 1, "name": "test.com"}], False), await operations_async.add_domain(self.engine, "test.com")
+        )
+
+        # concurrent requests, passwords are hashed off the event loop thread
+        results = await asyncio.gather(
+            *[operations_async.add_user(self.engine, f"user{n}@test.com", f"password{n}") for n in range(5)],
+            operations_async.add_alias(self.engine, "@test.com", "user1@test.com"),
+        )
+        self.assertTrue(all(added for _, added in results))
+        self.assertNotIn(threading.get_ident(), self.hashing_threads)
+
+        self.assertEqual((None, False), await operations_async.add_user(self.engine, "user@unknown.org", "password"))
+
+        users = await operations_async.search_users(self.engine, "user", limit=2, after="user2@test.com")
+        self.assertEqual(["user3@test.com", "user4@test.com"], [user["email"] for user in users])
+        self.assertEqual("hash_password3", users[0]["password"])
+
+        self.assertEqual(
+            [user["email"] for user in await operations_async.search_users(self.engine, "")],
+            [user["email"] async for user in operations_async.iter_users(self.engine, "", chunk_size=2)],
+        )
+        self.assertEqual(
+            [{"id": 1, "name": "test.com"}],
+            [domain async for domain in operations_async.iter_domains(self.engine, "test.com", exact=True)],
+        )
+        self.assertEqual(
+            [{"id": 1, "domain_id": 1, "source": "@test.com", "destination": "user1@test.com"}],
+            [alias async for alias in operations_async.iter_aliases(self.engine, "@test", "", domain_name="test.com")],
+        )
+        self.assertEqual(
+            [{"source": "@test.com", "destination": "user1@test.com"}],
+            [alias async for alias in operations_async.iter_reverse_aliases(self.engine, "user1@test.com")],
+        )
+        self.assertEqual(
+            [{"domain": "test.com", "users": 5, "aliases": 1}, {"domain": None, "users": 5, "aliases": 1}],
+            [entry async for entry in operations_async.iter_stats(self.engine)],
+        )
+        self.assertEqual(
+            [{"domain": None, "users": 0, "aliases": 0}], await operations_async.stats(self.engine, "unknown")
+        )
+
+    async def test_delete(self):
+        await operations_async.add_domain(self.engine, "test.com")
+        for n in range(5):
+            await operations_async.add_user(self.engine, f"user{n}@test.com", "password")
+            await operations_async.add_user(self.engine, f"user1{n}@test.com", "password")
+            await operations_async.add_alias(self.engine, f"alias{n}@test.com", f"user{n}@test.com")
+
+        deleted = operations_async.iter_delete_aliases(self.engine, "alias", "", chunk_size=2)
+        self.assertEqual("alias0@test.com", (await deleted.__anext__())["source"])
+        # the first chunk is committed before its entries are yielded
+        self.assertEqual(3, len(await operations_async.search_aliases(self.engine, "", "")))
+        self.assertEqual(4, len([alias async for alias in deleted]))
+
+        self.assertEqual(
+            ["user0@test.com"],
+            [user["email"] for user in await operations_async.delete_user(self.engine, "user0@test.com")],
+        )
+        self.assertEqual(
+            6,
+            await operations_async.delete_user(
+                self.engine, "user1", prefix=True, chunk_size=1, count_only=True, pause=0.01
+            ),
+        )
+        self.assertEqual(0, await operations_async.delete_aliases(self.engine, "", "", count_only=True))
+
+        self.assertEqual(
+            [{"users": 3, "aliases": 0, "domains": 0}, {"users": 0, "aliases": 0, "domains": 1}],
+            [progress async for progress in operations_async.delete_domain(self.engine, "test.com")],
+        )
+        self.assertEqual([], [progress async for progress in operations_async.delete_domain(self.engine, "test.com")])
+        self.assertEqual([], await operations_async.search_domains(self.engine, ""))
+
+    async def test_import_sync_export(self):
+        entries = [
+            (1, {"type": "domain", "name": "test.com"}),
+            (2, {"type": "user", "email": "user@test.com", "password": "secret"}),
+            (3, {"type": "alias", "source": "@test.com", "destination": "user@test.com"}),
+            (4, {"type": "user", "email": "invalid"}),
+        ]
+        results = [result async for result in operations_async.import_entries(self.engine, entries, batch_size=2)]
+        self.assertEqual([2, 2], [result["processed"] for result in results])
+        self.assertEqual(3, sum(result["added"] for result in results))
+        self.assertEqual([[], [(4, "invalid email address 'invalid'")]], [result["errors"] for result in results])
+
+        state = {
+            "domains": ["test.com"],
+            "users": [{"email": "user@test.com", "password": "ignored"}, {"email": "new@test.com", "password": "new"}],
+        }
+        plan = await operations_async.plan_sync(self.engine, state)
+        self.assertEqual(["new@test.com"], [user["email"] for user in plan["add"]["user"]])
+        self.assertEqual(["@test.com"], [alias["source"] for alias in plan["delete"]["alias"]])
+
+        result = await operations_async.sync(self.engine, plan)
+        self.assertEqual({"added": 1, "updated": 0, "deleted": 1, "errors": []}, result)
+        self.assertNotIn(threading.get_ident(), self.hashing_threads)
+        self.assertEqual(
+            [("new@test.com", "hash_new"), ("user@test.com", "hash_secret")],
+            [(user["email"], user["password"]) for user in await operations_async.search_users(self.engine, "")],
+        )
+
+        counts = await operations_async.export_maps(self.engine, self.directory.name)
+        self.assertEqual(
+            {"virtual_mailbox_domains": 1, "virtual_mailbox_maps": 2, "virtual_alias_maps": 0, "passwd": 2}, counts
+        )
+
+    async def test_retry(self):
+        # no busy timeout, writes fail right away while another connection holds an exclusive lock
+        policy = retry.RetryPolicy(attempts=2, backoff=0.5, jitter=False)
+        engine = create_async_engine(self.engine.url, connect_args={"timeout": 0}, execution_options={"retry": policy})
+        self.addAsyncCleanup(engine.dispose)
+        locker = sqlite3.connect(os.path.join(self.directory.name, 'test.sqlite'), isolation_level=None)
+        self.addCleanup(locker.close)
+        locker.execute("BEGIN EXCLUSIVE")
+
+        started = time.monotonic()
+        task = asyncio.create_task(operations_async.add_domain(engine, "test.com"))
+        while not policy.retries and not task.done():
+            await asyncio.sleep(0.01)
+        # this coroutine runs while the failed write waits before the retry
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertFalse(task.done())
+
+        locker.execute("COMMIT")
+        self.assertEqual(([{"id": 1, "name": "test.com"}], True), await task)
+        self.assertEqual(1, policy.retries)
+
+    async def test_delete_domain_retry(self):
+        policy = retry.RetryPolicy(attempts=2, backoff=0.2, jitter=False)
+        engine = create_async_engine(self.engine.url, connect_args={"timeout": 0}, execution_options={"retry": policy})
+        self.addAsyncCleanup(engine.dispose)
+        await operations_async.add_domain(engine, "test.com")
+        reader = sqlite3.connect(os.path.join(self.directory.name, 'test.sqlite'), isolation_level=None)
+        self.addCleanup(reader.close)
+
+        @event.listens_for(engine.sync_engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            # a reader takes a shared lock before the first attempt deletes the domain, so that its COMMIT fails
+            if statement.startswith("DELETE FROM virtual_domains") and not policy.retries:
+                reader.execute("BEGIN")
+                reader.execute("SELECT * FROM virtual_domains").fetchall()
+
+        async def release():
+            while not policy.retries:
+                await asyncio.sleep(0.01)
+            reader.execute("COMMIT")
+
+        progress, _ = await asyncio.gather(
+            collect(operations_async.delete_domain(engine, "test.com")), asyncio.wait_for(release(), 5)
+        )
+        self.assertEqual([{"users": 0, "aliases": 0, "domains": 1}], progress)
+        self.assertEqual(1, policy.retries)
+        self.assertEqual([], await operations_async.search_domains(engine, ""))
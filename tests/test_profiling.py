@@ -0,0 +1,65 @@
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from postfix_sql_ucli import profiling
+
+
+def test_phases(monkeypatch):
+    now = [0]
+    monkeypatch.setattr(time, "perf_counter", lambda: now[0])
+
+    def sleep(seconds, error=None):
+        now[0] += seconds
+        if error:
+            raise error
+
+    profiler = profiling.Profiler()
+    with profiler:
+        sleep(1)
+        with profiler.phase("config"):
+            sleep(2)
+            # time is attributed to the innermost phase
+            profiler.timed("hash", sleep)(4)
+        sleep(8)
+        with pytest.raises(RuntimeError):
+            profiler.timed("config", sleep)(16, RuntimeError)
+
+    report = profiler.report()
+    assert report["total"] == 31
+    assert report["phases"] == {"operation": 9, "config": 18, "hash": 4}
+
+    # phases reported without the profiler are timed by the running profiler only
+    with profiling.phase("hash"):
+        sleep(32)
+    with profiler:
+        with profiling.phase("hash"):
+            sleep(64)
+    assert profiler.phases["hash"] == 68
+
+
+def test_disabled():
+    profiler = profiling.Profiler(False)
+    function = object()
+    assert profiler.timed("hash", function) is function
+    with profiler, profiler.phase("config"), profiling.phase("hash"):
+        pass
+    assert profiler.phases == {}
+
+
+def test_instrument(tmp_path):
+    profiler = profiling.Profiler()
+    engine = profiler.instrument(create_engine(f"sqlite:///{tmp_path / 'test.sqlite'}"))
+    with profiler, engine.connect() as connection:
+        connection.execute(text("CREATE TABLE entries (id INTEGER)"))
+        connection.execute(text("INSERT INTO entries VALUES (1), (2), (3)"))
+        assert [1, 2, 3] == connection.scalars(text("SELECT id FROM entries")).all()
+        assert 1 == connection.execute(text("SELECT id FROM entries")).first()[0]
+        with pytest.raises(Exception, match="no such table"):
+            connection.execute(text("SELECT * FROM missing"))
+
+    report = profiler.report()
+    assert set(report["phases"]) == {"operation", "connect", "query"}
+    assert report["statements"]["count"] == 5
+    assert report["rows"] == 4
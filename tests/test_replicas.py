@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+from sqlalchemy import create_engine
+
+from postfix_sql_ucli import operations, replicas, server
+
+
+@pytest.fixture
+def databases(tmp_path):
+    """Primary and two replicas told apart by the domains they contain"""
+
+    engines = []
+    for name in ["primary", "replica1", "replica2"]:
+        engine = create_engine(f"sqlite:///{tmp_path / name}.sqlite")
+        operations.reset_database(engine)
+        operations.add_domain(engine, f"{name}.com")
+        engines.append(engine)
+    yield engines
+    for engine in engines:
+        engine.dispose()
+
+
+def domains(engine, operation="search_domains"):
+    return [domain["name"] for domain in getattr(operations, operation)(engine, "")]
+
+
+def test_read_operations(public_functions):
+    assert replicas.READ_OPERATIONS < set(public_functions(operations))
+
+
+def test_round_robin(databases):
+    primary, *replica_engines = databases
+    router = replicas.ReplicaRouter(primary, replica_engines, start=0)
+
+    assert [domains(router.engine("search_domains")) for _ in range(3)] == [
+        ["replica1.com"],
+        ["replica2.com"],
+        ["replica1.com"],
+    ]
+    assert list(domains(router.engine("iter_domains"), "iter_domains")) == ["replica2.com"]
+
+    # writes and the sync plan stay on the primary
+    for operation in ["add_domain", "delete_domain", "import_entries", "sync", "plan_sync", "reset_database"]:
+        assert router.engine(operation) is primary
+    operations.add_domain(router.engine("add_domain"), "new.com")
+    assert domains(primary) == ["new.com", "primary.com"]
+    assert domains(router.engine("search_domains")) == ["replica1.com"]
+
+
+def test_fallback(databases, tmp_path):
+    primary, replica, _ = databases
+    # SQLite fails to open a database in a directory that does not exist
+    unreachable = create_engine(f"sqlite:///{tmp_path / 'missing' / 'replica.sqlite'}")
+
+    router = replicas.ReplicaRouter(primary, [unreachable, replica], start=0)
+    assert [domains(router.engine("search_domains")) for _ in range(2)] == [["replica1.com"], ["replica1.com"]]
+
+    router = replicas.ReplicaRouter(primary, [unreachable])
+    assert domains(router.engine("search_domains")) == ["primary.com"]
+
+    assert replicas.ReplicaRouter(primary).engine("search_domains") is primary
+
+
+def test_server_replicas(databases, tmp_path):
+    primary, replica, _ = databases
+    socket_path = str(tmp_path / "test.sock")
+
+    with server.Server(primary, socket_path, replicas=[replica]) as instance:
+        thread = threading.Thread(target=instance.serve_forever, kwargs={'poll_interval': 0.01})
+        thread.start()
+        try:
+            with server.Client(socket_path) as client:
+                assert client.add_domain("new.com")[1]
+                assert [domain["name"] for domain in client.search_domains("")] == ["replica1.com"]
+        finally:
+            instance.shutdown()
+            thread.join()
+
+    assert domains(primary) == ["new.com", "primary.com"]
@@ -0,0 +1,155 @@
+import sqlite3
+import time
+import unittest.mock
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from postfix_sql_ucli import operations, retry
+
+
+class PostgreSQLError(Exception):
+    def __init__(self, pgcode):
+        super().__init__("error")
+        self.pgcode = pgcode
+
+
+class MySQLError(Exception):
+    pass
+
+
+@pytest.mark.parametrize(
+    ("orig", "transient"),
+    [
+        (PostgreSQLError("40001"), True),
+        (PostgreSQLError("40P01"), True),
+        (PostgreSQLError("55P03"), True),
+        (PostgreSQLError("23505"), False),
+        (MySQLError(1213, "Deadlock found when trying to get lock"), True),
+        (MySQLError(1205, "Lock wait timeout exceeded"), True),
+        (MySQLError(1062, "Duplicate entry"), False),
+        (sqlite3.OperationalError("database is locked"), True),
+        (sqlite3.OperationalError("no such table: virtual_users"), False),
+    ],
+)
+def test_is_transient(orig, transient):
+    assert retry.is_transient(OperationalError("SELECT 1", {}, orig)) is transient
+
+
+def test_is_transient_other_errors():
+    assert not retry.is_transient(RuntimeError("database is locked"))
+    assert not retry.is_transient(IntegrityError("INSERT", {}, sqlite3.IntegrityError("UNIQUE constraint failed")))
+
+
+def test_retry_policy(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+
+    locked = OperationalError("INSERT", {}, sqlite3.OperationalError("database is locked"))
+    function = unittest.mock.Mock(side_effect=[locked, locked, locked, "result"])
+
+    policy = retry.RetryPolicy(attempts=4, backoff=0.1, max_backoff=0.3, jitter=False)
+    assert policy.call(function, "argument", option=True) == "result"
+    function.assert_called_with("argument", option=True)
+    assert sleeps == [0.1, 0.2, 0.3]
+    assert policy.retries == 3
+
+    function.side_effect = [locked] * 4
+    with pytest.raises(OperationalError):
+        policy.call(function)
+    assert function.call_count == 8
+
+    function.side_effect = KeyError
+    with pytest.raises(KeyError):
+        policy.call(function)
+    assert function.call_count == 9
+
+    assert list(retry.RetryPolicy(attempts=3, backoff=0.1, jitter=False).delays()) == [0.1, 0.2]
+    policy = retry.RetryPolicy(backoff=1, max_backoff=4)
+    assert all(0 <= policy.delay(retry) <= min(4, 2 ** (retry - 1)) for retry in range(1, 10) for _ in range(10))
+
+
+@pytest.fixture
+def database(tmp_path, _constant_password_hash):
+    path = tmp_path / "test.sqlite"
+    engine = create_engine(f"sqlite:///{path}")
+    operations.reset_database(engine)
+    operations.add_domain(engine, "test.com")
+    engine.dispose()
+    return path
+
+
+def test_import_concurrent_insert(database):
+    engine = create_engine(f"sqlite:///{database}")
+    concurrent = create_engine(f"sqlite:///{database}")
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # another writer adds one of the users after the batch looked up the existing users
+        if statement.startswith("INSERT INTO virtual_users") and not operations.search_users(concurrent, ""):
+            operations.add_user(concurrent, "user1@test.com", "password")
+
+    entries = [(n, {"type": "user", "email": f"user{n}@test.com", "password": "password"}) for n in range(3)]
+    results = list(operations.import_entries(engine, entries))
+    assert [(result["added"], result["skipped"], result["errors"]) for result in results] == [(2, 1, [])]
+    assert len(operations.search_users(engine, "")) == 3
+
+    engine.dispose()
+    concurrent.dispose()
+
+
+def lock_commit(database, monkeypatch):
+    """Take a shared lock with another connection, so that the next ``COMMIT`` fails after its statements ran
+
+    The lock is released when the retry policy waits before the next attempt.
+
+    :returns: list of the waiting times of the retry policy"""
+
+    reader = sqlite3.connect(database, isolation_level=None)
+    reader.execute("BEGIN")
+    reader.execute("SELECT * FROM virtual_users").fetchall()
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if reader.in_transaction:
+            reader.execute("COMMIT")
+
+    monkeypatch.setattr(time, "sleep", sleep)
+    return sleeps
+
+
+@pytest.fixture
+def engine(database):
+    # no busy timeout, the COMMIT fails right away
+    policy = retry.RetryPolicy(attempts=3, jitter=False)
+    engine = create_engine(f"sqlite:///{database}", connect_args={"timeout": 0}, execution_options={"retry": policy})
+    yield engine
+    engine.dispose()
+
+
+@pytest.mark.parametrize("count_only", [True, False])
+def test_delete_commit_failure(engine, database, monkeypatch, count_only):
+    emails = [f"user{n}@test.com" for n in range(5)]
+    for email in emails:
+        operations.add_user(engine, email, "password")
+
+    sleeps = lock_commit(database, monkeypatch)
+    deleted = operations.delete_user(engine, "user", prefix=True, chunk_size=2, count_only=count_only)
+    assert sleeps == [0.05]
+    # the changes of the failed attempt are rolled back and deleted again, the chunks that follow are not skipped
+    if count_only:
+        assert deleted == len(emails)
+    else:
+        assert [user["email"] for user in deleted] == emails
+    assert operations.search_users(engine, "") == []
+
+
+def test_add_commit_failure(engine, database, monkeypatch):
+    sleeps = lock_commit(database, monkeypatch)
+    users, added = operations.add_user(engine, "user@test.com", "password")
+    assert sleeps == [0.05]
+    # the retry does not find the user inserted by the failed attempt
+    assert added
+    assert operations.search_users(engine, "") == users
@@ -0,0 +1,170 @@
+import json
+import socket
+import threading
+import unittest.mock
+
+import pytest
+from click.testing import CliRunner
+from sqlalchemy import create_engine
+
+from postfix_sql_ucli import cli, operations, server
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.sqlite'}")
+    operations.reset_database(engine)
+    socket_path = str(tmp_path / "test.sock")
+    log = unittest.mock.Mock()
+
+    with server.Server(engine, socket_path, log) as instance:
+        thread = threading.Thread(target=instance.serve_forever, kwargs={'poll_interval': 0.01})
+        thread.start()
+        try:
+            yield socket_path, log
+        finally:
+            instance.shutdown()
+            thread.join()
+            engine.dispose()
+
+
+def test_server_client(daemon):
+    socket_path, log = daemon
+
+    with server.Client(socket_path) as client:
+        assert client.add_domain("test.com") == [[{"id": 1, "name": "test.com"}], True]
+        assert client.add_domain("test.com") == [[{"id": 1, "name": "test.com"}], False]
+        assert client.add_alias("alias@test.com", "user@other.org")[1]
+        assert list(client.iter_domains("")) == [{"id": 1, "name": "test.com"}]
+
+        # stopping the iteration early keeps the connection usable
+        aliases = client.iter_aliases("", "")
+        assert next(aliases)["source"] == "alias@test.com"
+        aliases.close()
+        assert client.search_domains("other") == []
+        assert client.search_aliases("", "", domain_name="other.org") == []
+        assert len(list(client.iter_aliases("", "", domain_name="test.com"))) == 1
+        assert client.search_aliases("", "", limit=1, after=["alias@test.com", "user@other.org"]) == []
+
+        with pytest.raises(RuntimeError, match="unsupported method 'drop_database'"):
+            client.call("drop_database")
+
+        with pytest.raises(AttributeError):
+            client.drop_database  # noqa: B018
+
+    assert log.call_count == 10
+    assert log.call_args_list[0].args[0].startswith("add_domain ok in ")
+    assert log.call_args_list[-1].args[0].startswith("drop_database failed in ")
+
+
+def test_server_concurrent_clients(daemon):
+    socket_path, _ = daemon
+
+    def add_aliases(index):
+        with server.Client(socket_path) as client:
+            for n in range(10):
+                client.add_alias(f"alias{n}@test.com", f"user{index}@other.org")
+
+    with server.Client(socket_path) as client:
+        client.add_domain("test.com")
+
+    threads = [threading.Thread(target=add_aliases, args=(index,)) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with server.Client(socket_path) as client:
+        assert len(client.search_aliases("", "")) == 40
+
+
+def test_server_protocol(daemon):
+    socket_path, _ = daemon
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        stream = sock.makefile('rwb')
+        stream.write(b'{"id": "a", "method": "add_domain", "params": ["test.com"]}\n\nnot json\n')
+        stream.flush()
+
+        response = json.loads(stream.readline())
+        assert response["id"] == "a"
+        assert response["result"] == [[{"id": 1, "name": "test.com"}], True]
+        assert response["elapsed_ms"] > 0
+
+        response = json.loads(stream.readline())
+        assert response["id"] is None
+        assert "error" in response
+        stream.close()
+
+    with pytest.raises(OSError, match="another daemon is already serving"):
+        server.serve(None, socket_path)
+
+
+def test_cli_client_mode(daemon):
+    socket_path, _ = daemon
+    runner = CliRunner()
+
+    result = runner.invoke(
+        cli.main, ['add-domain', '--config', 'tests/postfix-sql-ucli.yml', '--socket', socket_path, 'test.com']
+    )
+    assert result.exit_code == 0
+    assert not result.exception
+    assert (
+        result.output.strip()
+        == "Adding virtual domain: test.com\nCreated new virtual domain: [{'id': 1, 'name': 'test.com'}]"
+    )
+
+    result = runner.invoke(
+        cli.main,
+        ['search-domains', '--config', 'tests/postfix-sql-ucli.yml', '--socket', socket_path, '--format', 'jsonl'],
+    )
+    assert result.exit_code == 0
+    assert result.output == '{"id": 1, "name": "test.com"}\n'
+
+
+def test_cli_client_mode_without_config(daemon, tmp_path, monkeypatch):
+    socket_path, _ = daemon
+    # no postfix-sql-ucli.yml in the working directory of a client host
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv('POSTFIX_SQL_UCLI_SOCKET', raising=False)
+    runner = CliRunner()
+
+    result = runner.invoke(cli.main, ['add-domain', '--socket', socket_path, 'test.com'])
+    assert result.exit_code == 0
+    assert not result.exception
+    result = runner.invoke(cli.main, ['search-domains', '--socket', socket_path, '--format', 'jsonl', 'test'])
+    assert result.exit_code == 0
+    assert result.output == '{"id": 1, "name": "test.com"}\n'
+
+    # the local database engine still requires the configuration file
+    result = runner.invoke(cli.main, ['search-domains', 'test'])
+    assert result.exit_code == 2
+    assert "Invalid value for '--config': Path 'postfix-sql-ucli.yml' does not exist." in result.output
+
+
+def test_cli_client_mode_opt_in(tmp_path, monkeypatch):
+    # a daemon on the default socket does not receive operations unless --socket option is given
+    daemon_engine = create_engine(f"sqlite:///{tmp_path / 'daemon.sqlite'}")
+    operations.reset_database(daemon_engine)
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.sqlite'}")
+    operations.reset_database(engine)
+    config = tmp_path / "config.yml"
+    config.write_text(f"database:\n  type: sqlite\n  name: {tmp_path / 'test.sqlite'}\n")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv('POSTFIX_SQL_UCLI_SOCKET', raising=False)
+
+    with server.Server(daemon_engine, cli.DEFAULT_SOCKET) as instance:
+        thread = threading.Thread(target=instance.serve_forever, kwargs={'poll_interval': 0.01})
+        thread.start()
+        try:
+            result = CliRunner().invoke(cli.main, ['add-domain', '--config', str(config), 'test.com'])
+        finally:
+            instance.shutdown()
+            thread.join()
+
+    assert result.exit_code == 0
+    assert operations.search_domains(daemon_engine, "") == []
+    assert [domain["name"] for domain in operations.search_domains(engine, "")] == ["test.com"]
+    daemon_engine.dispose()
+    engine.dispose()
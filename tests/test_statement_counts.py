@@ -0,0 +1,252 @@
+"""Budgets of SQL statements executed by the public functions of :mod:`postfix_sql_ucli.operations`
+
+Statements are counted on SQLite with an engine event listener. Budgets are exact and expressed in
+terms of the number of entries and the chunk or batch size, so that a query per entry sneaking into
+a single-entry or a bulk code path fails the tests.
+"""
+
+import contextlib
+import inspect
+import math
+
+import pytest
+from sqlalchemy import create_engine, event
+
+from postfix_sql_ucli import operations
+
+# public functions of the operations module covered by the budgets below
+BUDGETED = {
+    "reset_database",
+    "add_domain",
+    "search_domains",
+    "iter_domains",
+    "delete_domain",
+    "add_user",
+    "search_users",
+    "iter_users",
+    "delete_user",
+    "iter_delete_users",
+    "add_alias",
+    "search_aliases",
+    "iter_aliases",
+    "reverse_aliases",
+    "iter_reverse_aliases",
+    "delete_aliases",
+    "iter_delete_aliases",
+    "stats",
+    "iter_stats",
+    "export_maps",
+    "import_entries",
+    "plan_sync",
+    "sync",
+}
+
+DOMAINS = ["a.example", "b.example", "c.example"]
+USERS_PER_DOMAIN = 10
+
+CHUNK_SIZES = [1, 3, 1000]
+
+pytestmark = pytest.mark.usefixtures("_constant_password_hash")
+
+
+def chunks(entries, chunk_size):
+    return math.ceil(entries / chunk_size)
+
+
+def chunked_delete(entries, chunk_size):
+    # a SELECT of the keys and a DELETE per chunk, the last SELECT finds no more entries
+    return 2 * chunks(entries, chunk_size) + 1
+
+
+def import_batch(entry_types):
+    """Statements writing a batch of new entries of the given types"""
+
+    # a SELECT of the existing entries and a multi-row INSERT per entry type,
+    # a SELECT of the domain IDs of users and aliases
+    return 2 * len(set(entry_types)) + (1 if {"user", "alias"} & set(entry_types) else 0)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.sqlite'}")
+    operations.reset_database(engine)
+    entries = [{"type": "domain", "name": domain} for domain in DOMAINS]
+    for domain in DOMAINS:
+        for n in range(USERS_PER_DOMAIN):
+            entries.append({"type": "user", "email": f"user{n}@{domain}", "password": "password"})
+            entries.append({"type": "alias", "source": f"alias{n}@{domain}", "destination": f"user{n}@{domain}"})
+    list(operations.import_entries(engine, enumerate(entries, 1)))
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def count_statements(engine):
+    """Context manager collecting the statements executed by the engine into a list"""
+
+    @contextlib.contextmanager
+    def count_statements():
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+    return count_statements
+
+
+def consume(result):
+    return list(result) if inspect.isgenerator(result) else result
+
+
+def test_every_operation_budgeted(public_functions):
+    assert set(public_functions(operations)) == BUDGETED
+
+
+def test_reset_database(engine, count_statements):
+    with count_statements() as statements:
+        operations.reset_database(engine)
+    # checking for, dropping and creating the tables and their indexes
+    assert len(statements) == 22
+
+
+@pytest.mark.parametrize(
+    ("function", "args", "budget"),
+    [
+        # a single INSERT resolving the domain ID, a SELECT of the existing entry if nothing was inserted
+        (operations.add_domain, ("new.example",), 1),
+        (operations.add_domain, ("a.example",), 2),
+        # users are checked by a SELECT before the password is hashed, followed by the INSERT
+        # or a SELECT of the existing entry
+        (operations.add_user, ("new@a.example", "password"), 2),
+        (operations.add_user, ("user0@a.example", "password"), 2),
+        (operations.add_user, ("user@unknown.example", "password"), 1),
+        (operations.add_alias, ("new@a.example", "user0@a.example"), 1),
+        (operations.add_alias, ("alias0@a.example", "user0@a.example"), 2),
+        (operations.search_domains, ("",), 1),
+        (operations.search_users, ("",), 1),
+        (operations.search_aliases, ("", ""), 1),
+        (operations.reverse_aliases, ("user0@a.example",), 1),
+        (operations.stats, (), 1),
+    ],
+)
+def test_single_statement(engine, count_statements, function, args, budget):
+    with count_statements() as statements:
+        function(engine, *args)
+    assert len(statements) == budget
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize(
+    ("function", "args"),
+    [
+        (operations.iter_domains, ("",)),
+        (operations.iter_users, ("",)),
+        (operations.iter_aliases, ("", "")),
+        (operations.iter_reverse_aliases, ("user0@a.example",)),
+        (operations.iter_stats, ()),
+    ],
+)
+def test_streaming(engine, count_statements, function, args, chunk_size):
+    # entries are fetched in chunks from a single cursor
+    with count_statements() as statements:
+        assert list(function(engine, *args, chunk_size=chunk_size))
+    assert len(statements) == 1
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_plan_sync(engine, count_statements, chunk_size):
+    state = {"domains": DOMAINS, "users": [], "aliases": []}
+    with count_statements() as statements:
+        plan = operations.plan_sync(engine, state, chunk_size=chunk_size)
+    assert len(plan["delete"]["user"]) == len(DOMAINS) * USERS_PER_DOMAIN
+    # one streaming query per entry type
+    assert len(statements) == 3
+
+
+def test_export_maps(engine, count_statements, tmp_path):
+    with count_statements() as statements:
+        operations.export_maps(engine, str(tmp_path), chunk_size=1)
+    assert len(statements) == 3
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize(
+    ("function", "args", "kwargs", "entries"),
+    [
+        (operations.delete_user, ("user",), {"prefix": True}, len(DOMAINS) * USERS_PER_DOMAIN),
+        (operations.delete_user, ("user",), {"prefix": True, "count_only": True}, len(DOMAINS) * USERS_PER_DOMAIN),
+        (operations.delete_user, ("user0@a.example",), {}, 1),
+        (operations.iter_delete_users, ("user",), {"prefix": True}, len(DOMAINS) * USERS_PER_DOMAIN),
+        (operations.delete_aliases, ("alias", ""), {}, len(DOMAINS) * USERS_PER_DOMAIN),
+        (operations.delete_aliases, ("", "user0@"), {"count_only": True}, len(DOMAINS)),
+        (operations.iter_delete_aliases, ("alias", ""), {}, len(DOMAINS) * USERS_PER_DOMAIN),
+    ],
+)
+def test_chunked_delete(engine, count_statements, function, args, kwargs, entries, chunk_size):
+    with count_statements() as statements:
+        consume(function(engine, *args, chunk_size=chunk_size, **kwargs))
+    assert len(statements) == chunked_delete(entries, chunk_size)
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_delete_domain(engine, count_statements, chunk_size):
+    with count_statements() as statements:
+        list(operations.delete_domain(engine, "a.example", chunk_size=chunk_size))
+    # resolving the domain, aliases and users in chunks and the domain itself
+    assert len(statements) == 1 + 2 * chunked_delete(USERS_PER_DOMAIN, chunk_size) + 1
+
+    with count_statements() as statements:
+        list(operations.delete_domain(engine, "a.example", chunk_size=chunk_size))
+    assert len(statements) == 1
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 1000])
+@pytest.mark.parametrize("entry_type", ["domain", "user", "alias"])
+@pytest.mark.parametrize("entries", [10, 100])
+def test_import_entries(engine, count_statements, entry_type, entries, batch_size):
+    fields = {
+        "domain": lambda n: {"name": f"import{n}.example"},
+        "user": lambda n: {"email": f"import{n}@a.example", "password": "password"},
+        "alias": lambda n: {"source": f"import{n}@a.example", "destination": "user0@a.example"},
+    }[entry_type]
+    lines = [(n, {"type": entry_type, **fields(n)}) for n in range(entries)]
+    with count_statements() as statements:
+        results = list(operations.import_entries(engine, lines, batch_size=batch_size))
+    assert sum(result["added"] for result in results) == entries
+    assert len(statements) == chunks(entries, batch_size) * import_batch([entry_type])
+
+
+@pytest.mark.parametrize("batch_size", [1, 4, 1000])
+def test_sync(engine, count_statements, batch_size):
+    state = {
+        "domains": DOMAINS[1:] + ["new.example"],
+        "users": [
+            # users of b.example with updated passwords, new users of new.example
+            {"email": f"user{n}@{domain}", "password": "password", "password_hash": "new"}
+            for domain in DOMAINS[1:]
+            for n in range(USERS_PER_DOMAIN)
+        ]
+        + [{"email": f"user{n}@new.example", "password": "password"} for n in range(7)],
+        "aliases": [{"source": f"alias{n}@c.example", "destination": f"user{n}@c.example"} for n in range(5)],
+    }
+    plan = operations.plan_sync(engine, state)
+    # domains are added before users
+    additions = ["domain"] * len(plan["add"]["domain"]) + ["user"] * len(plan["add"]["user"])
+    assert (len(additions), len(plan["update"]["user"])) == (8, 2 * USERS_PER_DOMAIN)
+
+    with count_statements() as statements:
+        result = operations.sync(engine, plan, batch_size=batch_size)
+    assert result["errors"] == []
+
+    # a DELETE per batch of entries of the same type
+    deletes = sum(chunks(len(entries), batch_size) for entries in plan["delete"].values())
+    adds = sum(import_batch(additions[start : start + batch_size]) for start in range(0, len(additions), batch_size))
+    # an UPDATE executemany per batch
+    updates = chunks(len(plan["update"]["user"]), batch_size)
+    assert len(statements) == deletes + adds + updates